@@ -0,0 +1,121 @@
+"""
+Compares the typed single pass parser with the previous regex based one on long expressions.
+It isn't a command of mathcp.bench because the previous implementation it carries doesn't belong to the package.
+
+Usage: python benchmarks/parser.py [operations]
+"""
+import re
+import sys
+import timeit
+
+from mathcp.math import operators, prepare_input, validate_input, shunting_yard, rpn_execute
+
+
+# The previous implementation, kept here only to compare with
+
+def legacy_prepare_input(expression: str) -> [str]:
+    parts = re.findall(r'[0-9.?]+|\(|\)|.', str(expression))
+    return list(filter(lambda x: len(x), map(str.strip, parts)))
+
+
+def legacy_validate_input(expression: [str]) -> [str]:
+    for token in expression:
+        if not token in operators and not legacy_is_number(token) and not token in ("(", ")"):
+            raise SyntaxError("Invalid token %s" % token)
+
+    return expression
+
+
+def legacy_is_number(value) -> bool:
+    try:
+        float(value)
+        return True
+    except ValueError:
+        return False
+
+
+def legacy_shunting_yard(expression: [str]) -> [str]:
+    output_queue = []
+    operator_stack = []
+
+    for token in expression:
+
+        if legacy_is_number(token):
+            output_queue.append(token)
+            continue
+
+        if token == "(":
+            # If it's a left bracket push it onto the stack
+            operator_stack.append(token)
+            continue
+
+        if token == ")":
+            while operator_stack and operator_stack[-1] != "(":
+                # While there's not a left bracket at the top of the stack
+                # Pop operators from the stack onto the output queue.
+                output_queue.append(operator_stack.pop())
+
+            # Pop the left bracket from the stack and discard it
+            operator_stack.pop()
+
+        if token in operators:
+            while operator_stack and operator_stack[-1] not in ("(", ")") and operators[operator_stack[-1]][
+                'precedence'] >= operators[token]['precedence']:
+                # While there's an operator on the top of the stack with greater precedence:
+                # Pop operators from the stack onto the output queue
+                output_queue.append(operator_stack.pop())
+
+            # Push the current operator onto the stack
+            operator_stack.append(token)
+
+    # While there's operators on the stack, pop them to the queue
+    while operator_stack:
+        output_queue.append(operator_stack.pop())
+
+    return output_queue
+
+
+def legacy_rpn_execute(rpn: [str]) -> float:
+    stack = []
+
+    for value in rpn:
+        if value in operators:
+            try:
+                b, a = stack.pop(), stack.pop()
+            except IndexError:
+                raise SyntaxError("Invalid expression")
+
+            function = operators[value]['exec']
+
+            if callable(function):
+                stack.append(function(a, b))
+        else:
+            # Don't convert to float if not needed
+            stack.append(int(value) if value.replace('-', '').isdigit() else float(value))
+
+    return stack.pop()
+
+
+def legacy_calculate(expression):
+    return legacy_rpn_execute(legacy_shunting_yard(legacy_validate_input(legacy_prepare_input(expression))))
+
+
+def calculate(expression):
+    return rpn_execute(shunting_yard(validate_input(prepare_input(expression))))
+
+
+def main():
+    operations = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    expression = ' + '.join('(%d * 3.25 - 17 / 4)' % i for i in range(operations // 4))
+
+    assert calculate(expression) == legacy_calculate(expression)
+
+    for name, function in (('legacy', legacy_calculate), ('typed', calculate)):
+        timer = timeit.Timer(lambda: function(expression))
+        number, _ = timer.autorange()
+        best = min(timer.repeat(5, number)) / number
+        print("%-8s %d tokens: %.3f ms" % (name, len(prepare_input(expression)), best * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,75 +1,701 @@
 import argparse
 import logging
+import time
+from collections import deque
+from functools import partial
 
-from mathcp.loop import Loop
-from mathcp.math import calculate
-from mathcp.parallel import Pool
-from mathcp.server import Server, Connection
+from mathcp.aio import AsyncLoop, AsyncPool, AsyncServer
+from mathcp.cache import ResultCache
+from mathcp.loop import Loop, SelectorLoop
+from mathcp.math import (
+    Arithmetic, Program, compile, execute_many, execute_bindings, expression_cache, get_arithmetic, init_worker,
+    parse_number
+)
+from mathcp.metrics import Registry, registry
+from mathcp.parallel import BasePool, ExecutorPool, Pool, Scheduler, create_executor
+from mathcp.profiler import SamplingProfiler, SlowLog
+from mathcp.protocol import ERROR_BUSY, ERROR_CALCULATION, ERROR_INVALID, ERROR_PROTOCOL, pack_error, pack_result
+from mathcp.server import Admission, Server, Connection
+from mathcp.supervisor import ShutdownHandler, Supervisor
 
 logger = logging.getLogger(__name__)
 
+connections_total = registry.counter('mathcp_connections_total', "Accepted connections")
+messages_total = registry.counter('mathcp_messages_total', "Received messages")
+parse_seconds = registry.histogram('mathcp_parse_seconds', "Time to compile an expression, cached or not")
+latency_seconds = registry.histogram(
+    'mathcp_latency_seconds', "Time from the parsing of an expression until its reply is sent"
+)
+
+
+class Reply(object):
+    """
+    Placeholder for a reply which is not ready yet
+    """
+
+    __slots__ = ('message', 'start', 'program', 'parse', 'request_id', 'timing')
+
+    def __init__(self, start: float = None, program: Program = None, parse=0.0, request_id: int = None):
+        self.message = None
+        # time.perf_counter() when the message was received, for the latency of calculations
+        self.start = start
+        # For the slow log, the calculated program and the time it took to parse the message
+        self.program = program
+        self.parse = parse
+        # Id of the request in the binary protocol or the tagged mode, the reply is sent as soon as it's ready
+        self.request_id = request_id
+        # (queue wait, execution, batch size) of the pool job which calculated it, None when it wasn't calculated
+        self.timing = None
+
 
 class MathSolver(Connection):
     """
     This is a Connection implementation which separates socket data by '\n'
     and executes each message in a pool of processes to obtain the result of
     the math operations.
+
+    Expressions are sent to the pool in batches together with the expressions of
+    the other connections, replies are queued so they are sent in the order of the messages.
+
+    Expressions with variables can be evaluated for many values with a sweep:
+    'sweep a * (b + 2)' compiles the expression, then each message is a row of values
+    for the variables (separated by spaces or commas) until 'end' is received.
+
+    The calculations in flight are limited by the admission, messages received over the limits
+    wait in a backlog while reading from the socket is paused, or get a busy error.
+
+    'stats' replies with the metrics of the server, one 'STAT name value' line each, and 'END'.
+    'profile start' and 'profile stop' sample the stacks of the loop with the profiler.
+    Calculations slower than the threshold of the slow log are logged.
+
+    With a result cache the results of the expressions are looked up before they are sent to the pool,
+    the cache is shared by the server processes.
+
+    After 'tagged' each message is '<id> <expression>' and its reply is '<id> <result>', sent as soon
+    as the result is ready, so a slow expression doesn't hold back the ones after it.
+
+    'arithmetic fraction' (or 'decimal', 'decimal(50)', 'float') calculates the next expressions with exact
+    numbers, a single expression can be prefixed with the arithmetic instead: 'fraction: 1 / 3'.
     """
 
-    def __init__(self, raw_socket, pool: Pool, **kwargs):
-        super().__init__(raw_socket, '\n', 'utf8')
+    __slots__ = (
+        '_pool', '_admission', '_profiler', '_slow_log', '_results', '_arithmetic', '_replies', '_sweep', '_tagged',
+        '_in_flight', '_backlog', '_admitting'
+    )
+
+    separator = '\n'
+
+    def __init__(self, raw_socket, pool: Pool, admission: Admission = None, profiler: SamplingProfiler = None,
+                 slow_log: SlowLog = None, results: ResultCache = None, arithmetic: Arithmetic = None, **kwargs):
+        super().__init__(raw_socket, self.separator, 'utf8', **kwargs)
         self._pool = pool
+        self._admission = admission or Admission()
+        self._profiler = profiler
+        self._slow_log = slow_log
+        self._results = results
+        # None for ints and floats
+        self._arithmetic = arithmetic
+        # Created for the first calculation and dropped when all the replies are sent
+        self._replies = None
+        self._sweep = None
+        self._tagged = False
+        self._in_flight = 0
+        # Created when the connection is over the limits for the first time
+        self._backlog = None
+        self._admitting = False
 
     def on_message(self, message):
-        logger.info("Message: %s", message)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Message: %s", message)
 
-        if message == "":
-            self.send("Please enter an expression!")
+        messages_total.inc()
+
+        if self._backlog or (self._admission.policy == 'pause' and self._admission.full(self._in_flight)):
+            # Over the limits, the message waits for the results of the previous ones
+            if self._backlog is None:
+                self._backlog = deque()
+
+            self._backlog.append(message)
+            self._wait()
             return
 
+        self.handle_message(message)
+
+    def handle_message(self, message: str) -> None:
         if message == chr(0x03) or message == "exit":
             # Disconnect when "exit" or Ctrl-C is received
             self.on_disconnect()
             return
 
-        self._pool.add(calculate, (message,), self.on_calculation_success, self.on_calculation_error)
+        if self._sweep:
+            self.on_sweep_row(message)
+            return
+
+        if self._tagged:
+            self.on_tagged_message(message)
+            return
+
+        if message == "":
+            self.reply("Please enter an expression!")
+            return
+
+        if message.startswith("sweep "):
+            self.on_sweep_start(message[6:])
+            return
+
+        if message == "stats":
+            self.reply("\r\n".join(registry.stats() + ["END"]))
+            return
+
+        if message.startswith("profile "):
+            self.on_profile(message[8:])
+            return
+
+        if message == "tagged":
+            self._tagged = True
+            self.reply("Tagged mode")
+            return
+
+        if message.startswith("arithmetic "):
+            self.on_arithmetic(message[11:])
+            return
+
+        start = time.perf_counter()
+
+        try:
+            # Parsing is cached, so only the execution of the program is sent to the pool
+            program = self.compile_expression(message)
+        except Exception as e:
+            self.on_calculation_error(e)
+            return
+
+        parse = time.perf_counter() - start
+        parse_seconds.observe(parse)
+        self.calculate(execute_many, program, program, start, parse)
+
+    def compile_expression(self, expression: str) -> Program:
+        """
+        Compiles the expression with the arithmetic of the connection or the one of its prefix
+        """
+        arithmetic = self._arithmetic
+
+        if ':' in expression:
+            name, _, expression = expression.partition(':')
+            arithmetic = get_arithmetic(name.strip())
+
+        return compile(expression, arithmetic=arithmetic)
+
+    def on_arithmetic(self, name: str) -> None:
+        try:
+            self._arithmetic = get_arithmetic(name.strip())
+        except SyntaxError as e:
+            self.reply("Error: %s!" % e)
+            return
+
+        self.reply("Arithmetic %s" % (self._arithmetic.name if self._arithmetic else 'float'))
+
+    def on_sweep_start(self, expression: str) -> None:
+        try:
+            self._sweep = self.compile_expression(expression)
+        except Exception as e:
+            self.on_calculation_error(e)
+            return
+
+        self.reply("Variables: %s" % ", ".join(self._sweep.variables))
+
+    def on_sweep_row(self, message: str) -> None:
+        if message == "end":
+            self._sweep = None
+            self.reply("Sweep finished")
+            return
+
+        program = self._sweep
+        start = time.perf_counter()
+        parse = parse_number if program.arithmetic is None else program.arithmetic.parse
+
+        try:
+            row = tuple(parse(value) for value in message.replace(',', ' ').split())
+        except SyntaxError as e:
+            self.on_calculation_error(e)
+            return
+
+        if len(row) != len(program.variables):
+            self.reply("Error: Expected %d values!" % len(program.variables))
+            return
+
+        self.calculate(execute_bindings, (program, row), program, start, time.perf_counter() - start)
+
+    def on_tagged_message(self, message: str) -> None:
+        request_id, _, expression = message.partition(" ")
+
+        if not expression:
+            self.reply("Error: Expected '<id> <expression>'!")
+            return
+
+        start = time.perf_counter()
+
+        try:
+            program = self.compile_expression(expression)
+        except Exception as e:
+            self.send("%s %s" % (request_id, self.error_message(e)))
+            return
+
+        parse = time.perf_counter() - start
+        parse_seconds.observe(parse)
+        self.calculate(execute_many, program, program, start, parse, request_id)
+
+    def on_profile(self, command: str) -> None:
+        profiler = self._profiler
+
+        if profiler is None:
+            self.reply("Error: Profiling is not enabled!")
+        elif command == "start":
+            profiler.start()
+            self.reply("Profiling at %s Hz" % profiler.rate)
+        elif command == "stop":
+            if profiler.running:
+                self.reply("Profile written to %s (%d samples)" % (profiler.path, profiler.stop()))
+            else:
+                self.reply("Error: Profiler is not running!")
+        else:
+            self.reply("Error: Expected 'profile start' or 'profile stop'!")
+
+    def calculate(self, func: callable, arg, program: Program, start: float = None, parse=0.0,
+                  request_id: int = None) -> None:
+        """
+        Sends arg to the pool for a batch call of func, the result is replied in order
+        unless it has a request_id. start is the time the message was received, for the latency
+        metric and the slow log.
+        """
+        if self._admission.full(self._in_flight):
+            # Only with the reject policy, otherwise the message would wait in the backlog
+            self._admission.shed += 1
+            self.on_busy(request_id)
+            return
+
+        self._in_flight += 1
+        self._admission.acquire()
+
+        reply = Reply(start, program, parse, request_id)
+
+        if request_id is None:
+            if self._replies is None:
+                self._replies = deque()
+
+            self._replies.append(reply)
+
+        if self._results is not None and func is execute_many and program.arithmetic is None:
+            result = self._results.get(program.key)
+
+            if result is not None:
+                self.on_calculation_success(result, reply)
+                return
+
+            success = self.on_result
+        else:
+            success = self.on_calculation_success
+
+        self._pool.add_batched(
+            func,
+            arg,
+            partial(self.on_pool_done, success, reply),
+            partial(self.on_pool_done, self.on_calculation_error, reply),
+            cost=program.cost
+        )
+
+    def on_pool_done(self, callback: callable, reply: Reply, result) -> None:
+        """
+        Called by the pool with the result or the error of a calculation, the timing of the pool
+        is the one of this job only until the callback returns, so the reply keeps it
+        """
+        reply.timing = self._pool.timing
+        callback(result, reply)
+
+    def on_busy(self, request_id: str = None) -> None:
+        if request_id is None:
+            self.reply("Error: Server is busy!")
+        else:
+            self.send("%s Error: Server is busy!" % request_id)
+
+    def on_admitted(self) -> None:
+        """
+        Called when the limits allow to handle the messages of the backlog
+        """
+        if self._admitting:
+            return
+
+        self._admitting = True
+
+        try:
+            while self._backlog and self.loop:
+                if self._admission.full(self._in_flight):
+                    self._wait()
+                    return
+
+                self.handle_message(self._backlog.popleft())
+        finally:
+            self._admitting = False
+
+        if self.loop:
+            self.resume_reading()
+
+    def _wait(self) -> None:
+        self.pause_reading()
+
+        if self._admission.full(0):
+            # Other connections free the global limit, this connection frees only its own
+            self._admission.wait(self)
+
+    def _finish(self, reply: Reply) -> None:
+        self._in_flight -= 1
+        self._admission.release()
+
+        if self._slow_log and reply.start is not None:
+            elapsed = time.perf_counter() - reply.start
+
+            if elapsed >= self._slow_log.threshold:
+                program = reply.program
+                self._slow_log.record(program.key, program.tokens, elapsed, reply.parse, reply.timing)
+
+        if self._backlog:
+            self.on_admitted()
 
     def on_message_error(self, error: Exception) -> None:
-        logger.info("Error: %s", error)
-        self.send("Error while executing the expression!")
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Error: %s", error)
+
+        self.reply("Error while executing the expression!")
+
+    def on_calculation_success(self, result, reply: Reply = None):
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Calculation success: %s", result)
 
-    def on_calculation_success(self, result):
-        logger.info("Calculation success: %s", result)
-        self.send(str(result))
+        self.reply(str(result), reply)
 
-    def on_calculation_error(self, error):
-        logger.info("Calculation error: %s", error)
+        if reply is not None:
+            self._finish(reply)
 
+    def on_result(self, result, reply: Reply) -> None:
+        """
+        Stores the result of a calculation in the result cache before replying with it
+        """
+        self._results.put(reply.program.key, result)
+        self.on_calculation_success(result, reply)
+
+    def on_calculation_error(self, error, reply: Reply = None):
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Calculation error: %s", error)
+
+        self.reply(self.error_message(error), reply)
+
+        if reply is not None:
+            self._finish(reply)
+
+    @staticmethod
+    def error_message(error: Exception) -> str:
         if isinstance(error, SyntaxError):
-            self.send("Error: Invalid expression!")
-        else:
-            self.send("Error: %s" % error)
+            return "Error: Invalid expression!"
+
+        return "Error: %s" % error
+
+    def reply(self, message: str, reply: Reply = None) -> None:
+        """
+        Sends the message after the replies to the previous messages,
+        a tagged reply is sent right away with its request id
+        """
+        if not self.loop:
+            # Connection was closed while the calculation was running
+            return
+
+        if reply is not None and reply.request_id is not None:
+            self.send("%s %s" % (reply.request_id, message))
+            latency_seconds.observe(time.perf_counter() - reply.start)
+            return
+
+        if reply is None:
+            if not self._replies:
+                self.send(message)
+                return
+
+            reply = Reply()
+            self._replies.append(reply)
+
+        reply.message = message
+        replies = self._replies
+        now = time.perf_counter()
+
+        while replies and replies[0].message is not None:
+            reply = replies.popleft()
+            self.send(reply.message)
+
+            if reply.start is not None:
+                latency_seconds.observe(now - reply.start)
+
+        if not replies:
+            self._replies = None
 
     def on_connected(self):
         super().on_connected()
+        connections_total.inc()
+        self.welcome()
+
+    def welcome(self) -> None:
         self.send("=====================================")
         self.send(" Welcome to math solver")
         self.send(" Allowed operations are: +, -, *, /")
         self.send("")
+        self.send(" Send 'sweep <expression>' to evaluate an expression")
+        self.send(" with variables for many values, 'end' to stop")
+        self.send(" Send 'tagged' to prefix the expressions with an id,")
+        self.send(" results are then sent as soon as they are ready")
+        self.send(" Send 'arithmetic fraction' or 'arithmetic decimal(50)'")
+        self.send(" for exact numbers, 'arithmetic float' to go back")
         self.send(" Send 'exit' or Ctrl-C to quit")
         self.send("=====================================")
 
     def on_disconnect(self):
         super().on_disconnect()
-        logger.info("Connection closed")
+        self._admission.cancel(self)
+        self._backlog = None
+
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Connection closed")
+
+
+class BinaryMathSolver(MathSolver):
+    """
+    MathSolver for the binary protocol of mathcp.protocol. Messages are tuples of a request id
+    and an expression, every result is sent as soon as it's ready together with the id of its request,
+    so a slow expression doesn't hold back the ones after it. There is no welcome message.
+    """
+
+    __slots__ = ()
+
+    separator = None
+
+    def welcome(self) -> None:
+        pass
+
+    def handle_message(self, message: tuple) -> None:
+        request_id, expression = message
+        start = time.perf_counter()
+
+        try:
+            program = self.compile_expression(expression)
+        except Exception as e:
+            self.send_error(request_id, e)
+            return
+
+        parse = time.perf_counter() - start
+        parse_seconds.observe(parse)
+        self.calculate(execute_many, program, program, start, parse, request_id)
+
+    def send_error(self, request_id: int, error: Exception) -> None:
+        if isinstance(error, SyntaxError):
+            self.write(pack_error(request_id, ERROR_INVALID, "Invalid expression"))
+        else:
+            self.write(pack_error(request_id, ERROR_CALCULATION, str(error)))
+
+    def on_busy(self, request_id: int = None) -> None:
+        self.write(pack_error(request_id, ERROR_BUSY, "Server is busy"))
+
+    def on_message_error(self, error: Exception) -> None:
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Error: %s", error)
+
+        # A FrameError knows the request, a frame which is too long doesn't
+        self.write(pack_error(getattr(error, 'request_id', 0), ERROR_PROTOCOL, str(error)))
+
+    def on_calculation_success(self, result, reply: Reply = None):
+        if self.loop:
+            self.write(pack_result(reply.request_id, result))
+            latency_seconds.observe(time.perf_counter() - reply.start)
+
+        self._finish(reply)
+
+    def on_calculation_error(self, error, reply: Reply = None):
+        if self.loop:
+            self.send_error(reply.request_id, error)
+            latency_seconds.observe(time.perf_counter() - reply.start)
+
+        self._finish(reply)
+
+
+class MetricsConnection(Connection):
+    """
+    Minimal HTTP/1.0 handler which answers every request with the metrics of the registry
+    in the Prometheus text format, so the metrics port can be scraped.
+    """
+
+    __slots__ = ('_registry', '_request')
+
+    def __init__(self, raw_socket, registry: Registry = registry, **kwargs):
+        super().__init__(raw_socket, '\n', 'latin1', **kwargs)
+        self._registry = registry
+        self._request = None
+
+    def on_message(self, message: str) -> None:
+        if self._request is None:
+            self._request = message
+            return
 
+        if message:
+            # Headers are not needed
+            return
+
+        if self._request.startswith('GET '):
+            body = self._registry.prometheus()
+            self.send(
+                "HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: %d\r\n\r\n%s"
+                % (len(body), body), end=''
+            )
+        else:
+            self.send("HTTP/1.0 405 Method Not Allowed\r\nContent-Length: 0\r\n\r\n", end='')
+
+        self.close()
+
+
+def register_metrics(servers: list, pool: BasePool, admission: Admission, results: ResultCache = None) -> None:
+    """
+    Registers the gauges and the counters which are read from the server objects when the metrics are collected
+    """
+    registry.gauge(
+        'mathcp_connections', "Open connections", lambda: sum(server.connection_count for server in servers)
+    )
+    registry.gauge('mathcp_pool_pending', "Jobs and batches running in the pool", lambda: pool.pending)
+    registry.gauge('mathcp_in_flight', "Expressions accepted and not answered yet", lambda: admission.in_flight)
+    registry.gauge('mathcp_waiting', "Connections paused by the global limit", lambda: admission.waiting)
+    registry.counter('mathcp_shed_total', "Expressions rejected because the server was busy", lambda: admission.shed)
+    registry.counter('mathcp_inlined_total', "Jobs executed on the loop", lambda: pool.scheduler.inlined)
+    registry.counter('mathcp_offloaded_total', "Jobs sent to the pool", lambda: pool.scheduler.offloaded)
+    registry.counter('mathcp_cache_hits_total', "Expressions found in the compile cache", lambda: expression_cache.hits)
+    registry.counter('mathcp_cache_misses_total', "Expressions compiled", lambda: expression_cache.misses)
+
+    if results is not None:
+        registry.counter('mathcp_result_cache_hits_total', "Results found in the result cache", lambda: results.hits)
+        registry.counter(
+            'mathcp_result_cache_misses_total', "Results not found in the result cache", lambda: results.misses
+        )
+
+
+def create_pool(backend='select', pool_backend='multiprocessing', batch_size=128, inline_threshold=0.0005,
+                pool_size: int = None, start_method: str = None, max_tasks_per_child: int = None,
+                timeout: float = 0) -> BasePool:
+    """
+    Creates the pool of the server backend, workers are initialized with mathcp.math.init_worker
+    which warms them up and limits the execution time of an expression to timeout seconds
+
+    pool_backend is one of:
+
+    multiprocessing - multiprocessing.Pool, the only one which supports max_tasks_per_child
+    process - concurrent.futures.ProcessPoolExecutor
+    thread - concurrent.futures.ThreadPoolExecutor
+    """
+    scheduler = Scheduler(inline_threshold)
+    initializer = partial(init_worker, timeout)
+
+    if backend == 'asyncio' or pool_backend != 'multiprocessing':
+        executor_backend = 'thread' if pool_backend == 'thread' else 'process'
+        executor = create_executor(executor_backend, pool_size, start_method, initializer)
+
+        if backend == 'asyncio':
+            return AsyncPool(executor, batch_size, scheduler)
+
+        return ExecutorPool(executor, batch_size, scheduler)
+
+    return Pool(batch_size, scheduler, pool_size, start_method, initializer, max_tasks_per_child)
+
+
+def run_server(host: str, port: int, backend='select', batch_size=128, inline_threshold=0.0005,
+               read_size=65536, max_line_length=65536, write_buffer_size=65536, pool_backend='multiprocessing',
+               pool_size: int = None, start_method: str = None, max_tasks_per_child: int = None,
+               reuse_port=False, handle_signals=False, drain_timeout=10.0, max_in_flight=10000,
+               max_connection_in_flight=1000, overload_policy='pause', timeout=10.0, metrics_port: int = None,
+               profile: str = None, profile_rate=100, slow_threshold=0.0, binary_port: int = None,
+               results: ResultCache = None, arithmetic='float', allow_profile=False):
+    """
+    Runs the server on one of the backends:
+
+    select - SelectorLoop which services only ready sockets
+    poll - Loop which ticks every socket on each loop
+    asyncio - asyncio event loop with run_in_executor pool
 
-def run_server(host: str, port: int):
-    pool = Pool()
-    server = Server(host, port, MathSolver, pool=pool)
-    server.listen()
+    With handle_signals (only from the main thread) the server drains its connections
+    on SIGTERM or SIGINT and returns. With metrics_port the metrics are served over HTTP on that port.
 
-    Loop(server, pool).run()
+    With profile the loop is profiled from the start and the collapsed stacks are written to that
+    file when the server stops. Clients can start and stop the profiler with 'profile start' only
+    with profile or allow_profile, it writes mathcp-<pid>.folded to the working directory by default.
+    Calculations slower than slow_threshold seconds are logged, 0 disables the slow log.
+
+    With binary_port the binary protocol (see mathcp.protocol) is served on that port too.
+
+    results is the ResultCache of the expressions, it should be created before the worker processes
+    are forked so they share it.
+
+    arithmetic is the default arithmetic of the connections, see mathcp.math.get_arithmetic.
+    """
+    pool = create_pool(
+        backend, pool_backend, batch_size, inline_threshold, pool_size, start_method, max_tasks_per_child, timeout
+    )
+    admission = Admission(max_in_flight, max_connection_in_flight, overload_policy)
+    profiler = SamplingProfiler(profile, profile_rate) if profile or allow_profile else None
+    options = dict(
+        admission=admission,
+        profiler=profiler,
+        slow_log=SlowLog(slow_threshold) if slow_threshold else None,
+        results=results,
+        arithmetic=get_arithmetic(arithmetic),
+        reuse_port=reuse_port,
+        read_size=read_size,
+        max_line_length=max_line_length,
+        high_watermark=write_buffer_size,
+        low_watermark=write_buffer_size // 4
+    )
+
+    server_class = AsyncServer if backend == 'asyncio' else Server
+    servers = [server_class(host, port, MathSolver, pool=pool, **options)]
+
+    if binary_port:
+        servers.append(server_class(host, binary_port, BinaryMathSolver, pool=pool, **options))
+
+    if backend == 'asyncio':
+        loop = AsyncLoop(pool, *servers)
+
+        for server in servers:
+            server.listen()
+    else:
+        # Listening first, the selector loop watches the servers which have a socket
+        for server in servers:
+            server.listen()
+
+        loop = SelectorLoop(pool, *servers) if backend == 'select' else Loop(pool, *servers)
+
+    register_metrics(servers, pool, admission, results)
+    metrics_server = None
+
+    if metrics_port:
+        # A plain server on every backend, the asyncio loop polls it
+        metrics_server = Server(host, metrics_port, MetricsConnection)
+        metrics_server.listen()
+        loop.add(metrics_server)
+
+    if handle_signals:
+        loop.add(ShutdownHandler(*servers, drain_timeout=drain_timeout).install())
+
+    if profile:
+        profiler.start()
+
+    try:
+        loop.run()
+    finally:
+        pool.destroy()
+
+        if profiler is not None and profiler.running:
+            profiler.stop()
+
+        if metrics_server:
+            metrics_server.destroy()
 
 
 def main():
@@ -82,12 +708,106 @@ def main():
     parser.add_argument("host", type=str, nargs="?", help="Server ip address. Default: 0.0.0.0", default='0.0.0.0')
     parser.add_argument("port", type=int, nargs="?", help="Server port. Default: 8000", default="8000")
     parser.add_argument('-v', '--verbose', help="Verbose logger", action="store_true")
+    parser.add_argument('--backend', help="Server backend. Default: select", choices=('select', 'poll', 'asyncio'),
+                        default='select')
+    parser.add_argument('--cache-size', type=int, help="Compiled expressions cache size. Default: 1024",
+                        default=1024)
+    parser.add_argument('--batch-size', type=int, help="Maximum expressions sent to the pool at once. Default: 128",
+                        default=128)
+    parser.add_argument('--inline-threshold', type=float, default=0.0005,
+                        help="Expressions predicted to run faster (in seconds) are calculated on the loop "
+                             "instead of the pool, 0 disables it. Default: 0.0005")
+    parser.add_argument('--read-size', type=int, help="Bytes read from a socket at once. Default: 65536",
+                        default=65536)
+    parser.add_argument('--max-line-length', type=int, default=65536,
+                        help="Connections sending longer lines are closed. Default: 65536")
+    parser.add_argument('--write-buffer-size', type=int, default=65536,
+                        help="Reading from a client is paused while more bytes of replies are waiting "
+                             "to be sent to it. Default: 65536")
+    parser.add_argument('--pool-backend', choices=('multiprocessing', 'process', 'thread'), default='multiprocessing',
+                        help="Pool of the workers, concurrent.futures process or thread executors are the "
+                             "alternatives of multiprocessing.Pool. Default: multiprocessing")
+    parser.add_argument('--pool-size', type=int, help="Number of workers. Default: number of CPUs")
+    parser.add_argument('--start-method', choices=('fork', 'forkserver', 'spawn'),
+                        help="Start method of the worker processes. Default: the platform default")
+    parser.add_argument('--max-tasks-per-child', type=int,
+                        help="Worker processes of the multiprocessing pool are replaced after this many tasks. "
+                             "Default: never")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of server processes sharing the port with SO_REUSEPORT, each one has "
+                             "its own pool. Default: 1")
+    parser.add_argument('--drain-timeout', type=float, default=10.0,
+                        help="Seconds to wait for the open connections on shutdown. Default: 10")
+    parser.add_argument('--max-in-flight', type=int, default=10000,
+                        help="Maximum expressions calculated at once, 0 is unlimited. Default: 10000")
+    parser.add_argument('--max-connection-in-flight', type=int, default=1000,
+                        help="Maximum expressions of a connection calculated at once, 0 is unlimited. Default: 1000")
+    parser.add_argument('--overload-policy', choices=('pause', 'reject'), default='pause',
+                        help="Over the limits stop reading from the connection (pause) "
+                             "or reply with a busy error (reject). Default: pause")
+    parser.add_argument('--timeout', type=float, default=10.0,
+                        help="Expressions running longer in the pool are interrupted, 0 disables it. Default: 10")
+    parser.add_argument('--metrics-port', type=int,
+                        help="Serve the metrics in the Prometheus text format over HTTP on this port, "
+                             "each worker has its own metrics on the next ports (port + worker index). "
+                             "Default: disabled")
+    parser.add_argument('--binary-port', type=int,
+                        help="Serve the binary protocol (length prefixed frames with request ids) on this port. "
+                             "Default: disabled")
+    parser.add_argument('--profile', metavar='FILE',
+                        help="Sample the stacks of the loop and write them to FILE in the collapsed stack format "
+                             "of flamegraph.pl on exit, {pid} is replaced by the process id. Default: disabled")
+    parser.add_argument('--profile-rate', type=int, default=100, help="Profiler samples per second. Default: 100")
+    parser.add_argument('--allow-profile', action='store_true',
+                        help="Let the clients start and stop the profiler with 'profile start' and 'profile stop', "
+                             "it's always allowed with --profile. Default: disabled")
+    parser.add_argument('--slow-threshold', type=float, default=0.0,
+                        help="Log the calculations slower than this (in seconds) with the split of their time, "
+                             "0 disables it. Default: 0")
+    parser.add_argument('--arithmetic', default='float', type=str,
+                        help="Numbers of the expressions: float (ints and floats), fraction (exact rationals), "
+                             "decimal (28 digits) or decimal(<digits>). Clients can change it. Default: float")
+    parser.add_argument('--result-cache-size', type=int, default=0,
+                        help="Slots of the result cache shared by the server processes, 0 disables it. Default: 0")
+    parser.add_argument('--result-cache-file',
+                        help="File of the result cache, so the results survive a restart. "
+                             "Default: anonymous shared memory")
     args = parser.parse_args()
 
     if args.verbose:
         logging.getLogger().setLevel(logging.DEBUG)
 
-    run_server(args.host, args.port)
+    try:
+        get_arithmetic(args.arithmetic)
+    except SyntaxError as e:
+        parser.error(str(e))
+
+    expression_cache.maxsize = args.cache_size
+    results = None
+
+    if args.result_cache_size:
+        # Created before the workers are forked, so they share it
+        results = ResultCache(args.result_cache_size, args.result_cache_file)
+
+    run = partial(
+        run_server, args.host, args.port, args.backend, args.batch_size, args.inline_threshold,
+        args.read_size, args.max_line_length, args.write_buffer_size, args.pool_backend,
+        args.pool_size, args.start_method, args.max_tasks_per_child,
+        reuse_port=args.workers > 1, handle_signals=True, drain_timeout=args.drain_timeout,
+        max_in_flight=args.max_in_flight, max_connection_in_flight=args.max_connection_in_flight,
+        overload_policy=args.overload_policy, timeout=args.timeout, metrics_port=args.metrics_port,
+        profile=args.profile, profile_rate=args.profile_rate, slow_threshold=args.slow_threshold,
+        binary_port=args.binary_port, results=results, arithmetic=args.arithmetic, allow_profile=args.allow_profile
+    )
+
+    def run_worker(index: int) -> None:
+        # Every worker has its own metrics, so each one is scraped on its own port
+        run(metrics_port=args.metrics_port + index if args.metrics_port else None)
+
+    if args.workers > 1:
+        Supervisor(run_worker, args.workers, args.drain_timeout).run()
+    else:
+        run()
 
 
 if __name__ == "__main__":
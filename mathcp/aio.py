@@ -0,0 +1,273 @@
+import asyncio
+import logging
+import weakref
+from concurrent.futures import Executor, ProcessPoolExecutor
+from functools import partial
+from typing import Iterable
+
+from mathcp.loop import Loop, Tickable
+from mathcp.parallel import BasePool, Scheduler
+from mathcp.server import BaseSocket, Connection, SocketCallback, create_framer, read_bytes, write_bytes
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncLoop(Loop):
+    """
+    This is a Loop implementation which runs on top of an asyncio event loop.
+
+    Sockets and pool results are driven by asyncio itself, so the loop mostly keeps
+    track of the tickables. Tickables which implement tick() are still ticked
+    every `sleep` seconds so the Tickable API keeps working.
+    """
+
+    def __init__(self, *args, loop: asyncio.AbstractEventLoop = None, sleep=0.01):
+        self._asyncio_loop = loop or asyncio.new_event_loop()
+        self._sleep = sleep
+        self._polled = {}
+        self._handle = None
+        super().__init__(*args)
+
+    @property
+    def asyncio_loop(self) -> asyncio.AbstractEventLoop:
+        return self._asyncio_loop
+
+    def add(self, tickable: Tickable) -> None:
+        super().add(tickable)
+
+        if type(tickable).tick is not Tickable.tick:
+            self._polled[tickable] = None
+
+            if not self._handle:
+                self._handle = self._asyncio_loop.call_soon(self._tick)
+
+    def remove(self, tickable: Tickable) -> None:
+        super().remove(tickable)
+
+        self._polled.pop(tickable, None)
+
+    def call_soon(self, callback: callable) -> None:
+        self._asyncio_loop.call_soon(callback)
+
+    def _tick(self) -> None:
+        for tickable in tuple(self._polled):
+            if tickable.loop is self:
+                tickable.tick()
+
+        self._handle = self._asyncio_loop.call_later(self._sleep, self._tick) if self._polled else None
+
+    def stop(self) -> None:
+        self._asyncio_loop.stop()
+
+    def run(self, loops=0, sleep=0.01) -> None:
+        """
+        Runs the asyncio loop until it's stopped, use this only when the asyncio loop is not already running
+        """
+        self._asyncio_loop.run_forever()
+
+
+class AsyncSocket(BaseSocket, asyncio.BufferedProtocol):
+    """
+    This is an asyncio Protocol implementation of the Socket, it creates a new connection
+    object when the transport is ready and feeds it with the received messages.
+
+    As a buffered protocol the transport receives the data straight into the buffer of the line framer.
+    Reading is paused while the transport write buffer is above the high watermark.
+    """
+
+    def __init__(self, server: 'AsyncServer'):
+        super().__init__()
+        self._server = server
+        self._transport = None
+        self._callback = None
+        self._encoding = None
+        self._framer = None
+        self._max_line_length = None
+        self._write_buffer = []
+        self._writing_paused = False
+        self._reading_paused = False
+
+    def attach(self, callback: SocketCallback, separator: str, encoding: str, read_size=65536,
+               max_line_length=65536, high_watermark=65536, low_watermark=16384) -> 'AsyncSocket':
+        """
+        Called by the Connection to receive the socket events
+        """
+        self._callback = callback
+        self._encoding = encoding
+        self._framer = create_framer(separator, encoding, read_size)
+        self._max_line_length = max_line_length
+        self._transport.set_write_buffer_limits(high_watermark, low_watermark)
+        return self
+
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        self._transport = transport
+        self._server.on_connection(self)
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        return self._framer.get_buffer()
+
+    def buffer_updated(self, nbytes: int) -> None:
+        read_bytes.observe(nbytes)
+        self._deliver(self._framer.feed(nbytes))
+
+    def pause_writing(self) -> None:
+        # The client doesn't read its replies, stop reading its messages until it does
+        self._writing_paused = True
+        self._transport.pause_reading()
+
+    def resume_writing(self) -> None:
+        self._writing_paused = False
+
+        if not self._reading_paused:
+            self._transport.resume_reading()
+
+    def pause_reading(self) -> None:
+        self._reading_paused = True
+        self._transport.pause_reading()
+
+    def resume_reading(self) -> None:
+        self._reading_paused = False
+
+        if not self._writing_paused:
+            self._transport.resume_reading()
+
+    def connection_lost(self, exc: Exception) -> None:
+        if self._loop:
+            self._callback.on_disconnect()
+
+    def print(self, message: str, end="\r\n") -> None:
+        """
+        Writes a string to the socket
+        """
+        if not self._loop:
+            # Connection is already closed
+            return
+
+        try:
+            data = ("%s%s" % (message, end)).encode(self._encoding)
+        except Exception as e:
+            self._callback.on_error(e)
+            return
+
+        self.write(data)
+
+    def write(self, data: bytes) -> None:
+        """
+        Writes bytes to the socket
+        """
+        if not self._loop:
+            return
+
+        if not self._write_buffer:
+            # Messages sent in the same asyncio loop iteration are written at once
+            self._loop.asyncio_loop.call_soon(self._write)
+
+        self._write_buffer.append(data)
+
+    def close(self) -> None:
+        """
+        Disconnects once the queued messages are sent, the transport flushes its buffer on close
+        """
+        if self._loop:
+            self._write()
+            self._callback.on_disconnect()
+
+    def _write(self) -> None:
+        if not self._write_buffer:
+            return
+
+        data = b''.join(self._write_buffer)
+        write_bytes.observe(len(data))
+        self._transport.write(data)
+        self._write_buffer.clear()
+
+    def destroy(self) -> None:
+        super().destroy()
+        self._transport.close()
+
+
+class AsyncServer(Tickable):
+    """
+    This is an asyncio version of the Server, it accepts the same connection classes and dependencies.
+
+    Use listen() when the asyncio loop is not running yet, or await start() from a coroutine
+    when mathcp is embedded in an existing asyncio application.
+    """
+
+    def __init__(self, host: str, port: int, connection_class: Connection, reuse_port=False, **kwargs):
+        super().__init__()
+        self._host = host
+        self._port = port
+
+        if not issubclass(connection_class, Connection):
+            raise TypeError("Your class should subclass Connection class")
+
+        self._connection_class = connection_class
+        self._server = None
+        self._reuse_port = reuse_port
+        self._dependencies = kwargs
+        self._connections = weakref.WeakSet()
+
+    @property
+    def connection_count(self) -> int:
+        """
+        Number of connections which are still open or wait for results
+        """
+        return len(self._connections)
+
+    async def start(self) -> None:
+        self._server = await self.loop.asyncio_loop.create_server(
+            partial(AsyncSocket, self), self._host, self._port,
+            reuse_address=True, reuse_port=self._reuse_port or None
+        )
+        logger.info("Listening on %s:%s", self._host, self._port)
+
+    def listen(self) -> None:
+        self.loop.asyncio_loop.run_until_complete(self.start())
+
+    def on_connection(self, socket: AsyncSocket) -> None:
+        if logger.isEnabledFor(logging.INFO):
+            host, port, *_ = socket._transport.get_extra_info('peername')
+            logger.info("New connection from %s:%s", host, port)
+
+        connection = self._connection_class(socket, **self._dependencies)
+        self._connections.add(connection)
+        self.loop.add(connection)
+        connection.on_connected()
+
+    def destroy(self) -> None:
+        super().destroy()
+
+        if self._server:
+            self._server.close()
+
+
+class AsyncPool(BasePool):
+    """
+    This is the asyncio version of the Pool, tasks are executed with run_in_executor
+    and callbacks are called when the future is done.
+    """
+
+    def __init__(self, executor: Executor = None, batch_size=128, scheduler: Scheduler = None):
+        super().__init__(batch_size, scheduler)
+        self._executor = executor or ProcessPoolExecutor()
+
+    def _submit(self, func: callable, args: Iterable, on_success: callable, on_error: callable) -> None:
+        future = self.loop.asyncio_loop.run_in_executor(self._executor, func, *args)
+        future.add_done_callback(partial(self._on_done, on_success, on_error))
+
+    @staticmethod
+    def _on_done(on_success: callable, on_error: callable, future: asyncio.Future) -> None:
+        if future.cancelled():
+            return
+
+        error = future.exception()
+
+        if error:
+            on_error(error)
+        else:
+            on_success(future.result())
+
+    def destroy(self) -> None:
+        super().destroy()
+        self._executor.shutdown(wait=False)
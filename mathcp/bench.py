@@ -0,0 +1,661 @@
+"""
+Load generator and micro-benchmarks of the math server.
+
+python -m mathcp.bench load [host] [port] - opens concurrent connections to a running server
+(or starts one with --server), pipelines a mix of expressions and reports the throughput
+and the latency percentiles.
+
+python -m mathcp.bench micro - measures each layer on its own: prepare_input, shunting_yard,
+rpn_execute, Socket.tick and a whole message handled by MathSolver with logging off and at DEBUG.
+
+python -m mathcp.bench memory - measures the memory of an idle connection with tracemalloc.
+
+python -m mathcp.bench cache - compares the hit rates of the result cache keyed by the tokens of the expressions
+and by their canonical form.
+
+python -m mathcp.bench arithmetic - measures the throughput of the workers with each arithmetic.
+
+python -m mathcp.bench vector - compares the scalar and the NumPy engines on programs of the same shape.
+
+python -m mathcp.bench startup - measures the startup time of the pool configurations, cold and warmed up.
+
+All of them write their results as JSON with --json so runs can be compared.
+"""
+import argparse
+import io
+import json
+import logging
+import multiprocessing
+import random
+import selectors
+import socket
+import sys
+import time
+import timeit
+import tracemalloc
+from collections import deque
+
+from mathcp.loop import Loop, SelectorLoop
+from mathcp.math import (
+    ExpressionCache, compile, execute_many, execute_vectorized, get_arithmetic, numpy, prepare_input, validate_input,
+    shunting_yard, rpn_compile, rpn_execute, warm_up
+)
+from mathcp.parallel import ExecutorPool, Pool, Scheduler, create_executor
+from mathcp.server import Socket, SocketCallback
+
+
+def short_expression(rng: random.Random) -> str:
+    return '%d + %d' % (rng.randint(1, 1000), rng.randint(1, 1000))
+
+
+def deep_expression(rng: random.Random, depth=20) -> str:
+    expression = str(rng.randint(1, 9))
+
+    for _ in range(depth):
+        expression = '(%s %s %d)' % (expression, rng.choice('+-*'), rng.randint(1, 9))
+
+    return expression
+
+
+def long_expression(rng: random.Random, terms=200) -> str:
+    return ' '.join('%d %s' % (rng.randint(1, 1000), rng.choice('+-*/')) for _ in range(terms)) + ' 1'
+
+
+def repeated_expression(rng: random.Random) -> str:
+    return '((1 + 3) / 3.14) * 4 - 5.1'
+
+
+def variant_expression(rng: random.Random) -> str:
+    # The same few expressions with other whitespace, parentheses and order of the operands
+    a, b, c = rng.randint(1, 5), rng.randint(1, 5), rng.randint(1, 5)
+    return rng.choice((
+        '(%d+%d)*%d' % (a, b, c),
+        '%d * ( %d + %d )' % (c, b, a),
+        '((%d + %d)) * %d' % (b, a, c),
+        '%d * %d + %d / 2' % (a, b, c),
+        '%d / 2 + (%d * %d)' % (c, b, a),
+    ))
+
+
+mixes = {
+    'short': short_expression,
+    'deep': deep_expression,
+    'long': long_expression,
+    'repeated': repeated_expression,
+    'variants': variant_expression,
+}
+
+
+def percentile(values: list, q: float) -> float:
+    """
+    Returns the q (0..1) percentile of the sorted values
+    """
+    if not values:
+        return 0.0
+
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class Client(object):
+    """
+    A connection of the load generator, keeps up to `pipeline` expressions in flight
+    and measures the time of each reply (replies come in the order of the expressions).
+    """
+
+    def __init__(self, address: tuple, expressions: list, pipeline: int):
+        self.socket = socket.create_connection(address)
+        self.socket.setblocking(False)
+        self.latencies = []
+        self.errors = 0
+        self._expressions = deque(expressions)
+        self._pipeline = pipeline
+        self._sent = deque()
+        self._buffer = b''
+        # The welcome message is between two lines of '='
+        self._banner = 2
+
+    @property
+    def done(self) -> bool:
+        return not self._expressions and not self._sent
+
+    def write(self) -> None:
+        if self._banner:
+            return
+
+        lines = []
+
+        while self._expressions and len(self._sent) + len(lines) < self._pipeline:
+            lines.append(self._expressions.popleft())
+
+        if lines:
+            now = time.perf_counter()
+            self._sent.extend(now for _ in lines)
+            self.socket.sendall(''.join('%s\n' % line for line in lines).encode())
+
+    def read(self) -> None:
+        data = self.socket.recv(65536)
+
+        if not data:
+            raise ConnectionError("Connection closed by the server")
+
+        *lines, self._buffer = (self._buffer + data).split(b'\r\n')
+        now = time.perf_counter()
+
+        for line in lines:
+            if self._banner:
+                self._banner -= line.startswith(b'=')
+                continue
+
+            self.latencies.append(now - self._sent.popleft())
+
+            if line.startswith(b'Error'):
+                self.errors += 1
+
+    def close(self) -> None:
+        self.socket.close()
+
+
+def load(host: str, port: int, connections=10, requests=1000, pipeline=16, mix=('short',), seed=0) -> dict:
+    """
+    Runs the load test and returns the results
+    """
+    rng = random.Random(seed)
+    generators = [mixes[name] for name in mix]
+    selector = selectors.DefaultSelector()
+    clients = []
+
+    for _ in range(connections):
+        expressions = [rng.choice(generators)(rng) for _ in range(requests)]
+        client = Client((host, port), expressions, pipeline)
+        selector.register(client.socket, selectors.EVENT_READ, client)
+        clients.append(client)
+
+    start = time.perf_counter()
+    pending = len(clients)
+
+    while pending:
+        for key, _ in selector.select(10):
+            client = key.data
+            client.read()
+            client.write()
+
+            if client.done:
+                selector.unregister(client.socket)
+                pending -= 1
+
+    elapsed = time.perf_counter() - start
+    latencies = sorted(latency for client in clients for latency in client.latencies)
+
+    for client in clients:
+        client.close()
+
+    return {
+        'connections': connections,
+        'requests': len(latencies),
+        'pipeline': pipeline,
+        'mix': list(mix),
+        'errors': sum(client.errors for client in clients),
+        'seconds': elapsed,
+        'throughput': len(latencies) / elapsed if elapsed else 0.0,
+        'latency_ms': {
+            'p50': percentile(latencies, 0.5) * 1000,
+            'p99': percentile(latencies, 0.99) * 1000,
+            'p999': percentile(latencies, 0.999) * 1000,
+            'max': (latencies[-1] if latencies else 0.0) * 1000,
+        },
+    }
+
+
+def start_server(host: str, port: int, backend: str) -> multiprocessing.Process:
+    """
+    Starts the server in a child process so it doesn't share the GIL with the load generator
+    """
+    from mathcp.__main__ import run_server
+
+    # Not a daemon, the server has its own pool of processes, terminate() makes it drain and exit
+    process = multiprocessing.Process(
+        target=run_server, args=(host, port, backend), kwargs={'handle_signals': True, 'drain_timeout': 1}
+    )
+    process.start()
+    deadline = time.monotonic() + 10
+
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port)).close()
+            return process
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+
+    process.terminate()
+    raise RuntimeError("The server didn't start")
+
+
+def micro(number=10000) -> dict:
+    """
+    Measures each layer on its own, returns microseconds per operation
+    """
+    expression = '((15 / (7 - (1 + 1))) * 3) - (2 + (1 + 1)) * 4.5 / 3'
+    tokens = validate_input(prepare_input(expression))
+    rpn = shunting_yard(tokens)
+
+    results = {
+        'prepare_input': min(timeit.repeat(lambda: prepare_input(expression), number=number, repeat=5)),
+        'shunting_yard': min(timeit.repeat(lambda: shunting_yard(tokens), number=number, repeat=5)),
+        'rpn_execute': min(timeit.repeat(lambda: rpn_execute(rpn), number=number, repeat=5)),
+        'socket_tick': socket_tick(number) * number,
+        'message': message_cost(number) * number,
+        'message_debug': message_cost(number, logging.DEBUG) * number,
+    }
+
+    return {name: seconds / number * 1000000 for name, seconds in results.items()}
+
+
+def socket_tick(number: int, lines=100) -> float:
+    """
+    Seconds per line received and replied by a Socket, the client side is not included
+    """
+    server, client = socket.socketpair()
+    server.setblocking(False)
+    messages = []
+    tickable = Socket(server, SocketCallback(messages.append, print, print), '\n', 'utf8')
+    Loop(tickable)
+    data = b'1 + 1\n' * lines
+    elapsed = 0.0
+
+    try:
+        for _ in range(max(number // lines, 1)):
+            client.sendall(data)
+            messages.clear()
+            start = time.perf_counter()
+
+            while len(messages) < lines:
+                tickable.tick()
+
+            for message in messages:
+                tickable.print(message)
+
+            tickable.tick()
+            elapsed += time.perf_counter() - start
+
+            received = 0
+
+            while received < len(data) + lines:
+                received += len(client.recv(65536))
+    finally:
+        tickable.destroy()
+        client.close()
+
+    return elapsed / (max(number // lines, 1) * lines)
+
+
+def message_cost(number: int, level=logging.WARNING, lines=100) -> float:
+    """
+    Seconds per expression received, calculated inline and replied by MathSolver,
+    with the mathcp loggers at the given level (writing to memory)
+    """
+    from mathcp.__main__ import MathSolver, create_pool
+
+    server, client = socket.socketpair()
+    server.setblocking(False)
+    client.setblocking(False)
+    pool = create_pool(pool_backend='thread', pool_size=1, inline_threshold=1.0)
+    solver = MathSolver(server, pool)
+    loop = Loop(pool)
+    loop.add(solver)
+    solver.on_connected()
+
+    mathcp_logger = logging.getLogger('mathcp')
+    handler = logging.StreamHandler(io.StringIO())
+    previous = mathcp_logger.level, mathcp_logger.propagate
+    mathcp_logger.addHandler(handler)
+    mathcp_logger.setLevel(level)
+    mathcp_logger.propagate = False
+
+    data = b'1 + 2\n' * lines
+    rounds = max(number // lines, 1)
+    elapsed = 0.0
+
+    try:
+        loop.run(1, sleep=0)
+        client.recv(65536)
+
+        for _ in range(rounds):
+            client.sendall(data)
+            replies = 0
+            start = time.perf_counter()
+
+            while replies < lines:
+                loop.run(1, sleep=0)
+
+                try:
+                    replies += client.recv(65536).count(b'\n')
+                except BlockingIOError:
+                    pass
+
+            elapsed += time.perf_counter() - start
+    finally:
+        mathcp_logger.removeHandler(handler)
+        mathcp_logger.setLevel(previous[0])
+        mathcp_logger.propagate = previous[1]
+        solver.on_disconnect()
+        pool.destroy()
+        client.close()
+
+    return elapsed / (rounds * lines)
+
+
+def cache_hit_rate(requests=10000, mix=('variants',), seed=0) -> dict:
+    """
+    Hit rates of a result cache big enough for all the expressions, keyed by the tokens of the expressions
+    (the old key) and by their canonical form
+    """
+    rng = random.Random(seed)
+    generators = [mixes[name] for name in mix]
+    expressions = [rng.choice(generators)(rng) for _ in range(requests)]
+    cache = ExpressionCache(maxsize=requests)
+    token_keys, canonical_keys = set(), set()
+    token_hits = canonical_hits = 0
+
+    for expression in expressions:
+        key = ' '.join([token.text for token in prepare_input(expression)])
+        token_hits += key in token_keys
+        token_keys.add(key)
+
+        key = compile(expression, cache).key
+        canonical_hits += key in canonical_keys
+        canonical_keys.add(key)
+
+    return {
+        'requests': requests,
+        'mix': list(mix),
+        'token_key_hit_rate': token_hits / requests,
+        'canonical_key_hit_rate': canonical_hits / requests,
+        'token_keys': len(token_keys),
+        'canonical_keys': len(canonical_keys),
+    }
+
+
+def arithmetic_throughput(requests=2000, mix=('short', 'deep', 'long'), arithmetics=('float', 'fraction', 'decimal'),
+                          batch_size=128, seed=0) -> dict:
+    """
+    Expressions per second executed in batches like in a worker of the pool, for each arithmetic.
+    The programs are not canonicalized, folding would leave nothing to execute of the float ones.
+    """
+    rng = random.Random(seed)
+    generators = [mixes[name] for name in mix]
+    expressions = [rng.choice(generators)(rng) for _ in range(requests)]
+    results = {}
+
+    for name in arithmetics:
+        arithmetic = get_arithmetic(name)
+        programs = [
+            rpn_compile(shunting_yard(prepare_input(expression)), expression, arithmetic) for expression in expressions
+        ]
+        start = time.perf_counter()
+
+        for i in range(0, len(programs), batch_size):
+            execute_many(programs[i:i + batch_size])
+
+        results[name] = requests / (time.perf_counter() - start)
+
+    return results
+
+
+vector_formulas = (
+    '(%d + %d) * %d - %d',
+    '(%d + %d) * %d - %d / 7',
+    '((%d * 1.07 + %d) * (%d - 3.5) + %d / 12) * 0.98',
+)
+
+
+def vectorized(count=10000, seed=0) -> dict:
+    """
+    Microseconds per expression of the scalar and the NumPy engines for programs of the same shape,
+    for each formula of vector_formulas
+    """
+    rng = random.Random(seed)
+    results = {}
+
+    for formula in vector_formulas:
+        # Not canonicalized, compile() would fold the constant programs to a number
+        expressions = [formula % tuple(rng.randint(1, 1000) for _ in range(4)) for _ in range(count)]
+        programs = [rpn_compile(shunting_yard(prepare_input(expression))) for expression in expressions]
+        results[formula] = {}
+
+        for name, min_group in (('scalar', count + 1), ('vector', 1)):
+            timer = timeit.Timer(lambda: execute_vectorized(programs, min_group))
+            results[formula][name] = min(timer.repeat(5, 1)) / count * 1000000
+
+    return results
+
+
+pool_configurations = {
+    'multiprocessing fork': lambda workers, initializer: Pool(
+        scheduler=Scheduler(0), processes=workers, start_method='fork', initializer=initializer
+    ),
+    'multiprocessing forkserver': lambda workers, initializer: Pool(
+        scheduler=Scheduler(0), processes=workers, start_method='forkserver', initializer=initializer
+    ),
+    'multiprocessing spawn': lambda workers, initializer: Pool(
+        scheduler=Scheduler(0), processes=workers, start_method='spawn', initializer=initializer
+    ),
+    'process executor spawn': lambda workers, initializer: ExecutorPool(
+        create_executor('process', workers, 'spawn', initializer), scheduler=Scheduler(0)
+    ),
+    'thread executor': lambda workers, initializer: ExecutorPool(
+        create_executor('thread', workers, initializer=initializer), scheduler=Scheduler(0)
+    ),
+}
+
+
+def pool_startup(workers: int = None, configurations=tuple(pool_configurations)) -> dict:
+    """
+    Milliseconds from the creation of the pool until a job executed on every worker returns,
+    for each configuration with cold workers and with workers warmed up by warm_up
+    """
+    workers = workers or multiprocessing.cpu_count()
+    results = {}
+
+    for name in configurations:
+        for initializer in (None, warm_up):
+            key = '%s %s' % (name, 'warm' if initializer else 'cold')
+            results[key] = _startup(pool_configurations[name], workers, initializer) * 1000
+
+    return results
+
+
+def _startup(factory: callable, workers: int, initializer: callable) -> float:
+    start = time.perf_counter()
+    pool = factory(workers, initializer)
+    loop = SelectorLoop(pool)
+    pending = [workers]
+
+    def on_result(result):
+        pending[0] -= 1
+
+    try:
+        for _ in range(workers):
+            pool.add(execute_many, ([compile('(1 + 2) * 3')],), on_result, on_result)
+
+        while pending[0]:
+            loop.run(1)
+
+        return time.perf_counter() - start
+    finally:
+        pool.destroy()
+
+
+def connection_memory(connections=200) -> float:
+    """
+    Bytes of Python memory per idle MathSolver connection which has sent its welcome message,
+    the memory of the kernel socket buffers is not included
+    """
+    from mathcp.__main__ import MathSolver, create_pool
+    from mathcp.server import Admission
+
+    pool = create_pool(pool_backend='thread', pool_size=1)
+    admission = Admission()
+    loop = Loop(pool)
+    pairs = [socket.socketpair() for _ in range(connections)]
+    solvers = []
+
+    for server, _ in pairs:
+        server.setblocking(False)
+
+    tracing = tracemalloc.is_tracing()
+
+    if not tracing:
+        tracemalloc.start()
+
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+
+        for server, _ in pairs:
+            solver = MathSolver(server, pool, admission)
+            loop.add(solver)
+            solver.on_connected()
+            solvers.append(solver)
+
+        # Sends the welcome messages
+        loop.run(1, sleep=0)
+        return (tracemalloc.get_traced_memory()[0] - before) / connections
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+
+        for solver in solvers:
+            solver.on_disconnect()
+
+        for _, client in pairs:
+            client.close()
+
+        pool.destroy()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Math TCP Server benchmarks')
+    output = argparse.ArgumentParser(add_help=False)
+    output.add_argument('--json', help="Write the results to this file ('-' for stdout)")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    load_parser = commands.add_parser('load', help="Load test a server", parents=[output])
+    load_parser.add_argument("host", type=str, nargs="?", default='127.0.0.1', help="Default: 127.0.0.1")
+    load_parser.add_argument("port", type=int, nargs="?", default=8000, help="Default: 8000")
+    load_parser.add_argument('--server', action='store_true', help="Start the server on host:port")
+    load_parser.add_argument('--backend', choices=('select', 'poll', 'asyncio'), default='select',
+                             help="Backend of the started server. Default: select")
+    load_parser.add_argument('-c', '--connections', type=int, default=10, help="Default: 10")
+    load_parser.add_argument('-n', '--requests', type=int, default=1000, help="Requests per connection. Default: 1000")
+    load_parser.add_argument('-p', '--pipeline', type=int, default=16,
+                             help="Requests in flight per connection. Default: 16")
+    load_parser.add_argument('-m', '--mix', default='short', help="Comma separated expression kinds: %s. "
+                                                                  "Default: short" % ', '.join(mixes))
+
+    micro_parser = commands.add_parser('micro', help="Micro-benchmarks of each layer", parents=[output])
+    micro_parser.add_argument('-n', '--number', type=int, default=10000, help="Operations. Default: 10000")
+
+    memory_parser = commands.add_parser('memory', help="Memory of an idle connection", parents=[output])
+    memory_parser.add_argument('-c', '--connections', type=int, default=1000, help="Default: 1000")
+
+    cache_parser = commands.add_parser('cache', help="Hit rates of the result cache keys", parents=[output])
+    cache_parser.add_argument('-n', '--requests', type=int, default=10000, help="Default: 10000")
+    cache_parser.add_argument('-m', '--mix', default='variants', help="Comma separated expression kinds: %s. "
+                                                                      "Default: variants" % ', '.join(mixes))
+
+    arithmetic_parser = commands.add_parser('arithmetic', help="Throughput of each arithmetic", parents=[output])
+    arithmetic_parser.add_argument('-n', '--requests', type=int, default=2000, help="Default: 2000")
+    arithmetic_parser.add_argument('-m', '--mix', default='short,deep,long',
+                                   help="Comma separated expression kinds: %s. "
+                                        "Default: short,deep,long" % ', '.join(mixes))
+    arithmetic_parser.add_argument('-a', '--arithmetics', default='float,fraction,decimal,decimal(100)',
+                                   help="Comma separated arithmetics. Default: float,fraction,decimal,decimal(100)")
+
+    vector_parser = commands.add_parser('vector', help="Scalar and NumPy engines", parents=[output])
+    vector_parser.add_argument('-n', '--programs', type=int, default=10000, help="Default: 10000")
+
+    startup_parser = commands.add_parser('startup', help="Startup time of the pools", parents=[output])
+    startup_parser.add_argument('-w', '--workers', type=int, help="Default: number of CPUs")
+    startup_parser.add_argument('--pools', default=','.join(pool_configurations),
+                                help="Comma separated configurations: %s. "
+                                     "Default: all" % ', '.join(pool_configurations))
+
+    args = parser.parse_args()
+    mix = args.mix.split(',') if args.command in ('load', 'cache', 'arithmetic') else []
+    unknown = set(mix) - set(mixes)
+
+    if unknown:
+        parser.error("Unknown expression kinds: %s" % ', '.join(sorted(unknown)))
+
+    if args.command == 'load':
+        server = start_server(args.host, args.port, args.backend) if args.server else None
+
+        try:
+            results = load(args.host, args.port, args.connections, args.requests, args.pipeline, mix)
+        finally:
+            if server:
+                server.terminate()
+                server.join()
+
+        print("%d requests in %.2f s: %.0f requests/s, %d errors" % (
+            results['requests'], results['seconds'], results['throughput'], results['errors']
+        ))
+        print(
+            "latency p50 %(p50).3f ms, p99 %(p99).3f ms, p999 %(p999).3f ms, max %(max).3f ms" % results['latency_ms']
+        )
+    elif args.command == 'cache':
+        results = cache_hit_rate(args.requests, mix)
+        print("hit rate %.1f%% with the token key (%d keys), %.1f%% with the canonical key (%d keys)" % (
+            results['token_key_hit_rate'] * 100, results['token_keys'],
+            results['canonical_key_hit_rate'] * 100, results['canonical_keys']
+        ))
+    elif args.command == 'arithmetic':
+        arithmetics = args.arithmetics.split(',')
+
+        try:
+            for name in arithmetics:
+                get_arithmetic(name)
+        except SyntaxError as e:
+            parser.error(str(e))
+
+        results = arithmetic_throughput(args.requests, mix, arithmetics)
+
+        for name, throughput in results.items():
+            print("%-16s %.0f expressions/s" % (name, throughput))
+    elif args.command == 'vector':
+        if numpy is None:
+            parser.error("NumPy is not installed")
+
+        results = vectorized(args.programs)
+
+        for formula, timings in results.items():
+            for name, microseconds in timings.items():
+                print("%-8s %-50s %.3f us/expression" % (name, formula, microseconds))
+    elif args.command == 'startup':
+        configurations = args.pools.split(',')
+        unknown = set(configurations) - set(pool_configurations)
+
+        if unknown:
+            parser.error("Unknown pools: %s" % ', '.join(sorted(unknown)))
+
+        results = pool_startup(args.workers, configurations)
+
+        for name, milliseconds in results.items():
+            print("%-36s %.1f ms" % (name, milliseconds))
+    elif args.command == 'memory':
+        results = {'connection_bytes': connection_memory(args.connections)}
+        print("%.0f bytes per idle connection" % results['connection_bytes'])
+    else:
+        results = micro(args.number)
+
+        for name, microseconds in results.items():
+            print("%-16s %.3f us" % (name, microseconds))
+
+    if args.json == '-':
+        json.dump(results, sys.stdout, indent=2)
+    elif args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
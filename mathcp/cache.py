@@ -0,0 +1,151 @@
+import mmap
+import os
+import struct
+from hashlib import blake2b
+from zlib import crc32
+
+from mathcp.protocol import INT64_MAX, INT64_MIN
+
+MAGIC = b'MATHCP01'
+HEADER = struct.Struct('=8sII')
+
+# check (crc32 of the entry), reference bit, entry (type, key, value)
+SLOT = struct.Struct('=IB25s2x')
+ENTRY = struct.Struct('=B16s8s')
+FLOAT = struct.Struct('=d')
+INT = struct.Struct('=q')
+
+TYPE_FLOAT = 1
+TYPE_INT = 2
+
+# Offsets in a slot
+REFERENCE_OFFSET = 4
+KEY_OFFSET = 6
+KEY_SIZE = 16
+
+
+class ResultCache(object):
+    """
+    Results of the expressions in a hash table of fixed size slots in shared memory, so the server
+    processes and the workers forked after it's created use the same results. With a path the table
+    is a file which keeps the results across restarts, otherwise it's an anonymous shared mapping.
+
+    Keys are blake2b digests of the normalized expressions, a key belongs to a bucket of `ways` slots
+    which are evicted with the clock algorithm: a hit sets the reference bit of its slot, the hand of the
+    bucket clears the bits it passes and replaces the first slot without one.
+
+    Reads don't take a lock, every slot has a crc32 of its entry so a slot which is being written
+    by another process at the same time is a miss. Only floats and integers which fit an int64 are cached.
+    """
+
+    def __init__(self, slots=65536, path: str = None, ways=8):
+        self.ways = ways
+        self.buckets = max(1, slots // ways)
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._hands = HEADER.size
+        self._slots = self._hands + self.buckets
+        size = self._slots + self.buckets * ways * SLOT.size
+
+        if path is None:
+            self._map = mmap.mmap(-1, size)
+        else:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+
+            try:
+                if os.fstat(fd).st_size != size:
+                    os.ftruncate(fd, 0)
+                    os.ftruncate(fd, size)
+
+                self._map = mmap.mmap(fd, size)
+            finally:
+                os.close(fd)
+
+        if HEADER.unpack_from(self._map) != (MAGIC, self.buckets, ways):
+            # A new table or one with another layout
+            self._map[:] = bytes(size)
+            HEADER.pack_into(self._map, 0, MAGIC, self.buckets, ways)
+
+    def get(self, key: str):
+        """
+        Returns the cached result of the expression, None when it's not cached
+        """
+        digest = blake2b(key.encode(), digest_size=KEY_SIZE).digest()
+        memory = self._map
+        offset = self._bucket(digest)
+
+        for offset in range(offset, offset + self.ways * SLOT.size, SLOT.size):
+            if memory[offset + KEY_OFFSET:offset + KEY_OFFSET + KEY_SIZE] != digest:
+                continue
+
+            # A single read of the slot, the key check above may be stale by now
+            check, reference, entry = SLOT.unpack_from(memory, offset)
+
+            if crc32(entry) != check:
+                # Torn by a concurrent write
+                break
+
+            kind, entry_key, value = ENTRY.unpack(entry)
+
+            if entry_key != digest:
+                # Replaced by another expression since the key check
+                break
+
+            if not reference:
+                memory[offset + REFERENCE_OFFSET] = 1
+
+            self.hits += 1
+            return FLOAT.unpack(value)[0] if kind == TYPE_FLOAT else INT.unpack(value)[0]
+
+        self.misses += 1
+        return None
+
+    def put(self, key: str, result) -> None:
+        if result.__class__ is float:
+            entry = ENTRY.pack(TYPE_FLOAT, b'', FLOAT.pack(result))
+        elif result.__class__ is int and INT64_MIN <= result <= INT64_MAX:
+            entry = ENTRY.pack(TYPE_INT, b'', INT.pack(result))
+        else:
+            return
+
+        digest = blake2b(key.encode(), digest_size=KEY_SIZE).digest()
+        entry = entry[:1] + digest + entry[1 + KEY_SIZE:]
+        memory = self._map
+        start = self._bucket(digest)
+        ways = self.ways
+
+        for offset in range(start, start + ways * SLOT.size, SLOT.size):
+            if memory[offset + KEY_OFFSET:offset + KEY_OFFSET + KEY_SIZE] == digest:
+                memory[offset:offset + SLOT.size] = SLOT.pack(crc32(entry), 1, entry)
+                return
+
+        hand_offset = self._hands + (start - self._slots) // (ways * SLOT.size)
+        hand = memory[hand_offset] % ways
+
+        # The second round finds a slot whose bit was cleared in the first one
+        for _ in range(ways * 2):
+            offset = start + hand * SLOT.size
+            hand = (hand + 1) % ways
+            check, reference, old = SLOT.unpack_from(memory, offset)
+
+            if reference and crc32(old) == check:
+                memory[offset + REFERENCE_OFFSET] = 0
+                continue
+
+            memory[offset:offset + SLOT.size] = SLOT.pack(crc32(entry), 0, entry)
+            break
+
+        memory[hand_offset] = hand
+
+    def clear(self) -> None:
+        self._map[self._hands:] = bytes(len(self._map) - self._hands)
+
+    def close(self) -> None:
+        self._map.close()
+
+    def _bucket(self, digest: bytes) -> int:
+        """
+        Offset of the first slot of the bucket of the key
+        """
+        return self._slots + int.from_bytes(digest[:8], 'little') % self.buckets * self.ways * SLOT.size
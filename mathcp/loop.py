@@ -1,5 +1,9 @@
+import selectors
 import time
 
+EVENT_READ = selectors.EVENT_READ
+EVENT_WRITE = selectors.EVENT_WRITE
+
 
 class Tickable(object):
     """
@@ -8,8 +12,17 @@ class Tickable(object):
     The destroy method should be used as destructor where you have to clean your instance,
     call to the super().destroy() is mandatory so the tickable object gets removed from the loop
     and garbage collected.
+
+    Tickables which own a file descriptor can return it from fileno() together with
+    the events they are interested in from interest(), a SelectorLoop will then call
+    on_ready() only when the descriptor is ready instead of ticking them on every loop.
+
+    Tickables use __slots__ so the ones created for every connection stay small, sub-classes
+    which don't define __slots__ get a __dict__ as usual.
     """
 
+    __slots__ = ('_loop', '__weakref__')
+
     def __init__(self):
         self._loop = None
 
@@ -31,34 +44,175 @@ class Tickable(object):
     def tick(self) -> None:
         pass
 
+    def fileno(self) -> int:
+        """
+        File descriptor to be watched by the loop, None if there is nothing to watch
+        """
+        return None
+
+    def interest(self) -> int:
+        """
+        Mask of EVENT_READ and EVENT_WRITE the tickable wants to be notified for
+        """
+        return EVENT_READ
+
+    def on_ready(self, events: int) -> None:
+        """
+        Called by the SelectorLoop when the file descriptor is ready for the given events
+        """
+        self.tick()
+
+    def interest_changed(self) -> None:
+        """
+        Should be called when the result of interest() changes so the loop can update its watchers
+        """
+        if self._loop:
+            self._loop.modify(self)
+
 
 class Loop(object):
     """
     This is a simple loop implementation which holds a list of tickable objects.
     On each loop every tickable object tick method is called.
+
+    Tickables are kept in an insertion ordered dict, so adding and removing one is O(1).
+    Each loop ticks a snapshot of the tickables: the ones added by a tick are ticked from
+    the next loop and the ones removed by a tick are skipped.
     """
 
     def __init__(self, *args):
-        self._tickables = []
+        self._tickables = {}
+        self._callbacks = []
+        self._stopped = False
 
         for tickable in args:
             self.add(tickable)
 
+    def __len__(self) -> int:
+        return len(self._tickables)
+
     def add(self, tickable: Tickable) -> None:
         tickable.set_loop(self)
-        self._tickables.append(tickable)
+        self._tickables[tickable] = None
 
     def remove(self, tickable: Tickable) -> None:
-        self._tickables.remove(tickable)
+        del self._tickables[tickable]
+
+    def modify(self, tickable: Tickable) -> None:
+        """
+        Called when tickable interest has changed, every tickable is ticked anyway so nothing to do here
+        """
+        pass
+
+    def call_soon(self, callback: callable) -> None:
+        """
+        Schedules the callback to be called once at the end of the current loop
+        """
+        self._callbacks.append(callback)
+
+    def stop(self) -> None:
+        """
+        Stops the loop at the end of the current loop
+        """
+        self._stopped = True
+
+    def _run_callbacks(self) -> None:
+        callbacks, self._callbacks = self._callbacks, []
+
+        for callback in callbacks:
+            callback()
 
     def run(self, loops=0, sleep=0.01) -> None:
         i = 0
+        self._stopped = False
 
-        while not loops or i < loops:
-            for tickable in self._tickables:
-                tickable.tick()
+        while not self._stopped and (not loops or i < loops):
+            for tickable in tuple(self._tickables):
+                # It could be destroyed by a previous tickable in this loop
+                if tickable.loop is self:
+                    tickable.tick()
 
+            self._run_callbacks()
             time.sleep(sleep)
 
             if loops:
                 i += 1
+
+
+class SelectorLoop(Loop):
+    """
+    This is a readiness based loop built on top of the selectors module (epoll on Linux).
+
+    Tickables which have a file descriptor are registered in the selector and serviced
+    only when they are ready. Tickables without a file descriptor which implement tick()
+    are still ticked on every loop, while they exist the selector waits at most `sleep`
+    seconds, otherwise it blocks until some file descriptor is ready.
+    """
+
+    def __init__(self, *args, selector: selectors.BaseSelector = None):
+        self._selector = selector or selectors.DefaultSelector()
+        self._events = {}
+        self._polled = {}
+        super().__init__(*args)
+
+    def add(self, tickable: Tickable) -> None:
+        super().add(tickable)
+
+        if tickable.fileno() is not None:
+            self._events[tickable] = 0
+            self.modify(tickable)
+        elif type(tickable).tick is not Tickable.tick:
+            self._polled[tickable] = None
+
+    def remove(self, tickable: Tickable) -> None:
+        super().remove(tickable)
+
+        if tickable in self._events:
+            if self._events.pop(tickable):
+                self._selector.unregister(tickable)
+        else:
+            self._polled.pop(tickable, None)
+
+    def modify(self, tickable: Tickable) -> None:
+        if tickable not in self._events:
+            return
+
+        old, new = self._events[tickable], tickable.interest()
+
+        if old == new:
+            return
+
+        if not old:
+            self._selector.register(tickable, new, tickable)
+        elif not new:
+            self._selector.unregister(tickable)
+        else:
+            self._selector.modify(tickable, new, tickable)
+
+        self._events[tickable] = new
+
+    def run(self, loops=0, sleep=0.01) -> None:
+        i = 0
+        self._stopped = False
+
+        while not self._stopped and (not loops or i < loops):
+            if self._callbacks:
+                timeout = 0
+            else:
+                timeout = sleep if self._polled else None
+
+            for key, events in self._selector.select(timeout):
+                tickable = key.data
+
+                # It could be destroyed by a previous tickable in this loop
+                if tickable.loop is self:
+                    tickable.on_ready(events)
+
+            for tickable in tuple(self._polled):
+                if tickable.loop is self:
+                    tickable.tick()
+
+            self._run_callbacks()
+
+            if loops:
+                i += 1
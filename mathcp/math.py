@@ -1,54 +1,747 @@
+import decimal
+import fractions
 import logging
+import operator
+import signal
+import string
+import threading
+from collections import namedtuple, OrderedDict
+from zlib import crc32
 
-import re
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
+# Operators are functions from the operator module so compiled programs can be pickled
 operators = {
-    '+': {'exec': lambda a, b: a + b, 'precedence': 0},
-    '-': {'exec': lambda a, b: a - b, 'precedence': 0},
-    '*': {'exec': lambda a, b: a * b, 'precedence': 1},
-    '/': {'exec': lambda a, b: a / b, 'precedence': 1},
+    '+': {'exec': operator.add, 'precedence': 0},
+    '-': {'exec': operator.sub, 'precedence': 0},
+    '*': {'exec': operator.mul, 'precedence': 1},
+    '/': {'exec': operator.truediv, 'precedence': 1},
 }
 
+NUMBER = 'number'
+VARIABLE = 'variable'
+OPERATOR = 'operator'
+LEFT_PAREN = 'left_paren'
+RIGHT_PAREN = 'right_paren'
+
+Token = namedtuple('Token', ['kind', 'text', 'value'])
+
+_symbols = {
+    '(': Token(LEFT_PAREN, '(', None),
+    ')': Token(RIGHT_PAREN, ')', None),
+}
+_symbols.update({symbol: Token(OPERATOR, symbol, None) for symbol in operators})
+# Skips the namedtuple __new__ wrapper, numbers are the most common tokens
+_new_token = tuple.__new__
+_digits = frozenset('0123456789.')
+_letters = frozenset(string.ascii_letters + '_')
+_name = _letters | frozenset(string.digits)
+_whitespace = frozenset(' \t\r\n\x0b\x0c')
+
 logger = logging.getLogger(__name__)
 
 
-def calculate(expression: str) -> float:
+class UnboundVariableError(SyntaxError):
+    """
+    Raised when a program is executed without a value for one of its variables
+    """
+    pass
+
+
+class ExpressionTimeout(Exception):
+    """
+    Raised in a pool worker when a program runs longer than the time limit
+    """
+    pass
+
+
+class TimeLimit(object):
+    """
+    Interrupts a program which runs longer than the limit, see set_time_limit().
+
+    The execution loops count the programs in steps, a SIGALRM interval timer checks that
+    the count changed since the previous alarm, so a program is interrupted after running
+    between 1 and 2 limits and the loop continues with the next one.
+    """
+
+    def __init__(self):
+        self.steps = 0
+        self.checked = -1
+        self.running = False
+
+    def on_alarm(self, signum: int, frame) -> None:
+        if self.running and self.checked == self.steps:
+            # The next program gets a full period
+            self.steps += 1
+            raise ExpressionTimeout("Expression timed out")
+
+        self.checked = self.steps
+
+
+_time_limit = TimeLimit()
+
+
+class Arithmetic(object):
+    """
+    Numbers of the exact programs, the numbers of an expression are converted with `number` and the functions
+    of the operators table work on them as they do on ints and floats. Decimals are calculated in `context`,
+    so the result of each operation is rounded to its precision, fractions are always exact.
+
+    weight is the cost of an operation compared to the ints and floats, it grows with the digits of the numbers
+    of a fraction program and with the precision of decimals.
+    """
+
+    def __init__(self, name: str, number: type, weight: int, context: decimal.Context = None):
+        self.name = name
+        self.number = number
+        self.weight = weight
+        self.context = context
+
+    def parse(self, text: str):
+        """
+        Parses a number, it can be negative
+        """
+        try:
+            return self.number(text)
+        except (ValueError, ArithmeticError):
+            raise SyntaxError("Invalid number %s" % text)
+
+    def cost(self, units: int, size: int) -> int:
+        """
+        Cost of a program of `units` operations and numbers whose numbers have `size` digits in total,
+        in the units of Program.cost. Measured against floats, an operation on fractions is about 6 times slower
+        and the denominators grow with the digits, one on decimals is as fast up to a few hundred digits of precision
+        and about 25 times slower with 10000 digits.
+        """
+        if self.context is None:
+            return units * (self.weight + size // 64)
+
+        return units * (self.weight + self.context.prec // 400)
+
+    def execute(self, program, variables: dict = None):
+        try:
+            if self.context is None:
+                return program.run(variables)
+
+            with decimal.localcontext(self.context):
+                return program.run(variables)
+        except ZeroDivisionError:
+            # Fraction and decimal errors name the classes instead of saying what happened
+            raise ZeroDivisionError("division by zero") from None
+        except decimal.Overflow:
+            raise OverflowError("result out of range") from None
+
+    def __reduce__(self):
+        # Programs are sent to the pool with their arithmetic, this keeps them small
+        return get_arithmetic, (self.name,)
+
+
+_arithmetics = {}
+max_precision = 10000
+
+
+def get_arithmetic(name: str):
+    """
+    Returns the Arithmetic of one of: float (None, the default ints and floats), fraction,
+    decimal (28 digits) or decimal(digits), raises SyntaxError for anything else
+    """
+    if name == 'float':
+        return None
+
+    arithmetic = _arithmetics.get(name)
+
+    if arithmetic is not None:
+        return arithmetic
+
+    if name == 'fraction':
+        arithmetic = Arithmetic('fraction', fractions.Fraction, 6)
+    elif name == 'decimal' or (name.startswith('decimal(') and name.endswith(')') and name[8:-1].isdigit()):
+        precision = int(name[8:-1]) if name != 'decimal' else decimal.getcontext().prec
+
+        if not 0 < precision <= max_precision:
+            raise SyntaxError("Precision should be between 1 and %d" % max_precision)
+
+        context = decimal.Context(prec=precision, traps=[decimal.DivisionByZero, decimal.InvalidOperation,
+                                                         decimal.Overflow])
+        arithmetic = Arithmetic('decimal(%d)' % precision, decimal.Decimal, 1, context)
+    else:
+        raise SyntaxError("Unknown arithmetic %s" % name)
+
+    # Both names of the default precision get the same arithmetic
+    _arithmetics[name] = _arithmetics[arithmetic.name] = arithmetic
+    return arithmetic
+
+
+class Program(namedtuple('Program', ['key', 'code', 'depth', 'shape', 'variables', 'arithmetic', 'size', 'tokens'],
+                         defaults=(None, 0, 0))):
+    """
+    Compiled expression, the code is a flat tuple of numbers, variable names and operator
+    functions in Reverse Polish notation order, the key is the canonical expression and the depth
+    is the maximum size of the stack needed to execute it. Variables are the names of the
+    variables in the order of their first appearance.
+
+    The shape is the code with all the numbers replaced by '#' and variables by '$', programs
+    with the same shape differ only by their numbers and can be executed together by execute_vectorized.
+
+    Programs of exact numbers have an arithmetic, their key and shape start with its name and the size
+    is the number of digits of their numbers. Programs of ints and floats have None.
+
+    Tokens is the number of tokens of the expression the program was compiled from, before it was canonicalized.
+
+    Programs are immutable so the same program can be shared by all the users of the cache.
+    """
+
+    __slots__ = ()
+
+    @property
+    def cost(self) -> int:
+        """
+        Rough estimate of the execution time in abstract units
+        """
+        if self.arithmetic is None:
+            return len(self.code) + self.depth
+
+        return self.arithmetic.cost(len(self.code) + self.depth, self.size)
+
+    def execute(self, variables: dict = None) -> float:
+        """
+        Executes the program, variables is a dict with the values of the program variables
+        """
+        if self.arithmetic is not None:
+            return self.arithmetic.execute(self, variables)
+
+        return self.run(variables)
+
+    def run(self, variables: dict = None) -> float:
+        """
+        Executes the code, exact programs should be executed by their arithmetic
+        """
+        stack = []
+
+        if not self.variables:
+            for item in self.code:
+                if callable(item):
+                    b = stack.pop()
+                    stack[-1] = item(stack[-1], b)
+                else:
+                    stack.append(item)
+
+            return stack[-1]
+
+        if variables is None:
+            variables = {}
+
+        for item in self.code:
+            if callable(item):
+                b = stack.pop()
+                stack[-1] = item(stack[-1], b)
+            elif item.__class__ is str:
+                try:
+                    stack.append(variables[item])
+                except KeyError:
+                    raise UnboundVariableError("Unbound variable %s" % item)
+            else:
+                stack.append(item)
+
+        return stack[-1]
+
+
+class ExpressionCache(object):
+    """
+    Bounded LRU cache of compiled programs keyed by the tokens of the expression, spellings which
+    differ by more than whitespace are separate entries of the same canonical program
+    """
+
+    def __init__(self, maxsize=1024):
+        self._programs = OrderedDict()
+        self._maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def maxsize(self) -> int:
+        return self._maxsize
+
+    @maxsize.setter
+    def maxsize(self, maxsize: int) -> None:
+        self._maxsize = maxsize
+        self._evict()
+
+    def get(self, key: str) -> Program:
+        program = self._programs.get(key)
+
+        if program is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._programs.move_to_end(key)
+
+        return program
+
+    def put(self, program: Program, key: str = None) -> None:
+        self._programs[program.key if key is None else key] = program
+        self._evict()
+
+    def clear(self) -> None:
+        self._programs.clear()
+
+    def _evict(self) -> None:
+        while len(self._programs) > self._maxsize:
+            self._programs.popitem(last=False)
+            self.evictions += 1
+
+    def __len__(self) -> int:
+        return len(self._programs)
+
+
+expression_cache = ExpressionCache()
+
+
+def calculate(expression: str, variables: dict = None) -> float:
     """
     This function parses a users input expression, validates it and calculates the result of it
     """
-    return rpn_execute(shunting_yard(validate_input(prepare_input(expression))))
+    return compile(expression).execute(variables)
 
 
-def prepare_input(expression: str) -> [str]:
+def calculate_many(expressions: [str]) -> list:
     """
-    Parses the expression to tokens
+    Calculates a list of expressions at once, the result of each expression which
+    can't be calculated is the exception raised for it.
     """
-    parts = re.findall('[0-9.?]+|\(|\)|.', str(expression))
-    return list(filter(lambda x: len(x), map(str.strip, parts)))
+    results = []
+
+    for expression in expressions:
+        try:
+            results.append(compile(expression).execute())
+        except Exception as e:
+            results.append(e)
 
+    return results
 
-def validate_input(expression: [str]) -> [str]:
+
+def compile(expression: str, cache: ExpressionCache = None, arithmetic: Arithmetic = None) -> Program:
     """
-    Validates that each token can be handled by the current implementation
+    Compiles the expression to a Program, programs are cached so repeated
+    expressions skip the validation, Shunting-Yard and canonicalize steps.
 
-    At the moment only: numbers, + - * / ( ) are handled
+    With an arithmetic the numbers are exact (see get_arithmetic), constants are not folded then.
     """
-    for token in expression:
-        if not token in operators and not is_number(token) and not token in ("(", ")"):
-            raise SyntaxError("Invalid token %s" % token)
+    if cache is None:
+        cache = expression_cache
 
-    return expression
+    tokens = prepare_input(expression)
+    key = ' '.join([token.text for token in tokens])
+
+    if arithmetic is not None:
+        key = '%s: %s' % (arithmetic.name, key)
+
+    program = cache.get(key)
 
+    if program is None:
+        rpn, canonical = canonicalize(shunting_yard(validate_input(tokens)), arithmetic is None)
+
+        if arithmetic is not None:
+            canonical = '%s: %s' % (arithmetic.name, canonical)
+
+        # The canonical order of the operands would reorder the variables, they keep the order of the expression
+        variables = tuple(dict.fromkeys([token.value for token in tokens if token.kind is VARIABLE]))
+        program = rpn_compile(rpn, canonical, arithmetic, variables)._replace(tokens=len(tokens))
+        cache.put(program, key)
+
+    return program
+
+
+def execute(program: Program) -> float:
+    """
+    Executes a compiled program, this is a function so it can be sent to the pool
+    """
+    return program.execute()
+
+
+def execute_many(programs: [Program]) -> list:
+    """
+    Executes a list of compiled programs, results of the failed ones are the exceptions raised
+
+    Big lists are executed with execute_vectorized when NumPy is installed.
+    """
+    if numpy is not None and len(programs) >= vector_min_group:
+        return execute_vectorized(programs)
+
+    return _execute_scalar(programs)
+
+
+def execute_rows(program: Program, rows: [tuple]) -> list:
+    """
+    Executes the program once for every row of values, values in each row are in the
+    order of program.variables. Results of the failed rows are the exceptions raised.
+
+    Big lists of rows are executed with NumPy when it's installed.
+    """
+    if numpy is not None and len(rows) >= vector_min_group and program.arithmetic is None:
+        results = _execute_rows_vectorized(program, rows)
+
+        if results is not None:
+            return results
+
+    results = []
+    variables = program.variables
+    time_limit = _time_limit
+    time_limit.running = True
 
-def is_number(value) -> bool:
     try:
-        float(value)
-        return True
+        for row in rows:
+            try:
+                time_limit.steps += 1
+                results.append(program.execute(dict(zip(variables, row))))
+            except Exception as e:
+                results.append(e)
+    finally:
+        time_limit.running = False
+
+    return results
+
+
+def execute_bindings(jobs: [tuple]) -> list:
+    """
+    Executes a list of (program, row) jobs, rows of the same program are executed together with execute_rows
+    """
+    groups = {}
+
+    for index, (program, row) in enumerate(jobs):
+        # The same canonical program can have its variables in another order
+        indexes, rows = groups.setdefault((program.key, program.variables), (program, [], []))[1:]
+        indexes.append(index)
+        rows.append(row)
+
+    results = [None] * len(jobs)
+
+    for program, indexes, rows in groups.values():
+        for index, result in zip(indexes, execute_rows(program, rows)):
+            results[index] = result
+
+    return results
+
+
+def warm_up() -> None:
+    """
+    Initializer of the pool workers, compiles and executes a few programs on the scalar
+    and the vectorized engines so the first jobs of a new worker don't pay for it
+    """
+    # Not canonicalized, so the constants aren't folded
+    programs = [
+        rpn_compile(shunting_yard(prepare_input('(%d + 1.5) * %d - 4 / 2' % (i, i)))) for i in range(vector_min_group)
+    ]
+    execute_many(programs)
+    execute_many(programs[:1])
+    execute_rows(compile('a * (b + 2)'), [(1, 2)])
+
+
+def set_time_limit(seconds: float) -> None:
+    """
+    Limits the execution time of each program executed in this process to (about) seconds,
+    programs which run longer fail with ExpressionTimeout. Works only in the main thread.
+    """
+    signal.signal(signal.SIGALRM, _time_limit.on_alarm)
+    signal.setitimer(signal.ITIMER_REAL, seconds, seconds)
+
+
+def init_worker(time_limit: float = 0) -> None:
+    """
+    Initializer of the pool workers, warms them up and sets the time limit of the programs
+    (workers in threads of the server process run without a limit)
+    """
+    warm_up()
+
+    if time_limit and threading.current_thread() is threading.main_thread():
+        set_time_limit(time_limit)
+
+
+# Groups smaller than this are executed one by one, NumPy call overhead is bigger than the gain.
+# Half of the default batch size of the server, so a batch vectorizes its most common shape
+vector_min_group = 64
+
+# Integers up to this value are exact as floats, the vectorized engine works with floats
+_exact_limit = 2 ** 53
+
+
+def execute_vectorized(programs: [Program], min_group: int = None) -> list:
+    """
+    Executes a list of compiled programs with NumPy.
+
+    Programs are grouped by their shape and each operation of a group is executed
+    at once for all of its programs. Small groups, and the programs for which the float
+    arithmetic would give a different result than Python (big integers, division by zero)
+    are executed one by one with execute_many.
+    """
+    if min_group is None:
+        min_group = vector_min_group
+
+    if numpy is None:
+        return _execute_scalar(programs)
+
+    groups = {}
+
+    for index, program in enumerate(programs):
+        groups.setdefault(program.shape, []).append(index)
+
+    results = [None] * len(programs)
+
+    for shape, indexes in groups.items():
+        group = [programs[index] for index in indexes]
+        # Programs with variables can't be executed without values, exact numbers aren't floats
+        if len(group) >= min_group and '$' not in shape and group[0].arithmetic is None:
+            group_results = _execute_group(group)
+        else:
+            group_results = None
+
+        if group_results is None:
+            group_results = _execute_scalar(group)
+
+        for index, result in zip(indexes, group_results):
+            results[index] = result
+
+    return results
+
+
+def _execute_scalar(programs: [Program]) -> list:
+    results = []
+    time_limit = _time_limit
+    time_limit.running = True
+
+    try:
+        for program in programs:
+            try:
+                time_limit.steps += 1
+                results.append(program.execute())
+            except Exception as e:
+                results.append(e)
+    finally:
+        time_limit.running = False
+
+    return results
+
+
+def _execute_group(programs: [Program]) -> list:
+    """
+    Executes programs of the same shape as arrays, returns None when they can't be vectorized
+    """
+    code = programs[0].code
+    codes = [program.code for program in programs]
+    count = len(codes)
+
+    values = [list(map(operator.itemgetter(i), codes)) for i, item in enumerate(code) if not callable(item)]
+
+    try:
+        columns = [numpy.array(column, dtype=numpy.float64) for column in values]
+    except OverflowError:
+        return None
+
+    result, fallback = _execute_arrays(code, columns, count)
+    # Without division the result is an integer unless there is a float number in the program,
+    # the types of the columns decide it for the whole group unless some programs have floats and some don't
+    types = [set(map(type, column)) for column in values]
+
+    if '/' in programs[0].shape or {float} in types:
+        results = result.tolist()
+    elif not any(float in column_types for column_types in types):
+        results = numpy.where(fallback, 0, result).astype(numpy.int64).tolist()
+    else:
+        floats = [_has_float(program) for program in programs]
+        results = [value if is_float else int(value) for is_float, value in zip(floats, result.tolist())]
+
+    for index in numpy.flatnonzero(fallback).tolist():
+        results[index] = _execute_scalar([programs[index]])[0]
+
+    return results
+
+
+def _has_float(program: Program) -> bool:
+    """
+    True when a number of the program is a float, so its result is a float too
+    """
+    return float in map(type, program.code)
+
+
+def _execute_rows_vectorized(program: Program, rows: [tuple]) -> list:
+    """
+    Executes the program for all the rows as arrays, returns None when they can't be vectorized
+    """
+    count = len(rows)
+    variables = program.variables
+
+    if any(len(row) != len(variables) for row in rows):
+        return None
+
+    values = list(zip(*rows))
+    floats = numpy.zeros(count, dtype=bool)
+
+    for column in values:
+        types = set(map(type, column))
+
+        if not types <= {int, float}:
+            return None
+
+        if float in types:
+            floats |= numpy.fromiter((value.__class__ is float for value in column), dtype=bool, count=count)
+
+    try:
+        columns = {name: numpy.array(column, dtype=numpy.float64) for name, column in zip(variables, values)}
+        slots = [columns[item] if item.__class__ is str else numpy.float64(item)
+                 for item in program.code if not callable(item)]
+    except OverflowError:
+        return None
+
+    result, fallback = _execute_arrays(program.code, slots, count)
+
+    if '/' in program.shape or _has_float(program):
+        results = result.tolist()
+    elif not floats.any():
+        results = numpy.where(fallback, 0, result).astype(numpy.int64).tolist()
+    else:
+        results = [value if is_float else int(value) for is_float, value in zip(floats.tolist(), result.tolist())]
+
+    for index in numpy.flatnonzero(fallback).tolist():
+        try:
+            results[index] = program.execute(dict(zip(variables, rows[index])))
+        except Exception as e:
+            results[index] = e
+
+    return results
+
+
+def _execute_arrays(code: tuple, slots: list, count: int) -> tuple:
+    """
+    Executes the code with arrays (or scalars) in place of the numbers and variables.
+
+    Returns the result array and a mask of the rows which should be executed by Python,
+    because their values are out of the exact range of floats or there is division by zero.
+    """
+    fallback = numpy.zeros(count, dtype=bool)
+
+    for slot in slots:
+        fallback |= numpy.abs(slot) >= _exact_limit
+
+    slots = iter(slots)
+    stack = []
+
+    with numpy.errstate(all='ignore'):
+        for item in code:
+            if callable(item):
+                b = stack.pop()
+
+                if item is operator.truediv:
+                    fallback |= b == 0
+
+                stack[-1] = item(stack[-1], b)
+                fallback |= numpy.abs(stack[-1]) >= _exact_limit
+            else:
+                stack.append(next(slots))
+
+    # The result of a program without variables is a scalar
+    return numpy.broadcast_to(stack[-1], count), fallback
+
+
+def parse_number(text: str) -> float:
+    """
+    Parses a number, unlike the numbers in expressions it can be negative
+    """
+    try:
+        return float(text) if '.' in text else int(text)
     except ValueError:
-        return False
+        raise SyntaxError("Invalid number %s" % text)
+
+
+def prepare_input(expression: str) -> [Token]:
+    """
+    Parses the expression to typed tokens in a single pass, numbers are converted here
+    so the next steps don't have to guess what a token is.
+    """
+    expression = str(expression)
+    tokens = []
+    append = tokens.append
+    length = len(expression)
+    i = 0
+
+    while i < length:
+        char = expression[i]
+
+        if char in _digits:
+            start = i
+            i += 1
+
+            while i < length and expression[i] in _digits:
+                i += 1
+
+            text = expression[start:i]
+
+            try:
+                # Don't convert to float if not needed
+                append(_new_token(Token, (NUMBER, text, float(text) if '.' in text else int(text))))
+            except ValueError:
+                raise SyntaxError("Invalid number %s" % text)
+
+            continue
+
+        if char in _letters:
+            start = i
+            i += 1
+
+            while i < length and expression[i] in _name:
+                i += 1
+
+            text = expression[start:i]
+            append(_new_token(Token, (VARIABLE, text, text)))
+            continue
+
+        if char in _symbols:
+            append(_symbols[char])
+        elif char not in _whitespace:
+            raise SyntaxError("Invalid token %s" % char)
+
+        i += 1
+
+    return tokens
+
+
+def validate_input(expression: [Token]) -> [Token]:
+    """
+    Validates that the tokens form a valid expression
+
+    At the moment only: numbers, variables, + - * / ( ) are handled, operators should be
+    placed between two operands and the parentheses should be balanced.
+    """
+    expect_operand = True
+    depth = 0
+
+    for token in expression:
+        kind = token.kind
+
+        if expect_operand:
+            if kind is NUMBER or kind is VARIABLE:
+                expect_operand = False
+            elif kind is LEFT_PAREN:
+                depth += 1
+            else:
+                raise SyntaxError("Unexpected token %s" % token.text)
+        elif kind is OPERATOR:
+            expect_operand = True
+        elif kind is RIGHT_PAREN and depth:
+            depth -= 1
+        else:
+            raise SyntaxError("Unexpected token %s" % token.text)
+
+    if expect_operand or depth:
+        raise SyntaxError("Unexpected end of expression")
+
+    return expression
 
 
-def shunting_yard(expression: [str]) -> [str]:
+def shunting_yard(expression: [Token]) -> [Token]:
     """
     Shunting-Yard algorithm implementation.
 
@@ -62,18 +755,17 @@ def shunting_yard(expression: [str]) -> [str]:
     operator_stack = []
 
     for token in expression:
+        kind = token.kind
 
-        if is_number(token):
+        if kind is NUMBER or kind is VARIABLE:
             output_queue.append(token)
-            continue
 
-        if token == "(":
+        elif kind is LEFT_PAREN:
             # If it's a left bracket push it onto the stack
             operator_stack.append(token)
-            continue
 
-        if token == ")":
-            while operator_stack and operator_stack[-1] != "(":
+        elif kind is RIGHT_PAREN:
+            while operator_stack and operator_stack[-1].kind is not LEFT_PAREN:
                 # While there's not a left bracket at the top of the stack
                 # Pop operators from the stack onto the output queue.
                 output_queue.append(operator_stack.pop())
@@ -81,9 +773,11 @@ def shunting_yard(expression: [str]) -> [str]:
             # Pop the left bracket from the stack and discard it
             operator_stack.pop()
 
-        if token in operators:
-            while operator_stack and operator_stack[-1] not in ("(", ")") and operators[operator_stack[-1]][
-                'precedence'] >= operators[token]['precedence']:
+        else:
+            precedence = operators[token.text]['precedence']
+
+            while operator_stack and operator_stack[-1].kind is OPERATOR and \
+                    operators[operator_stack[-1].text]['precedence'] >= precedence:
                 # While there's an operator on the top of the stack with greater precedence:
                 # Pop operators from the stack onto the output queue
                 output_queue.append(operator_stack.pop())
@@ -95,31 +789,242 @@ def shunting_yard(expression: [str]) -> [str]:
     while operator_stack:
         output_queue.append(operator_stack.pop())
 
-    logger.debug('RPN: %s' % ' '.join(output_queue))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('RPN: %s', ' '.join(token.text for token in output_queue))
     return output_queue
 
 
-def rpn_execute(rpn: [str]) -> float:
+# Precedence of numbers and variables, they never need parentheses
+_OPERAND = 2
+_commutative = frozenset('+*')
+_spaced = {symbol: ' %s ' % symbol for symbol in operators}
+
+
+def canonicalize(rpn: [Token], fold=True) -> tuple:
+    """
+    Rewrites the output of Shunting-Yard to a canonical form, so the spellings of the same expression
+    get the same program and the same key in the caches. Returns the RPN and its text, the key.
+
+    The text has only the parentheses it needs, the operands of + and * are sorted (numbers, variables,
+    then operations) and constant operations are folded when their operands are integers below 2 ** 53 or
+    floats and their result is a number the expression could contain (a non negative integer below 2 ** 53
+    or a float written with a dot), so folding is cheap and the key is a valid expression. Operations are
+    never regrouped, swapping the operands of a single + or * gives the same result, floats included.
+    Without fold the constants and the text of the numbers are left for an exact arithmetic, which
+    parses the literals itself (a float repr would round them).
     """
-    Executes math operations from a Reverse Polish notation list
+    # Nodes are tuples of (precedence, value, order, hash, token, left operand, right operand),
+    # value is None unless the node is a number and order sorts the operands of + and *
+    stack = []
+
+    for token in rpn:
+        kind = token.kind
+
+        if kind is NUMBER:
+            text = _number_text(token.value, token.text) if fold else token.text
+
+            if text != token.text:
+                token = _new_token(Token, (NUMBER, text, token.value))
+
+            stack.append((_OPERAND, token.value, (0, token.value, text), crc32(text.encode()), token, None, None))
+            continue
+
+        if kind is VARIABLE:
+            text = token.text
+            stack.append((_OPERAND, None, (1, text), crc32(text.encode()), token, None, None))
+            continue
+
+        if len(stack) < 2:
+            raise SyntaxError("Invalid expression")
+
+        b = stack.pop()
+        a = stack.pop()
+
+        if fold and a[1] is not None and b[1] is not None:
+            node = _fold(token, a[1], b[1])
+
+            if node is not None:
+                stack.append(node)
+                continue
+
+        if token.text in _commutative and b[2] < a[2]:
+            a, b = b, a
+
+        digest = (a[3] * 1000003 ^ b[3] * 31 ^ ord(token.text)) & 0xffffffffffffffff
+        stack.append((operators[token.text]['precedence'], None, (2, digest), digest, token, a, b))
+
+    if not stack:
+        return [], ''
+
+    return _emit(stack[-1])
+
+
+def _emit(root: tuple) -> tuple:
+    """
+    Returns the RPN and the text of a canonicalize() tree, without recursion so deep expressions don't
+    hit the recursion limit
+    """
+    rpn = []
+    parts = []
+    # Nodes, parts of the text and operator tokens, in reverse order
+    work = [root]
+    pop, push = work.pop, work.append
+
+    while work:
+        item = pop()
+
+        if item.__class__ is not tuple:
+            if item.__class__ is str:
+                parts.append(item)
+            else:
+                rpn.append(item)
+
+            continue
+
+        precedence, _, _, _, token, a, b = item
+
+        if a is None:
+            rpn.append(token)
+            parts.append(token.text)
+            continue
+
+        push(token)
+
+        if b[0] <= precedence:
+            push(')')
+            push(b)
+            push('(')
+        else:
+            push(b)
+
+        push(_spaced[token.text])
+
+        if a[0] < precedence:
+            push(')')
+            push(a)
+            push('(')
+        else:
+            push(a)
+
+    return rpn, ''.join(parts)
+
+
+def _number_text(value, text: str) -> str:
+    """
+    Shortest text of a number, the original text when the number can't be written without an exponent
+    """
+    if value.__class__ is int:
+        return text if text[0] != '0' or text == '0' else repr(value)
+
+    canonical = repr(value)
+    return canonical if '.' in canonical and 'e' not in canonical else text
+
+
+def _fold(token: Token, a, b):
+    """
+    Returns the node of the number a <operator> b, None when it shouldn't be folded
+    """
+    if (a.__class__ is int and a >= _exact_limit) or (b.__class__ is int and b >= _exact_limit):
+        return None
+
+    try:
+        value = operators[token.text]['exec'](a, b)
+    except ArithmeticError:
+        # The error is raised when the program is executed
+        return None
+
+    text = repr(value)
+
+    if value.__class__ is int:
+        if not 0 <= value < _exact_limit:
+            return None
+    elif text[0] == '-' or '.' not in text or 'e' in text:
+        return None
+
+    return _OPERAND, value, (0, value, text), crc32(text.encode()), _new_token(Token, (NUMBER, text, value)), None, None
+
+
+def rpn_execute(rpn: [Token], variables: dict = None, arithmetic: Arithmetic = None) -> float:
+    """
+    Executes math operations from a Reverse Polish notation list,
+    variables is a dict with the values of the variables in the expression.
+    With an arithmetic the numbers are converted to its exact numbers.
 
     For more info: https://en.wikipedia.org/wiki/Reverse_Polish_notation
     """
+    if arithmetic is not None:
+        # Decimals need the context of the arithmetic around the whole execution
+        return rpn_compile(rpn, arithmetic=arithmetic).execute(variables)
+
     stack = []
 
-    for value in rpn:
-        if value in operators:
+    for token in rpn:
+        if token.kind is OPERATOR:
             try:
                 b, a = stack.pop(), stack.pop()
             except IndexError:
                 raise SyntaxError("Invalid expression")
 
-            function = operators[value]['exec']
-
-            if callable(function):
-                stack.append(function(a, b))
+            stack.append(operators[token.text]['exec'](a, b))
+        elif token.kind is VARIABLE:
+            try:
+                stack.append(variables[token.text])
+            except (KeyError, TypeError):
+                raise UnboundVariableError("Unbound variable %s" % token.text)
         else:
-            # Don't convert to float if not needed
-            stack.append(int(value) if value.replace('-', '').isdigit() else float(value))
+            stack.append(token.value)
 
     return stack.pop()
+
+
+def rpn_compile(rpn: [Token], key: str = '', arithmetic: Arithmetic = None, variables: tuple = None) -> Program:
+    """
+    Converts a Reverse Polish notation list to a Program,
+    numbers are replaced by their values (the exact numbers of the arithmetic) and operators by their functions.
+    The variables of the program are in the order of the rpn unless given, its tokens are the ones of the rpn.
+    """
+    code = []
+    shape = []
+    names = []
+    depth = 0
+    max_depth = 0
+    size = 0
+
+    for token in rpn:
+        if token.kind is OPERATOR:
+            if depth < 2:
+                raise SyntaxError("Invalid expression")
+
+            depth -= 1
+            code.append(operators[token.text]['exec'])
+            shape.append(token.text)
+        else:
+            depth += 1
+            max_depth = max(depth, max_depth)
+
+            if token.kind is VARIABLE:
+                code.append(token.value)
+                shape.append('$')
+
+                if token.value not in names:
+                    names.append(token.value)
+            else:
+                shape.append('#')
+
+                if arithmetic is None:
+                    code.append(token.value)
+                else:
+                    code.append(arithmetic.number(token.text))
+                    size += len(token.text)
+
+    if not depth:
+        raise SyntaxError("Empty expression")
+
+    if variables is None:
+        variables = tuple(names)
+
+    if arithmetic is None:
+        return Program(key, tuple(code), max_depth, ''.join(shape), variables, tokens=len(rpn))
+
+    shape = '%s: %s' % (arithmetic.name, ''.join(shape))
+    return Program(key, tuple(code), max_depth, shape, variables, arithmetic, size, len(rpn))
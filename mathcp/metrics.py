@@ -0,0 +1,172 @@
+from bisect import bisect_left
+
+# Upper bounds of the buckets of the histograms
+TIME_BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+class Counter(object):
+    """
+    A value which only goes up
+    """
+
+    __slots__ = ('name', 'help', 'value')
+    type = 'counter'
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount=1) -> None:
+        self.value += amount
+
+    def samples(self) -> list:
+        return [(self.name, '', self.value)]
+
+
+class Gauge(object):
+    """
+    A value which is read from a function when the metrics are collected, so it costs nothing until then
+    """
+
+    __slots__ = ('name', 'help', 'function')
+    type = 'gauge'
+
+    def __init__(self, name: str, help: str, function: callable):
+        self.name = name
+        self.help = help
+        self.function = function
+
+    def samples(self) -> list:
+        return [(self.name, '', self.function())]
+
+
+class FunctionCounter(Gauge):
+    """
+    A counter whose total is kept by another object and read from a function when the metrics are collected
+    """
+
+    __slots__ = ()
+    type = 'counter'
+
+
+class Histogram(object):
+    """
+    Counts the observed values in buckets with fixed upper bounds, the counts are preallocated
+    so observing a value is a binary search and an increment.
+    """
+
+    __slots__ = ('name', 'help', 'bounds', 'counts', 'sum', 'count')
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, bounds: tuple = TIME_BUCKETS):
+        self.name = name
+        self.help = help
+        self.bounds = tuple(bounds)
+        # The last bucket counts the values above all the bounds
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """
+        Upper bound of the bucket which contains the q (0..1) quantile, inf when it's above all the bounds
+        """
+        rank = q * self.count
+
+        for bound, total in zip(self.bounds, self._cumulative()):
+            if total and total >= rank:
+                return bound
+
+        return float('inf')
+
+    def _cumulative(self) -> list:
+        total, cumulative = 0, []
+
+        for count in self.counts:
+            total += count
+            cumulative.append(total)
+
+        return cumulative
+
+    def samples(self) -> list:
+        cumulative = self._cumulative()
+        samples = [
+            (self.name + '_bucket', '{le="%s"}' % bound, total) for bound, total in zip(self.bounds, cumulative)
+        ]
+        samples.append((self.name + '_bucket', '{le="+Inf"}', cumulative[-1]))
+        samples.append((self.name + '_sum', '', self.sum))
+        samples.append((self.name + '_count', '', self.count))
+        return samples
+
+
+class Registry(object):
+    """
+    Holds the metrics by name, registering a metric with the same name again returns the existing
+    counter or histogram and replaces a gauge or a counter read from a function (the objects it reads from can be new).
+    """
+
+    def __init__(self):
+        self._metrics = {}
+
+    def counter(self, name: str, help: str, function: callable = None) -> Counter:
+        """
+        With a function the counter reads its total from it, like a gauge
+        """
+        if function is not None:
+            counter = self._metrics[name] = FunctionCounter(name, help, function)
+            return counter
+
+        return self._metrics.setdefault(name, Counter(name, help))
+
+    def histogram(self, name: str, help: str, bounds: tuple = TIME_BUCKETS) -> Histogram:
+        return self._metrics.setdefault(name, Histogram(name, help, bounds))
+
+    def gauge(self, name: str, help: str, function: callable) -> Gauge:
+        gauge = self._metrics[name] = Gauge(name, help, function)
+        return gauge
+
+    def stats(self) -> [str]:
+        """
+        Human readable lines, histograms are summarized by their count, average and quantiles
+        """
+        lines = []
+
+        for metric in self._metrics.values():
+            if isinstance(metric, Histogram):
+                lines.append("STAT %s count=%d avg=%g p50=%g p99=%g" % (
+                    metric.name, metric.count, metric.sum / metric.count if metric.count else 0,
+                    metric.quantile(0.5), metric.quantile(0.99)
+                ))
+            else:
+                for name, _, value in metric.samples():
+                    lines.append("STAT %s %s" % (name, value))
+
+        return lines
+
+    def prometheus(self) -> str:
+        """
+        Metrics in the Prometheus text exposition format
+        """
+        lines = []
+
+        for metric in self._metrics.values():
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+
+            for name, labels, value in metric.samples():
+                lines.append('%s%s %s' % (name, labels, value))
+
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
@@ -1,63 +1,376 @@
 import logging
 import multiprocessing
-from multiprocessing.pool import AsyncResult
+import socket
+import time
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from typing import Iterable
 
 from mathcp.loop import Tickable
+from mathcp.metrics import registry
 
 logger = logging.getLogger(__name__)
 
+compute_seconds = registry.histogram('mathcp_compute_seconds', "Execution time of a job or batch")
+queue_wait_seconds = registry.histogram(
+    'mathcp_queue_wait_seconds', "Round trip of a batch to the pool minus its execution time"
+)
 
-class Task(Tickable):
+
+def timed(func: callable, args):
+    """
+    Calls func(args) in the worker and returns the execution time together with the result
+    """
+    start = time.perf_counter()
+    result = func(args)
+    return time.perf_counter() - start, result
+
+
+class Scheduler(object):
+    """
+    Decides which jobs are cheap enough to be executed inline on the loop instead of the pool.
+
+    The time of a cost unit is measured from the inline executions and a job runs inline when
+    its predicted time is below the threshold. The threshold is also tuned down to the measured
+    pool round trip, there is no point to block the loop longer than the pool needs to reply.
+    A threshold of 0 disables the inline execution.
+
+    A batch is sent as soon as its predicted time reaches batch_time, so expensive jobs (long expressions,
+    exact numbers with many digits) are spread over the workers instead of running one after the other in a batch.
+    """
+
+    def __init__(self, threshold=0.0005, unit_time=0.000001, alpha=0.1, batch_time=0.005):
+        self.max_threshold = threshold
+        self.batch_time = batch_time
+        self.threshold = threshold
+        self.unit_time = unit_time
+        self.round_trip = None
+        self.inlined = 0
+        self.offloaded = 0
+        self._alpha = alpha
+
+    def inline(self, cost: int) -> bool:
+        """
+        Returns True if the job with the given cost should be executed inline
+        """
+        if self.threshold and cost * self.unit_time <= self.threshold:
+            self.inlined += 1
+            return True
+
+        self.offloaded += 1
+        return False
+
+    def batch_full(self, cost: int) -> bool:
+        """
+        Returns True if a batch of jobs with the given total cost should be sent without waiting for more
+        """
+        return cost * self.unit_time >= self.batch_time
+
+    def on_inline(self, cost: int, elapsed: float) -> None:
+        """
+        Called with the execution time of a job executed inline
+        """
+        self.unit_time += self._alpha * (elapsed / max(cost, 1) - self.unit_time)
+
+    def on_round_trip(self, elapsed: float) -> None:
+        """
+        Called with the time it took the pool to return the result
+        """
+        if self.round_trip is None:
+            self.round_trip = elapsed
+        else:
+            self.round_trip += self._alpha * (elapsed - self.round_trip)
+
+        self.threshold = min(self.max_threshold, self.round_trip)
+
+
+class BasePool(Tickable):
     """
-    This is a wrapper for AsyncResult object returned by the multiprocessing pool
-    to be executed in the Loop, it also holds the supplied callbacks to be called
-    when task is finished.
+    Base class for the pools, sub-classes implement _submit() to send a job to the workers.
+
+    Jobs added with a cost are executed inline when the scheduler thinks they are cheaper
+    than the round trip to the pool.
 
-    on_success is called when no exception is thrown by the operation
-    on_error is called if operation throws an exception
+    Batched calls are collected from all the callers during a loop and sent to
+    the pool as a single call of func with the list of arguments, which saves a lot
+    of inter process communication when the tasks are small.
     """
 
-    def __init__(self, result: AsyncResult, on_success: callable, on_error: callable):
+    def __init__(self, batch_size=128, scheduler: Scheduler = None):
         super().__init__()
-        self._result = result
-        self._on_success = on_success
-        self._on_error = on_error
+        self._batch_size = batch_size
+        self._batches = {}
+        self.scheduler = scheduler or Scheduler()
+        # Number of jobs (or batches) sent to the workers which are not finished yet
+        self.pending = 0
+        # (queue wait, execution time, size) of the batch whose results are being delivered
+        self.timing = None
+
+    def add(self, func: callable, args: Iterable, on_success: callable, on_error: callable, cost: int = None) -> None:
+        if cost is not None and self.scheduler.inline(cost):
+            self._inline(func, args, on_success, on_error, cost)
+        else:
+            self.pending += 1
+            self._submit(
+                func, args, partial(self._on_job_success, on_success, on_error), partial(self._on_job_error, on_error)
+            )
+
+    def add_batched(self, func: callable, arg, on_success: callable, on_error: callable, cost: int = None) -> None:
+        """
+        Queues arg for a batch call of func.
+
+        func receives a list of arguments and should return a list of results in the same
+        order, results which are exceptions are passed to on_error instead of on_success.
+        """
+        if cost is not None and self.scheduler.inline(cost):
+            self._inline(func, ([arg],), partial(self._deliver, [(on_success, on_error)]), on_error, cost)
+            return
+
+        if not self._batches:
+            self.loop.call_soon(self.flush)
+
+        batch = self._batches.get(func)
+
+        if batch is None:
+            # Arguments, callbacks and the total cost
+            batch = self._batches[func] = [[], [], 0]
+
+        args, callbacks = batch[0], batch[1]
+        args.append(arg)
+        callbacks.append((on_success, on_error))
+
+        if cost is not None:
+            batch[2] += cost
+
+        if len(args) >= self._batch_size or self.scheduler.batch_full(batch[2]):
+            del self._batches[func]
+            self._send(func, args, callbacks)
+
+    def flush(self) -> None:
+        """
+        Sends all the queued batches to the pool
+        """
+        batches, self._batches = self._batches, {}
+
+        for func, (args, callbacks, _) in batches.items():
+            self._send(func, args, callbacks)
+
+    def _submit(self, func: callable, args: Iterable, on_success: callable, on_error: callable) -> None:
+        raise NotImplementedError("Implement this method in your class")
+
+    def _inline(self, func: callable, args: Iterable, on_success: callable, on_error: callable, cost: int) -> None:
+        start = time.perf_counter()
+
+        try:
+            result = func(*args)
+        except Exception as e:
+            self.timing = None
+            on_error(e)
+            return
+
+        elapsed = time.perf_counter() - start
+        compute_seconds.observe(elapsed)
+        self.scheduler.on_inline(cost, elapsed)
+        self.timing = (0.0, elapsed, 1)
+        self._call(on_success, on_error, result)
+
+    @staticmethod
+    def _call(callback: callable, on_error: callable, result) -> None:
+        """
+        Calls the callback with the result, an exception raised by the callback is passed to on_error of the job
+        """
+        try:
+            callback(result)
+        except Exception as e:
+            on_error(e)
+
+    def _on_job_success(self, on_success: callable, on_error: callable, result) -> None:
+        self.pending -= 1
+        self.timing = None
+        self._call(on_success, on_error, result)
+
+    def _on_job_error(self, on_error: callable, error: Exception) -> None:
+        self.pending -= 1
+        self.timing = None
+        on_error(error)
+
+    def _send(self, func: callable, args: list, callbacks: list) -> None:
+        self.pending += 1
+        self._submit(
+            timed,
+            (func, args),
+            partial(self._on_batch_success, callbacks, time.perf_counter()),
+            partial(self._on_batch_error, callbacks)
+        )
+
+    def _on_batch_success(self, callbacks: list, start: float, timed_results: tuple) -> None:
+        self.pending -= 1
+        round_trip = time.perf_counter() - start
+        elapsed, results = timed_results
+        queue_wait = max(round_trip - elapsed, 0)
+        compute_seconds.observe(elapsed)
+        queue_wait_seconds.observe(queue_wait)
+        self.scheduler.on_round_trip(round_trip)
+        self.timing = (queue_wait, elapsed, len(results))
+        self._deliver(callbacks, results)
+
+    def _deliver(self, callbacks: list, results: list) -> None:
+        for (on_success, on_error), result in zip(callbacks, results):
+            if isinstance(result, Exception):
+                on_error(result)
+            else:
+                self._call(on_success, on_error, result)
+
+    def _on_batch_error(self, callbacks: list, error: Exception) -> None:
+        self.pending -= 1
+        self.timing = None
+
+        for _, on_error in callbacks:
+            on_error(error)
+
+
+class CompletionPool(BasePool):
+    """
+    Base class for the pools whose jobs complete in other threads.
+
+    Finished jobs are pushed to a queue with _complete() and the loop is woken up through
+    a socket pair, whose read end is the file descriptor of the pool. The loop then calls
+    the callbacks of all the finished jobs at once.
+    """
+
+    def __init__(self, batch_size=128, scheduler: Scheduler = None):
+        super().__init__(batch_size, scheduler)
+        self._completed = deque()
+        self._notified = False
+        self._wakeup_reader, self._wakeup_writer = socket.socketpair()
+        self._wakeup_reader.setblocking(0)
+        self._wakeup_writer.setblocking(0)
+
+    def fileno(self) -> int:
+        return self._wakeup_reader.fileno()
+
+    def _complete(self, callback: callable, result) -> None:
+        """
+        Queues the callback to be called with the result on the loop, safe to call from any thread
+        """
+        self._completed.append((callback, result))
+
+        if not self._notified:
+            self._notified = True
 
-    def tick(self) -> None:
-        if self._result.ready():
             try:
-                self._on_success(self._result.get())
-                logger.info("Task successful")
-            except Exception as e:
-                self._on_error(e)
-                logger.info("Task error")
+                self._wakeup_writer.send(b'\0')
+            except (BlockingIOError, OSError):
+                # The loop is already woken up, or the pool is destroyed
+                pass
+
+    def tick(self) -> None:
+        try:
+            self._wakeup_reader.recv(4096)
+        except BlockingIOError:
+            pass
 
-            self.destroy()
+        # Cleared before the queue is drained, so a job completed meanwhile wakes the loop again
+        self._notified = False
+        completed = self._completed
+
+        while completed:
+            callback, result = completed.popleft()
+
+            try:
+                callback(result)
+            except Exception:
+                # An error callback failed, the other completions are still delivered
+                logger.exception("Completion callback failed")
 
     def destroy(self) -> None:
         super().destroy()
-        del self._result
-        del self._on_success
-        del self._on_error
+        self._wakeup_reader.close()
+        self._wakeup_writer.close()
 
-    def __del__(self) -> None:
-        logger.debug("Destruct %s", type(self))
 
-
-class Pool(Tickable):
+class Pool(CompletionPool):
     """
     This is a multiprocessing pool wrapper to offload a CPU intensive tasks to a pool of subprocess
     so they don't load the main server loop.
+
+    processes, initializer and maxtasksperchild are passed to multiprocessing.Pool, start_method
+    selects the multiprocessing context (fork, forkserver or spawn). Results are delivered by
+    completion: the pool result thread queues the finished jobs and wakes the loop.
     """
 
-    def __init__(self):
-        super().__init__()
-        self._pool = multiprocessing.Pool()
+    def __init__(self, batch_size=128, scheduler: Scheduler = None, processes: int = None, start_method: str = None,
+                 initializer: callable = None, maxtasksperchild: int = None):
+        super().__init__(batch_size, scheduler)
+        self._pool = get_context(start_method, initializer).Pool(
+            processes, initializer, maxtasksperchild=maxtasksperchild
+        )
+
+    def _submit(self, func: callable, args: Iterable, on_success: callable, on_error: callable) -> None:
+        self._pool.apply_async(
+            func,
+            args=args,
+            callback=partial(self._complete, on_success),
+            error_callback=partial(self._complete, on_error)
+        )
+
+    def destroy(self) -> None:
+        super().destroy()
+        self._pool.terminate()
 
-    def add(self, func: callable, args: Iterable, on_success: callable, on_error: callable) -> None:
-        task = Task(self._pool.apply_async(func, args=args), on_success, on_error)
-        self.loop.add(task)
 
-    def __del__(self) -> None:
-        logger.debug("Destruct %s", type(self))
+class ExecutorPool(CompletionPool):
+    """
+    This is a pool on top of a concurrent.futures executor, a ThreadPoolExecutor avoids
+    the inter process communication when the expressions are cheap (or the server runs in
+    a container with a single CPU), a ProcessPoolExecutor is an alternative to Pool.
+    """
+
+    def __init__(self, executor: Executor, batch_size=128, scheduler: Scheduler = None):
+        super().__init__(batch_size, scheduler)
+        self._executor = executor
+
+    def _submit(self, func: callable, args: Iterable, on_success: callable, on_error: callable) -> None:
+        future = self._executor.submit(func, *args)
+        future.add_done_callback(partial(self._on_done, on_success, on_error))
+
+    def _on_done(self, on_success: callable, on_error: callable, future: Future) -> None:
+        error = future.exception()
+
+        if error:
+            self._complete(on_error, error)
+        else:
+            self._complete(on_success, future.result())
+
+    def destroy(self) -> None:
+        super().destroy()
+        self._executor.shutdown(wait=False)
+
+
+def get_context(start_method: str = None, initializer: callable = None) -> multiprocessing.context.BaseContext:
+    """
+    Returns the multiprocessing context of the start method, the forkserver preloads
+    the module of the initializer so new workers are forked with it already imported
+    """
+    context = multiprocessing.get_context(start_method)
+
+    if start_method == 'forkserver' and initializer is not None:
+        # The initializer can be a partial
+        context.set_forkserver_preload([getattr(initializer, 'func', initializer).__module__])
+
+    return context
+
+
+def create_executor(backend: str, workers: int = None, start_method: str = None,
+                    initializer: callable = None) -> Executor:
+    """
+    Creates a concurrent.futures executor, backend is 'thread' or 'process'.
+
+    Workers are not recycled, max_tasks_per_child of the process executor can hang
+    when jobs are queued (Python 3.11), use Pool for that.
+    """
+    if backend == 'thread':
+        return ThreadPoolExecutor(workers, initializer=initializer)
+
+    return ProcessPoolExecutor(workers, get_context(start_method, initializer), initializer)
@@ -0,0 +1,137 @@
+import logging
+import os
+import sys
+import threading
+
+from mathcp.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+slow_total = registry.counter('mathcp_slow_total', "Requests slower than the slow log threshold")
+
+
+class SamplingProfiler(object):
+    """
+    Samples the stack of a thread (the loop thread by default) `rate` times per second
+    from a background thread, so it can be turned on in production without instrumenting the code.
+
+    The samples are written in the collapsed stack format of flamegraph.pl and speedscope:
+    one line per distinct stack, the frames from the root separated by ';' and the number of samples.
+    {pid} in the path is replaced by the process id, so the workers of a supervisor write separate files.
+    """
+
+    def __init__(self, path: str = None, rate=100):
+        self.path = (path or 'mathcp-{pid}.folded').format(pid=os.getpid())
+        self.rate = rate
+        self.samples = 0
+        self._stacks = {}
+        self._names = {}
+        self._thread = None
+        self._thread_id = None
+        self._stopping = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self, thread_id: int = None) -> None:
+        """
+        Starts sampling the thread with the given id, the calling thread by default
+        """
+        if self._thread:
+            return
+
+        self._thread_id = thread_id or threading.get_ident()
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='mathcp-profiler', daemon=True)
+        self._thread.start()
+        logger.info("Profiling at %s Hz", self.rate)
+
+    def stop(self) -> int:
+        """
+        Stops sampling and writes the collapsed stacks to path, returns the number of samples
+        """
+        if not self._thread:
+            return 0
+
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+        samples = self.samples
+
+        with open(self.path, 'w') as file:
+            file.write(self.collapsed())
+
+        logger.info("Profile with %d samples written to %s", samples, self.path)
+        self._stacks.clear()
+        self.samples = 0
+        return samples
+
+    def collapsed(self) -> str:
+        return ''.join('%s %d\n' % (stack, count) for stack, count in self._stacks.items())
+
+    def sample(self) -> None:
+        frame = sys._current_frames().get(self._thread_id)
+
+        if frame is None:
+            # The thread is gone
+            return
+
+        names = []
+
+        while frame is not None:
+            names.append(self._name(frame.f_code))
+            frame = frame.f_back
+
+        stack = ';'.join(reversed(names))
+        self._stacks[stack] = self._stacks.get(stack, 0) + 1
+        self.samples += 1
+
+    def _name(self, code) -> str:
+        name = self._names.get(code)
+
+        if name is None:
+            name = self._names[code] = '%s (%s)' % (
+                getattr(code, 'co_qualname', code.co_name), os.path.basename(code.co_filename)
+            )
+
+        return name
+
+    def _run(self) -> None:
+        interval = 1.0 / self.rate
+
+        while not self._stopping.wait(interval):
+            self.sample()
+
+
+class SlowLog(object):
+    """
+    Logs the requests which took longer than threshold seconds from the moment they were
+    received until their reply, with the number of tokens of the expression and the split of
+    the time between parsing, waiting in the queue of the pool and the execution.
+
+    The execution time comes from the whole batch the expression was sent in.
+    """
+
+    def __init__(self, threshold: float):
+        self.threshold = threshold
+
+    def record(self, expression: str, tokens: int, total: float, parse: float, timing: tuple = None) -> None:
+        """
+        timing is the (queue wait, execution, batch size) of the pool, None when it isn't known
+        """
+        slow_total.inc()
+
+        if timing is None:
+            logger.warning(
+                "Slow expression (%.3f ms, %d tokens, parse %.3f ms): %s",
+                total * 1000, tokens, parse * 1000, expression
+            )
+            return
+
+        queue, execute, batch = timing
+        logger.warning(
+            "Slow expression (%.3f ms, %d tokens, parse %.3f ms, queue %.3f ms, execute %.3f ms "
+            "for a batch of %d): %s",
+            total * 1000, tokens, parse * 1000, queue * 1000, execute * 1000, batch, expression
+        )
@@ -0,0 +1,100 @@
+"""
+Binary protocol of the math server, for the clients which don't want to format and parse text.
+
+Every frame starts with its length (the bytes after the length), all the numbers are big endian.
+
+Request: length (uint32), request id (uint32), the expression in UTF-8.
+
+Response: length (uint32), request id (uint32), status (uint8) and the value:
+
+RESULT_FLOAT - IEEE-754 double
+RESULT_INT - int64
+RESULT_TEXT - UTF-8 text, for the results which don't fit the other types (huge integers)
+ERROR_* - UTF-8 error message
+
+Responses are sent as soon as the results are ready, so they can come in any order, the request id
+matches them to the requests. A float result is unpacked with FLOAT_RESPONSE.unpack_from() once its
+status byte (at STATUS_OFFSET) is known. There is no welcome message.
+"""
+import struct
+
+RESULT_FLOAT = 0
+RESULT_INT = 1
+RESULT_TEXT = 2
+ERROR_INVALID = 3
+ERROR_CALCULATION = 4
+ERROR_BUSY = 5
+ERROR_PROTOCOL = 6
+
+LENGTH = struct.Struct('!I')
+REQUEST_ID = struct.Struct('!I')
+REQUEST = struct.Struct('!II')
+RESPONSE = struct.Struct('!IIB')
+FLOAT_RESPONSE = struct.Struct('!IIBd')
+INT_RESPONSE = struct.Struct('!IIBq')
+
+# Offset of the status in a response
+STATUS_OFFSET = 8
+
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+
+
+class FrameError(ValueError):
+    """
+    Raised for a frame which can't be decoded, request_id is 0 when it's not known
+    """
+
+    def __init__(self, request_id: int, message: str):
+        super().__init__(message)
+        self.request_id = request_id
+
+
+def pack_request(request_id: int, expression: str) -> bytes:
+    data = expression.encode('utf8')
+    return REQUEST.pack(len(data) + 4, request_id) + data
+
+
+def pack_result(request_id: int, result) -> bytes:
+    if result.__class__ is float:
+        return FLOAT_RESPONSE.pack(13, request_id, RESULT_FLOAT, result)
+
+    if result.__class__ is int and INT64_MIN <= result <= INT64_MAX:
+        return INT_RESPONSE.pack(13, request_id, RESULT_INT, result)
+
+    return pack_error(request_id, RESULT_TEXT, str(result))
+
+
+def pack_error(request_id: int, status: int, message: str) -> bytes:
+    data = message.encode('utf8')
+    return RESPONSE.pack(len(data) + 5, request_id, status) + data
+
+
+def unpack_responses(data: bytes) -> tuple:
+    """
+    Splits the received data into responses, returns a list of (request id, status, value)
+    and the bytes of the incomplete response at the end, which should be prepended to the next data
+    """
+    responses = []
+    offset = 0
+
+    while len(data) - offset >= LENGTH.size:
+        (length,) = LENGTH.unpack_from(data, offset)
+
+        if len(data) - offset - LENGTH.size < length:
+            break
+
+        status = data[offset + STATUS_OFFSET]
+
+        if status == RESULT_FLOAT:
+            responses.append(FLOAT_RESPONSE.unpack_from(data, offset)[1:])
+        elif status == RESULT_INT:
+            responses.append(INT_RESPONSE.unpack_from(data, offset)[1:])
+        else:
+            request_id = REQUEST_ID.unpack_from(data, offset + LENGTH.size)[0]
+            text = str(data[offset + RESPONSE.size:offset + LENGTH.size + length], 'utf8')
+            responses.append((request_id, status, text))
+
+        offset += LENGTH.size + length
+
+    return responses, data[offset:]
@@ -1,17 +1,36 @@
 import logging
 import socket
+import threading
+import weakref
+from collections import deque
+from itertools import islice
 
-from mathcp.loop import Tickable
+from mathcp.loop import Tickable, EVENT_READ, EVENT_WRITE
+from mathcp.metrics import SIZE_BUCKETS, registry
+from mathcp.protocol import LENGTH, REQUEST_ID, FrameError
 
 logger = logging.getLogger(__name__)
 
+read_bytes = registry.histogram('mathcp_socket_read_bytes', "Bytes received by a read from a socket", SIZE_BUCKETS)
+write_bytes = registry.histogram('mathcp_socket_write_bytes', "Bytes sent by a write to a socket", SIZE_BUCKETS)
+
+# Maximum number of segments written with a single sendmsg call (IOV_MAX on Linux)
+MAX_SEGMENTS = 1024
+
+_sendmsg = hasattr(socket.socket, 'sendmsg')
+
+# Receive buffers shared by the framers of a thread, by size
+_scratch = threading.local()
+
 
 class SocketCallback(object):
     """
-    This is a helper class which holds Connections callbacks which
-    have to be called when event in socket occurs.
+    This is a helper class which holds the callbacks to be called when an event occurs in
+    a socket. Connections are callbacks themselves, this is for the sockets used without one.
     """
 
+    __slots__ = ('_on_message', '_on_error', '_on_disconnect')
+
     def __init__(self, on_message: callable, on_error: callable, on_disconnect: callable):
         self._on_message = on_message
         self._on_error = on_error
@@ -26,62 +45,419 @@ class SocketCallback(object):
     def on_disconnect(self) -> None:
         self._on_disconnect()
 
-    def __del__(self):
-        logger.debug("Destruct %s", type(self))
 
+class LineFramer(object):
+    """
+    Splits a stream of bytes into lines without copying the received data.
+
+    Data is received straight into the free space returned by get_buffer() (with recv_into),
+    then feed() scans only the new bytes for the separator and returns the complete lines
+    as memoryviews of the buffer. They are valid until the next call of get_buffer() of any framer
+    of the thread, so they should be decoded right away. Only the incomplete tail is moved to the
+    start of the buffer, and only when there is no free space left after it.
+
+    A framer without an incomplete line holds no buffer, the data is received in a scratch buffer
+    shared by the framers of the thread. Only an incomplete line at the end of the data is copied
+    to a buffer of the framer, which is dropped again once the line is complete, so idle
+    connections cost no buffer memory.
+    """
+
+    __slots__ = ('_separator', '_read_size', '_buffer', '_view', '_owned', '_start', '_end', '_scan')
+
+    def __init__(self, separator: bytes, read_size=65536):
+        self._separator = separator
+        self._read_size = read_size
+        self._buffer = None
+        self._view = None
+        self._owned = False
+        self._start = 0
+        self._end = 0
+        self._scan = 0
+
+    @property
+    def pending(self) -> int:
+        """
+        Number of bytes of the incomplete line
+        """
+        return self._end - self._start
+
+    @property
+    def allocated(self) -> int:
+        """
+        Size of the buffer of the framer, 0 when it uses the scratch buffer
+        """
+        return len(self._buffer) if self._owned else 0
+
+    def get_buffer(self) -> memoryview:
+        """
+        Returns the free space of the buffer where the next data should be received
+        """
+        if self._buffer is None:
+            self._buffer, self._view = _scratch_buffer(self._read_size)
+        elif len(self._buffer) - self._end < self._read_size:
+            self._compact()
+
+        return self._view[self._end:]
+
+    def feed(self, size: int) -> list:
+        """
+        Marks size bytes of the free space as received and returns the completed lines
+        """
+        self._end += size
+        lines = []
+        find, separator, view = self._buffer.find, self._separator, self._view
+        start, end = self._start, self._end
+
+        while True:
+            index = find(separator, self._scan, end)
+
+            if index < 0:
+                break
+
+            lines.append(view[start:index])
+            start = self._scan = index + len(separator)
+
+        if start != end:
+            # A separator can be split between two reads
+            self._scan = max(start, end - len(separator) + 1)
+
+        self._consume(start)
+        return lines
+
+    @staticmethod
+    def decode(line: memoryview, encoding: str) -> str:
+        """
+        Returns the message of a line returned by feed()
+        """
+        return str(line, encoding).strip()
+
+    def _consume(self, start: int) -> None:
+        """
+        Marks the data before start as consumed
+        """
+        if start == self._end:
+            # Everything is consumed, the buffer is not needed until the next read
+            self._start = self._end = self._scan = 0
+            self._buffer = self._view = None
+            self._owned = False
+        else:
+            self._start = start
+
+            if not self._owned:
+                self._own()
+
+    def _own(self) -> None:
+        """
+        Copies the incomplete line from the scratch buffer to a buffer of the framer
+        """
+        pending = self._end - self._start
+        buffer = bytearray(pending + self._read_size)
+        buffer[:pending] = self._view[self._start:self._end]
+        self._scan -= self._start
+        self._start, self._end = 0, pending
+        self._buffer, self._view = buffer, memoryview(buffer)
+        self._owned = True
+
+    def _compact(self) -> None:
+        pending = self._end - self._start
+
+        if self._start:
+            self._buffer[:pending] = self._buffer[self._start:self._end]
+            self._scan -= self._start
+            self._start, self._end = 0, pending
+
+        if len(self._buffer) - self._end < self._read_size:
+            # The incomplete line doesn't leave enough space for a read
+            self._view.release()
+            self._buffer.extend(bytes(self._read_size))
+            self._view = memoryview(self._buffer)
+
+
+class LengthFramer(LineFramer):
+    """
+    Splits a stream of length prefixed frames (see mathcp.protocol) like LineFramer splits lines,
+    the messages are tuples of the request id and the expression.
+
+    pending includes the announced length of the incomplete frame, so a frame which is too long is
+    refused as soon as its length is received.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, read_size=65536):
+        super().__init__(b'', read_size)
+
+    @property
+    def pending(self) -> int:
+        pending = self._end - self._start
+
+        if pending < LENGTH.size:
+            return pending
+
+        return max(pending, LENGTH.size + LENGTH.unpack_from(self._buffer, self._start)[0])
 
-class Socket(Tickable):
+    def feed(self, size: int) -> list:
+        """
+        Marks size bytes of the free space as received and returns the completed frames without their length
+        """
+        self._end += size
+        frames = []
+        buffer, view, header = self._buffer, self._view, LENGTH.size
+        start, end = self._start, self._end
+
+        while end - start >= header:
+            (length,) = LENGTH.unpack_from(buffer, start)
+
+            if end - start - header < length:
+                break
+
+            frames.append(view[start + header:start + header + length])
+            start += header + length
+
+        self._consume(start)
+        return frames
+
+    @staticmethod
+    def decode(frame: memoryview, encoding: str) -> tuple:
+        if len(frame) < REQUEST_ID.size:
+            raise FrameError(0, "Frame is too short")
+
+        (request_id,) = REQUEST_ID.unpack_from(frame)
+
+        try:
+            return request_id, str(frame[REQUEST_ID.size:], encoding)
+        except UnicodeDecodeError:
+            raise FrameError(request_id, "Invalid encoding")
+
+
+def _scratch_buffer(size: int) -> tuple:
+    """
+    Returns the bytearray and memoryview of the scratch buffer of the thread for the size
+    """
+    try:
+        return _scratch.buffers[size]
+    except AttributeError:
+        _scratch.buffers = {}
+    except KeyError:
+        pass
+
+    buffer = bytearray(size)
+    _scratch.buffers[size] = buffer, memoryview(buffer)
+    return _scratch.buffers[size]
+
+
+def create_framer(separator: str, encoding: str, read_size=65536) -> LineFramer:
+    """
+    Returns the framer which splits the messages by the separator, or length prefixed frames without one
+    """
+    if separator is None:
+        return LengthFramer(read_size)
+
+    return LineFramer(separator.encode(encoding), read_size)
+
+
+class BaseSocket(Tickable):
+    """
+    Base class of the sockets of all the backends, passes the lines from the framer to the callback.
+
+    Sub-classes set _callback, _encoding, _framer and _max_line_length.
+    """
+
+    __slots__ = ('_callback', '_encoding', '_framer', '_max_line_length')
+
+    def _deliver(self, lines: list) -> None:
+        callback, encoding, decode = self._callback, self._encoding, self._framer.decode
+
+        for line in lines:
+            if not self._loop:
+                # Connection was closed by one of the previous messages
+                return
+
+            try:
+                callback.on_message(decode(line, encoding))
+            except Exception as e:
+                callback.on_error(e)
+
+        if self._loop and self._framer.pending > self._max_line_length:
+            logger.info("Line is longer than %d bytes, closing the connection", self._max_line_length)
+            callback.on_error(BufferError("Line is too long"))
+
+            if self._loop:
+                callback.on_disconnect()
+
+
+class Socket(BaseSocket):
     """
     Socket is a wrapper to the raw socket, and handles reads, writes, decoding of messages.
+
+    Data is read with recv_into in a reusable buffer of read_size bytes, lines are decoded only
+    when they are complete. A client which sends a line longer than max_line_length is disconnected.
+
+    Written messages are queued as separate segments and flushed together with sendmsg. When more
+    than high_watermark bytes are waiting for the client, reading from it is paused until the queue
+    drains below low_watermark, so a client which doesn't read its results can't grow it forever.
+
+    The callback is an object with on_message, on_error and on_disconnect methods, like a Connection
+    or a SocketCallback. Without a separator the socket receives length prefixed frames (LengthFramer).
     """
 
-    def __init__(self, raw_socket, callback: SocketCallback, separator='\r\n', encoding='utf8'):
+    __slots__ = (
+        '_socket', '_write_queue', '_write_offset', '_write_size', '_high_watermark', '_low_watermark',
+        '_paused', '_reading_paused', '_closing'
+    )
+
+    def __init__(self, raw_socket, callback: SocketCallback, separator='\r\n', encoding='utf8',
+                 read_size=65536, max_line_length=65536, high_watermark=65536, low_watermark=16384):
         super().__init__()
         self._socket = raw_socket
         self._callback = callback
-        self._separator = separator.encode(encoding)
         self._encoding = encoding
+        self._max_line_length = max_line_length
+
+        self._framer = create_framer(separator, encoding, read_size)
+
+        # Created by the first write and dropped when it's sent
+        self._write_queue = None
+        self._write_offset = 0
+        self._write_size = 0
+        self._high_watermark = high_watermark
+        self._low_watermark = low_watermark
+        self._paused = False
+        self._reading_paused = False
+        self._closing = False
+
+    @property
+    def paused(self) -> bool:
+        """
+        True while reading is paused because the client doesn't read its replies
+        """
+        return self._paused
 
-        self._read_buffer = bytearray()
-        self._write_buffer = bytes()
+    def pause_reading(self) -> None:
+        """
+        Stops reading from the socket until resume_reading() is called
+        """
+        if not self._reading_paused:
+            self._reading_paused = True
+            self.interest_changed()
+
+    def resume_reading(self) -> None:
+        if self._reading_paused:
+            self._reading_paused = False
+            self.interest_changed()
+
+    def close(self) -> None:
+        """
+        Disconnects once the queued messages are sent
+        """
+        self._closing = True
+
+        if not self._write_queue:
+            self._callback.on_disconnect()
 
     def print(self, message: str, end="\r\n") -> None:
         """
         Writes a string to the socket
         """
         try:
-            self._write_buffer += ("%s%s" % (message, end)).encode(self._encoding)
+            data = ("%s%s" % (message, end)).encode(self._encoding)
         except Exception as e:
             self._callback.on_error(e)
+            return
+
+        self.write(data)
+
+    def write(self, data: bytes) -> None:
+        """
+        Writes bytes to the socket
+        """
+        if self._write_queue is None:
+            self._write_queue = deque()
+
+        self._write_queue.append(data)
+        self._write_size += len(data)
+
+        if not self._paused and self._write_size > self._high_watermark:
+            self._paused = True
+            self.interest_changed()
+        elif len(self._write_queue) == 1:
+            self.interest_changed()
+
+    def fileno(self) -> int:
+        return self._socket.fileno()
+
+    def interest(self) -> int:
+        events = 0 if self._paused or self._reading_paused else EVENT_READ
+        return events | EVENT_WRITE if self._write_queue else events
 
     def tick(self) -> None:
-        if self._write_buffer:
-            try:
-                bytes_send = self._socket.send(self._write_buffer)
-                self._write_buffer = self._write_buffer[bytes_send:]
-            except BlockingIOError:
-                # Cannot write at the moment
-                pass
+        self._write()
+
+        if self._loop and not self._paused and not self._reading_paused:
+            self._read()
+
+    def on_ready(self, events: int) -> None:
+        if events & EVENT_WRITE:
+            self._write()
+
+        if events & EVENT_READ and self._loop:
+            self._read()
+
+    def _write(self) -> None:
+        if not self._write_queue:
+            return
+
+        queue = self._write_queue
+        head = memoryview(queue[0])[self._write_offset:]
 
         try:
-            data = self._socket.recv(1024)
+            if _sendmsg:
+                size = self._socket.sendmsg([head, *islice(queue, 1, MAX_SEGMENTS)])
+            else:
+                size = self._socket.send(head)
+        except BlockingIOError:
+            # Cannot write at the moment
+            return
+        except ConnectionError:
+            self._callback.on_disconnect()
+            return
+
+        write_bytes.observe(size)
+        self._write_size -= size
+        size += self._write_offset
+
+        # Drop the fully sent segments, a partially sent one is kept together with the sent offset
+        while queue and size >= len(queue[0]):
+            size -= len(queue.popleft())
 
-            if data == b'':
+        self._write_offset = size
+
+        if not queue:
+            self._write_queue = None
+
+            if self._closing:
                 self._callback.on_disconnect()
                 return
 
-            self._read_buffer.extend(data)
+        if not queue or (self._paused and self._write_size <= self._low_watermark):
+            self._paused = False
+            self.interest_changed()
+
+    def _read(self) -> None:
+        try:
+            size = self._socket.recv_into(self._framer.get_buffer())
         except BlockingIOError:
             # Cannot read at the moment
-            pass
+            return
+        except ConnectionError:
+            size = 0
 
-        *messages, self._read_buffer = self._read_buffer.split(self._separator)
+        if size == 0:
+            self._callback.on_disconnect()
+            return
 
-        for message in messages:
-            try:
-                self._callback.on_message(message.decode(self._encoding).strip())
-            except Exception as e:
-                self._callback.on_error(e)
+        read_bytes.observe(size)
+        self._deliver(self._framer.feed(size))
 
     def destroy(self) -> None:
         super().destroy()
@@ -89,9 +465,6 @@ class Socket(Tickable):
         del self._socket
         del self._callback
 
-    def __del__(self) -> None:
-        logger.debug("Destruct %s", type(self))
-
 
 class Connection(Tickable):
     """
@@ -100,18 +473,25 @@ class Connection(Tickable):
     your app logic in on_message method for example.
 
     You should provide separator and encoding to be able to decode and split messages
-    received on the socket.
+    received on the socket (a separator of None receives length prefixed frames),
+    read_size, max_line_length and the write watermarks (see Socket) can be passed as server dependencies.
+
+    The connection is the callback of its socket. Sub-classes can define __slots__ to save the
+    memory of a __dict__ for every connection.
     """
 
-    def __init__(self, raw_socket, separator: str, encoding: str, **kwargs):
+    __slots__ = ('_socket',)
+
+    def __init__(self, raw_socket, separator: str, encoding: str, read_size=65536, max_line_length=65536,
+                 high_watermark=65536, low_watermark=16384, **kwargs):
         super().__init__()
+        options = (read_size, max_line_length, high_watermark, low_watermark)
 
-        self._socket = Socket(
-            raw_socket,
-            SocketCallback(self.on_message, self.on_message_error, self.on_disconnect),
-            separator,
-            encoding
-        )
+        if isinstance(raw_socket, socket.socket):
+            self._socket = Socket(raw_socket, self, separator, encoding, *options)
+        else:
+            # Sockets of other backends (see mathcp.aio) are created by their server
+            self._socket = raw_socket.attach(self, separator, encoding, *options)
 
     def send(self, message:str, end="\r\n") -> None:
         """
@@ -119,6 +499,27 @@ class Connection(Tickable):
         """
         return self._socket.print(message, end=end)
 
+    def write(self, data: bytes) -> None:
+        """
+        Send bytes to the client, for binary protocols
+        """
+        self._socket.write(data)
+
+    def close(self) -> None:
+        """
+        Closes the connection after the messages sent so far reach the client
+        """
+        self._socket.close()
+
+    def pause_reading(self) -> None:
+        """
+        Stops receiving messages until resume_reading() is called, TCP will make the client wait
+        """
+        self._socket.pause_reading()
+
+    def resume_reading(self) -> None:
+        self._socket.resume_reading()
+
     def on_connected(self) -> None:
         """
         Called when connection object is ready to receive data from the socket
@@ -137,6 +538,10 @@ class Connection(Tickable):
         """
         pass
 
+    def on_error(self, error: Exception) -> None:
+        # Socket callback
+        self.on_message_error(error)
+
     def on_disconnect(self) -> None:
         """
         Called when connection to the user is lost.
@@ -152,8 +557,65 @@ class Connection(Tickable):
         self._socket.destroy()
         del self._socket
 
-    def __del__(self) -> None:
-        logger.debug("Destruct %s", type(self))
+
+class Admission(object):
+    """
+    Limits the requests in flight (accepted and not answered yet) of all the connections
+    and of each connection, 0 means no limit.
+
+    Connections check full() before accepting a request. With the 'pause' policy a connection
+    over the limits keeps the message and stops reading from its socket, so TCP pushes back
+    to the client, connections waiting for the global limit are resumed with on_admitted()
+    when other requests finish. With the 'reject' policy the request is answered right away
+    with a busy error and counted in shed.
+    """
+
+    def __init__(self, max_in_flight=0, max_connection_in_flight=0, policy='pause'):
+        if policy not in ('pause', 'reject'):
+            raise ValueError("Unknown admission policy %s" % policy)
+
+        self.max_in_flight = max_in_flight
+        self.max_connection_in_flight = max_connection_in_flight
+        self.policy = policy
+        self.in_flight = 0
+        self.shed = 0
+        self._waiting = {}
+
+    @property
+    def waiting(self) -> int:
+        """
+        Number of connections waiting for the global limit
+        """
+        return len(self._waiting)
+
+    def full(self, connection_in_flight: int) -> bool:
+        """
+        Returns True when a connection with connection_in_flight requests can't start a new one
+        """
+        return bool(
+            (self.max_in_flight and self.in_flight >= self.max_in_flight) or
+            (self.max_connection_in_flight and connection_in_flight >= self.max_connection_in_flight)
+        )
+
+    def acquire(self) -> None:
+        self.in_flight += 1
+
+    def release(self) -> None:
+        self.in_flight -= 1
+
+        while self._waiting and not (self.max_in_flight and self.in_flight >= self.max_in_flight):
+            connection = next(iter(self._waiting))
+            del self._waiting[connection]
+            connection.on_admitted()
+
+    def wait(self, connection: 'Connection') -> None:
+        """
+        Calls connection.on_admitted() when the global limit allows new requests
+        """
+        self._waiting[connection] = None
+
+    def cancel(self, connection: 'Connection') -> None:
+        self._waiting.pop(connection, None)
 
 
 class Server(Tickable):
@@ -169,9 +631,12 @@ class Server(Tickable):
 
     def __init__(self, socket, ..., service1, **kwargs):
         service1.call()
+
+    With reuse_port several processes can listen on the same port (SO_REUSEPORT)
+    and the kernel balances the new connections between them.
     """
 
-    def __init__(self, host: str, port: int, connection_class: Connection, **kwargs):
+    def __init__(self, host: str, port: int, connection_class: Connection, reuse_port=False, **kwargs):
         super().__init__()
         self._host = host
         self._port = port
@@ -181,27 +646,56 @@ class Server(Tickable):
 
         self._connection_class = connection_class
         self._socket = None
+        self._reuse_port = reuse_port
         self._dependencies = kwargs
+        self._connections = weakref.WeakSet()
+
+    @property
+    def connection_count(self) -> int:
+        """
+        Number of connections which are still open or wait for results
+        """
+        return len(self._connections)
 
     def listen(self) -> None:
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+        if self._reuse_port:
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
         self._socket.setblocking(0)
         self._socket.bind((self._host, self._port))
         self._socket.listen()
         logger.info("Listening on %s:%s", self._host, self._port)
 
+    def fileno(self) -> int:
+        return self._socket.fileno() if self._socket else None
+
     def tick(self) -> None:
-        try:
-            raw_socket, _ = self._socket.accept()
+        while True:
+            try:
+                raw_socket, _ = self._socket.accept()
+            except BlockingIOError:
+                # No new connections
+                return
+
             raw_socket.setblocking(0)
-            logger.info("New connection from %s:%s", _[0], _[1])
+
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("New connection from %s:%s", _[0], _[1])
 
             if callable(self._connection_class):
                 connection = self._connection_class(raw_socket, **self._dependencies)
+                self._connections.add(connection)
                 self.loop.add(connection)
                 connection.on_connected()
 
-        except BlockingIOError:
-            # No new connections
-            pass
+    def destroy(self) -> None:
+        """
+        Stops accepting new connections, the accepted ones keep running
+        """
+        super().destroy()
+
+        if self._socket:
+            self._socket.close()
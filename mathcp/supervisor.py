@@ -0,0 +1,179 @@
+import logging
+import multiprocessing
+import signal
+import socket
+import time
+from multiprocessing.connection import wait
+
+from mathcp.loop import Tickable
+
+logger = logging.getLogger(__name__)
+
+SHUTDOWN_SIGNALS = (signal.SIGTERM, signal.SIGINT)
+
+
+class ShutdownHandler(Tickable):
+    """
+    Drains the servers when SIGTERM or SIGINT is received: the servers stop accepting new connections
+    and the loop is stopped when all the connections are closed, or after drain_timeout seconds.
+
+    The signal handler only sets a flag, the wakeup fd of the signal module makes the loop return from
+    select so the flag is checked in tick(). Signal handlers can be installed only from the main thread.
+    """
+
+    def __init__(self, *servers, drain_timeout=10.0):
+        super().__init__()
+        self._servers = servers
+        self._drain_timeout = drain_timeout
+        self._signaled = False
+        self._deadline = None
+        self._wakeup_reader, self._wakeup_writer = socket.socketpair()
+        self._wakeup_reader.setblocking(0)
+        self._wakeup_writer.setblocking(0)
+
+    def install(self) -> 'ShutdownHandler':
+        for signum in SHUTDOWN_SIGNALS:
+            signal.signal(signum, self._on_signal)
+
+        signal.set_wakeup_fd(self._wakeup_writer.fileno())
+        return self
+
+    def fileno(self) -> int:
+        # While draining the handler is ticked on every loop to check the connections
+        return None if self._deadline else self._wakeup_reader.fileno()
+
+    @property
+    def connection_count(self) -> int:
+        return sum(server.connection_count for server in self._servers)
+
+    def _on_signal(self, signum: int, frame) -> None:
+        self._signaled = True
+
+    def tick(self) -> None:
+        try:
+            self._wakeup_reader.recv(4096)
+        except BlockingIOError:
+            pass
+
+        if not self._signaled:
+            return
+
+        if self._deadline is None:
+            logger.info("Draining %d connections", self.connection_count)
+
+            for server in self._servers:
+                server.destroy()
+
+            # Added again without a file descriptor so the loop polls it
+            self._deadline = time.monotonic() + self._drain_timeout
+            self.loop.add(self)
+            return
+
+        if not self.connection_count or time.monotonic() >= self._deadline:
+            logger.info("Stopping with %d connections", self.connection_count)
+            self.loop.stop()
+
+    def destroy(self) -> None:
+        super().destroy()
+        signal.set_wakeup_fd(-1)
+        self._wakeup_reader.close()
+        self._wakeup_writer.close()
+
+
+class Supervisor(object):
+    """
+    Runs target in a number of worker processes and restarts the workers which die. target is called
+    with the index of the worker, a restarted worker gets the index of the one it replaces.
+
+    On SIGTERM or SIGINT the signal is passed to the workers so they can drain their
+    connections, workers which don't exit in drain_timeout seconds are killed.
+    A worker which dies is restarted at most once every restart_delay seconds.
+    """
+
+    def __init__(self, target: callable, workers: int, drain_timeout=10.0, restart_delay=1.0):
+        self._target = target
+        self._workers = [None] * workers
+        self._started = [0.0] * workers
+        self._drain_timeout = drain_timeout
+        self._restart_delay = restart_delay
+        self._context = multiprocessing.get_context('fork')
+        self._stopping = False
+        self._wakeup_reader, self._wakeup_writer = socket.socketpair()
+        self._wakeup_reader.setblocking(0)
+        self._wakeup_writer.setblocking(0)
+
+    @property
+    def pids(self) -> list:
+        return [worker.pid for worker in self._workers if worker]
+
+    def run(self) -> None:
+        for signum in SHUTDOWN_SIGNALS:
+            signal.signal(signum, self._on_signal)
+
+        # Wakes up the wait for the workers when a signal is received
+        signal.set_wakeup_fd(self._wakeup_writer.fileno())
+
+        while not self._stopping:
+            timeout = None
+
+            for index, worker in enumerate(self._workers):
+                if worker and worker.is_alive():
+                    continue
+
+                if worker:
+                    logger.warning("Worker %d exited with code %s", worker.pid, worker.exitcode)
+                    self._workers[index] = None
+
+                delay = self._started[index] + self._restart_delay - time.monotonic()
+
+                if delay > 0:
+                    timeout = delay if timeout is None else min(timeout, delay)
+                else:
+                    self._start(index)
+
+            wait([self._wakeup_reader] + [worker.sentinel for worker in self._workers if worker], timeout)
+
+            try:
+                self._wakeup_reader.recv(4096)
+            except BlockingIOError:
+                pass
+
+        self._drain()
+        signal.set_wakeup_fd(-1)
+
+    def _start(self, index: int) -> None:
+        worker = self._context.Process(target=self._run_worker, args=(index,))
+        worker.start()
+        logger.info("Started worker %d", worker.pid)
+        self._workers[index] = worker
+        self._started[index] = time.monotonic()
+
+    def _run_worker(self, index: int) -> None:
+        # The handlers of the supervisor are inherited by the fork
+        for signum in SHUTDOWN_SIGNALS:
+            signal.signal(signum, signal.SIG_DFL)
+
+        signal.set_wakeup_fd(-1)
+        self._wakeup_reader.close()
+        self._wakeup_writer.close()
+
+        self._target(index)
+
+    def _on_signal(self, signum: int, frame) -> None:
+        self._stopping = True
+
+    def _drain(self) -> None:
+        workers = [worker for worker in self._workers if worker]
+
+        for worker in workers:
+            worker.terminate()
+
+        deadline = time.monotonic() + self._drain_timeout
+
+        for worker in workers:
+            worker.join(max(deadline - time.monotonic(), 0))
+
+            if worker.is_alive():
+                logger.warning("Killing worker %d", worker.pid)
+                worker.kill()
+                worker.join()
@@ -12,7 +12,8 @@ setup(
     packages=find_packages(exclude=[]),
     entry_points={
         'console_scripts': [
-            'mathcp = mathcp.__main__:main'
+            'mathcp = mathcp.__main__:main',
+            'mathcp-bench = mathcp.bench:main'
         ]
     },
 )
@@ -0,0 +1,71 @@
+import time
+from threading import Thread
+from unittest import TestCase, skipUnless
+
+from mathcp.__main__ import run_server
+from mathcp.bench import (
+    arithmetic_throughput, cache_hit_rate, connection_memory, load, micro, percentile, pool_startup, vectorized
+)
+from mathcp.math import numpy
+
+
+class BenchTestCase(TestCase):
+    port = 8897
+
+    @classmethod
+    def setUpClass(cls):
+        Thread(target=run_server, args=('', cls.port), daemon=True).start()
+        time.sleep(1)
+
+    def test_percentile(self):
+        values = list(range(1000))
+
+        self.assertEqual(percentile(values, 0.5), 500)
+        self.assertEqual(percentile(values, 0.999), 999)
+        self.assertEqual(percentile([], 0.5), 0.0)
+
+    def test_load(self):
+        results = load('127.0.0.1', self.port, connections=3, requests=50, pipeline=4,
+                       mix=('short', 'deep', 'long', 'repeated'))
+
+        self.assertEqual(results['requests'], 150)
+        self.assertEqual(results['errors'], 0)
+        self.assertGreater(results['throughput'], 0)
+        self.assertLessEqual(results['latency_ms']['p50'], results['latency_ms']['p999'])
+
+    def test_micro(self):
+        results = micro(100)
+
+        self.assertGreater(results['message'], 0)
+        self.assertEqual(set(results), {
+            'prepare_input', 'shunting_yard', 'rpn_execute', 'socket_tick', 'message', 'message_debug'
+        })
+
+    def test_connection_memory(self):
+        # Without a read buffer an idle connection is a few objects, it was about 69 KB with one
+        self.assertLess(connection_memory(100), 2048)
+
+    def test_cache_hit_rate(self):
+        results = cache_hit_rate(500, mix=('short', 'variants'))
+
+        self.assertLess(results['canonical_keys'], results['token_keys'])
+        self.assertGreater(results['canonical_key_hit_rate'], results['token_key_hit_rate'])
+
+    def test_arithmetic_throughput(self):
+        results = arithmetic_throughput(100, arithmetics=('float', 'fraction', 'decimal(50)'))
+
+        self.assertEqual(set(results), {'float', 'fraction', 'decimal(50)'})
+        self.assertTrue(all(throughput > 0 for throughput in results.values()))
+
+    @skipUnless(numpy, "NumPy is not installed")
+    def test_vectorized(self):
+        results = vectorized(200)
+
+        self.assertEqual(len(results), 3)
+        self.assertTrue(all(set(timings) == {'scalar', 'vector'} for timings in results.values()))
+
+    def test_pool_startup(self):
+        results = pool_startup(2, ('thread executor',))
+
+        self.assertEqual(set(results), {'thread executor cold', 'thread executor warm'})
+        self.assertTrue(all(milliseconds > 0 for milliseconds in results.values()))
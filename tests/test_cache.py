@@ -0,0 +1,99 @@
+import multiprocessing
+import os
+import tempfile
+from unittest import TestCase, mock
+
+from mathcp.cache import SLOT, ResultCache
+
+
+def put_in_child(cache: ResultCache) -> None:
+    cache.put('2 * 21', 42)
+
+
+class ResultCacheTestCase(TestCase):
+    def test_get_put(self):
+        cache = ResultCache(64)
+        self.assertIsNone(cache.get('1 + 2'))
+
+        cache.put('1 + 2', 3)
+        cache.put('7 / 2', 3.5)
+        cache.put('9 * 9', 9 ** 30)
+
+        self.assertEqual(cache.get('1 + 2'), 3)
+        self.assertIs(cache.get('1 + 2').__class__, int)
+        self.assertEqual(cache.get('7 / 2'), 3.5)
+        # Too big for a slot
+        self.assertIsNone(cache.get('9 * 9'))
+        self.assertEqual((cache.hits, cache.misses), (3, 2))
+
+    def test_clock_eviction(self):
+        cache = ResultCache(4, ways=4)
+
+        for i in range(4):
+            cache.put(str(i), i)
+
+        # Referenced slots get a second chance
+        self.assertEqual(cache.get('0'), 0)
+        cache.put('4', 4)
+
+        self.assertEqual(cache.get('0'), 0)
+        self.assertIsNone(cache.get('1'))
+        self.assertEqual(cache.get('4'), 4)
+
+    def test_torn_slot(self):
+        cache = ResultCache(8)
+        cache.put('1 + 2', 3)
+
+        # Corrupt the value byte of the only used slot like a write in progress would
+        start = cache._slots
+        offset = next(start + i for i in range(0, 8 * SLOT.size, SLOT.size) if any(cache._map[start + i:start + i + 4]))
+        cache._map[offset + SLOT.size - 3] ^= 0xff
+
+        self.assertIsNone(cache.get('1 + 2'))
+
+    def test_replaced_slot(self):
+        cache = ResultCache(8, ways=8)
+        cache.put('1 + 2', 3)
+        cache.put('2 + 2', 4)
+
+        start = cache._slots
+        first, second = (start + i for i in range(0, 8 * SLOT.size, SLOT.size) if any(cache._map[start + i:start + i + 4]))
+
+        class Replacing(object):
+            """
+            Another process replaces the slot of '1 + 2' with a valid entry after its key was checked
+            """
+            size = SLOT.size
+
+            @staticmethod
+            def unpack_from(memory, offset):
+                return SLOT.unpack_from(memory, second if offset == first else offset)
+
+        with mock.patch('mathcp.cache.SLOT', Replacing):
+            self.assertIsNone(cache.get('1 + 2'))
+
+        self.assertEqual(cache.get('1 + 2'), 3)
+
+    def test_shared_with_forked_processes(self):
+        cache = ResultCache(64)
+        process = multiprocessing.get_context('fork').Process(target=put_in_child, args=(cache,))
+        process.start()
+        process.join()
+
+        self.assertEqual(cache.get('2 * 21'), 42)
+
+    def test_file(self):
+        path = os.path.join(tempfile.mkdtemp(), 'results')
+        cache = ResultCache(64, path)
+        cache.put('1 + 2', 3)
+        cache.close()
+
+        cache = ResultCache(64, path)
+        self.assertEqual(cache.get('1 + 2'), 3)
+        cache.close()
+
+        # Another layout starts empty
+        cache = ResultCache(128, path)
+        self.assertIsNone(cache.get('1 + 2'))
+        cache.close()
+        os.remove(path)
@@ -1,6 +1,8 @@
+import socket
+import time
 from unittest import TestCase
 
-from mathcp.loop import Tickable, Loop
+from mathcp.loop import Tickable, Loop, SelectorLoop, EVENT_READ
 
 
 def once():
@@ -33,6 +35,23 @@ class LoopTestCase(TestCase):
         except Exception as e:
             self.assertEqual(str(e), "tick2")
 
+    def test_destroy_during_loop(self):
+        ticked = []
+
+        class TestTickable(Tickable):
+            def tick(self):
+                ticked.append(self)
+                other.destroy()
+                self.loop.add(PolledTickable())
+
+        tickable, other = TestTickable(), TestTickable()
+        loop = Loop(tickable, other)
+        loop.run(1, sleep=0)
+
+        # The destroyed tickable is skipped and the added one waits for the next loop
+        self.assertEqual(ticked, [tickable])
+        self.assertEqual(len(loop), 2)
+
     def test_tick_destroy_and_remove(self):
         class TestTickable(Tickable):
             def destroy(self):
@@ -49,3 +68,102 @@ class LoopTestCase(TestCase):
         except Exception as e:
             self.assertEqual(str(e), "destroy")
             self.assertEqual(tickable._loop, None)
+
+
+class SocketTickable(Tickable):
+    def __init__(self, raw_socket):
+        super().__init__()
+        self.socket = raw_socket
+        self.ready = []
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def on_ready(self, events):
+        self.ready.append(events)
+        self.socket.recv(1024)
+
+
+class PolledTickable(Tickable):
+    def tick(self):
+        pass
+
+
+class SelectorLoopTestCase(TestCase):
+    def setUp(self):
+        self.left, self.right = socket.socketpair()
+
+    def tearDown(self):
+        self.left.close()
+        self.right.close()
+
+    def test_ready(self):
+        tickable = SocketTickable(self.left)
+        self.right.send(b'data')
+
+        SelectorLoop(tickable).run(1)
+        self.assertEqual(tickable.ready, [EVENT_READ])
+
+    def test_not_ready(self):
+        tickable = SocketTickable(self.left)
+
+        # The polled tickable makes the selector wait only `sleep` seconds
+        SelectorLoop(tickable, PolledTickable()).run(1, sleep=0)
+        self.assertEqual(tickable.ready, [])
+
+    def test_tick_without_fileno(self):
+        class TestTickable(Tickable):
+            def tick(self):
+                raise Exception("tick")
+
+        with self.assertRaises(Exception) as context:
+            SelectorLoop(TestTickable()).run(1, sleep=0)
+
+        self.assertEqual(str(context.exception), "tick")
+
+    def test_destroy(self):
+        tickable = SocketTickable(self.left)
+        loop = SelectorLoop(tickable, PolledTickable())
+        tickable.destroy()
+        self.right.send(b'data')
+
+        loop.run(1, sleep=0)
+        self.assertEqual(tickable.ready, [])
+
+
+class LoopBenchmarkTestCase(TestCase):
+    """
+    The cost of adding and removing a tickable and the loop overhead per tickable should not
+    grow with the number of tickables in the loop.
+    """
+
+    @staticmethod
+    def churn(count: int) -> float:
+        tickables = [PolledTickable() for _ in range(count)]
+        loop = Loop(*tickables)
+        start = time.perf_counter()
+
+        # Remove the oldest tickables first, the worst case for a list
+        for tickable in tickables:
+            tickable.destroy()
+            loop.add(tickable)
+
+        return (time.perf_counter() - start) / count
+
+    @staticmethod
+    def loop_pass(count: int) -> float:
+        loop = Loop(*(PolledTickable() for _ in range(count)))
+        start = time.perf_counter()
+        loop.run(10, sleep=0)
+        return (time.perf_counter() - start) / count
+
+    def assertFlat(self, measure: callable) -> None:
+        small = min(measure(1000) for _ in range(3))
+        large = min(measure(20000) for _ in range(3))
+        self.assertLess(large / small, 5)
+
+    def test_churn(self):
+        self.assertFlat(self.churn)
+
+    def test_loop_pass(self):
+        self.assertFlat(self.loop_pass)
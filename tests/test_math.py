@@ -1,6 +1,14 @@
+import operator
+import pickle
+import signal
+from decimal import Decimal
+from fractions import Fraction
+import time
 import unittest
 
-from mathcp.math import calculate
+from mathcp.math import calculate, calculate_many, compile, execute_vectorized, execute_rows, execute_bindings, \
+    execute_many, get_arithmetic, numpy, set_time_limit, ExpressionTimeout, Program, UnboundVariableError, ExpressionCache, \
+    prepare_input, rpn_compile, rpn_execute, shunting_yard, NUMBER, OPERATOR, LEFT_PAREN, RIGHT_PAREN
 
 
 class MathTestCase(unittest.TestCase):
@@ -59,6 +67,45 @@ class MathTestCase(unittest.TestCase):
         with self.assertRaises(SyntaxError):
             calculate('2 * pi')
 
+    def test_calculate_many(self):
+        results = calculate_many(['1 + 1', '1 +', '1 / 0', '2.5 * 2'])
+
+        self.assertEqual(results[0], 2)
+        self.assertIsInstance(results[1], SyntaxError)
+        self.assertIsInstance(results[2], ZeroDivisionError)
+        self.assertEqual(results[3], 5.0)
+
+    def test_variables(self):
+        self.assertEqual(calculate('a * (b + 2)', {'a': 3, 'b': 4}), 18)
+        self.assertEqual(calculate('rate_1 * rate_1', {'rate_1': 1.5}), 2.25)
+
+        with self.assertRaises(UnboundVariableError):
+            calculate('a * (b + 2)', {'a': 3})
+
+        with self.assertRaises(SyntaxError):
+            calculate('a b')
+
+    def test_execute_rows(self):
+        program = compile('a * (b + 2) - a')
+
+        self.assertEqual(program.variables, ('a', 'b'))
+        self.assertEqual(execute_rows(program, [(1, 2), (2, 0.5), (-1, 0)]), [3, 3.0, -1])
+
+        results = execute_bindings([(program, (1, 2)), (compile('x / y'), (1, 0)), (program, (2, 2))])
+        self.assertEqual(results[0], 3)
+        self.assertIsInstance(results[1], ZeroDivisionError)
+        self.assertEqual(results[2], 6)
+
+    def test_variables_order(self):
+        # The canonical expression sorts the operands, the variables stay in the order of the expression
+        program = compile('rate * qty + fee')
+        self.assertEqual(program.key, 'fee + qty * rate')
+        self.assertEqual(program.variables, ('rate', 'qty', 'fee'))
+
+        # Same canonical program, the values of the rows are in the order of each one's variables
+        results = execute_bindings([(compile('b * c + a'), (1, 2, 3)), (compile('a + b * c'), (1, 2, 3))])
+        self.assertEqual(results, [5, 7])
+
     def test_a_lot_of_operations(self):
         self.assertAlmostEqual(
             calculate('3*(5+(39+(18*3/13)/7)*6-3)/0.999'),
@@ -69,3 +116,257 @@ class MathTestCase(unittest.TestCase):
             calculate('(3 * (5 + ((39 + (((18 * 3) / 13) / 7)) * 6) - 3)) / 0.999'),
             719.4007194007193
         )
+
+
+class TokenizerTestCase(unittest.TestCase):
+    def test_tokens(self):
+        tokens = prepare_input('(12 + 2.5)*3')
+
+        self.assertEqual([token.kind for token in tokens],
+                         [LEFT_PAREN, NUMBER, OPERATOR, NUMBER, RIGHT_PAREN, OPERATOR, NUMBER])
+        self.assertEqual([token.text for token in tokens], ['(', '12', '+', '2.5', ')', '*', '3'])
+        self.assertEqual([token.value for token in tokens if token.kind is NUMBER], [12, 2.5, 3])
+        self.assertIsInstance(tokens[1].value, int)
+
+    def test_invalid_number(self):
+        for case in ['1.2.3', '.', '1?']:
+            with self.assertRaises(SyntaxError):
+                prepare_input(case)
+
+    def test_invalid_structure(self):
+        for case in ['1 2', '()', '(1', '1)', '(1 +) 2', '']:
+            with self.assertRaises(SyntaxError):
+                calculate(case)
+
+
+class CompileTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache = ExpressionCache(maxsize=2)
+
+    def test_execute(self):
+        program = compile('((1 + 3) / 3.14) * 4 - 5.1', self.cache)
+        self.assertEqual(program.execute(), calculate('((1 + 3) / 3.14) * 4 - 5.1'))
+        self.assertEqual(compile('a + 2 * b', self.cache).code, ('a', 2, 'b', operator.mul, operator.add))
+
+    def test_cache_hit(self):
+        program = compile('1+2', self.cache)
+
+        self.assertIs(compile(' 1 + 2 ', self.cache), program)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_cache_eviction(self):
+        program = compile('1', self.cache)
+        compile('2', self.cache)
+        compile('1', self.cache)
+        compile('3', self.cache)
+
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(self.cache.evictions, 1)
+        self.assertIs(compile('1', self.cache), program)
+
+        self.cache.maxsize = 1
+        self.assertEqual(len(self.cache), 1)
+
+    def test_immutable(self):
+        program = compile('1 + 2', self.cache)
+
+        with self.assertRaises(AttributeError):
+            program.code = ()
+
+    def test_invalid(self):
+        for case in ['', '(1', '1 +']:
+            with self.assertRaises(SyntaxError):
+                compile(case, self.cache)
+
+        self.assertEqual(len(self.cache), 0)
+
+    def test_canonical_key(self):
+        for spellings in [
+            ['(1+2)*3', '3 * ( 1 + 2 )', '((9))', '009'],
+            ['(a + b) * c', 'c*(b+a)', '((c)) * ((a) + b)'],
+            ['a + 2 * b', 'b * 2 + a', '(b * 2) + a'],
+            ['x / (4 / 2)', 'x / 2.0', 'x / (1.0 + 1)'],
+        ]:
+            keys = {compile(expression, self.cache).key for expression in spellings}
+            self.assertEqual(len(keys), 1, spellings)
+
+        # Operations are not regrouped, (a + b) + c and a + (b + c) differ for floats
+        self.assertNotEqual(compile('(a + b) + c', self.cache).key, compile('a + (b + c)', self.cache).key)
+        self.assertEqual(compile('a - (b - c)', self.cache).key, 'a - (b - c)')
+        self.assertEqual(compile('(a - b) - c', self.cache).key, 'a - b - c')
+
+    def test_constant_folding(self):
+        self.assertEqual(compile('(1 + 2) * 3', self.cache).code, (9,))
+        self.assertEqual(compile('7 / 2 + 0.25', self.cache).code, (3.75,))
+        # Negative numbers, division by zero and big integers are left to the execution
+        self.assertEqual(compile('1 - 2 * 3', self.cache).key, '1 - 6')
+        self.assertEqual(compile('1 / (2 - 2)', self.cache).key, '1 / 0')
+        self.assertEqual(compile('%d * 2' % 2 ** 52, self.cache).key, '2 * %d' % 2 ** 52)
+
+        for expression in ['1 - 2 * 3', '1 / (2 - 2)', '7 / 2 + 0.25', '(1.5 + 2) * 3 - 0.1', '100 * 100']:
+            try:
+                # Without canonicalize
+                expected = rpn_execute(shunting_yard(prepare_input(expression)))
+            except Exception as e:
+                expected = e
+
+            result = execute_many([compile(expression, self.cache)])[0]
+            self.assertIs(type(result), type(expected))
+
+            if not isinstance(expected, Exception):
+                self.assertEqual(result, expected)
+
+    def test_debug_log(self):
+        with self.assertLogs('mathcp.math', 'DEBUG') as logs:
+            compile('1 + 2 * 3', self.cache)
+
+        self.assertEqual(logs.output, ['DEBUG:mathcp.math:RPN: 1 2 3 * +'])
+
+
+class ArithmeticTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache = ExpressionCache()
+        self.fraction = get_arithmetic('fraction')
+        self.decimal = get_arithmetic('decimal(5)')
+
+    def test_fraction(self):
+        program = compile('0.1 + 0.2 - 1 / 3', self.cache, self.fraction)
+
+        self.assertEqual(program.execute(), Fraction(-1, 30))
+        self.assertEqual(program.key, 'fraction: 0.1 + 0.2 - 1 / 3')
+        self.assertEqual(rpn_execute(shunting_yard(prepare_input('7 / 2')), arithmetic=self.fraction), Fraction(7, 2))
+
+    def test_decimal(self):
+        self.assertEqual(compile('1 / 3', self.cache, self.decimal).execute(), Decimal('0.33333'))
+        self.assertEqual(compile('0.1 + 0.2', self.cache, self.decimal).execute(), Decimal('0.3'))
+        self.assertIs(get_arithmetic('decimal'), get_arithmetic('decimal(28)'))
+
+    def test_precise_literals(self):
+        # The literals aren't rounded to floats on the way to the exact numbers
+        decimal50 = get_arithmetic('decimal(50)')
+        program = compile('1.23456789012345678901234567890 * 1', self.cache, decimal50)
+        self.assertEqual(program.execute(), Decimal('1.23456789012345678901234567890'))
+
+        program = compile('0.1000000000000000000001 + 0', self.cache, self.fraction)
+        self.assertEqual(program.execute(), Fraction('0.1000000000000000000001'))
+        self.assertNotEqual(program.key, compile('0.1 + 0', self.cache, self.fraction).key)
+
+    def test_not_folded(self):
+        # The float program would be the constant 3.5
+        self.assertEqual(compile('7 / 2', self.cache).code, (3.5,))
+        self.assertEqual(compile('7 / 2', self.cache, self.fraction).code, (Fraction(7), Fraction(2), operator.truediv))
+
+    def test_errors(self):
+        for arithmetic in (self.fraction, self.decimal):
+            with self.assertRaisesRegex(ZeroDivisionError, '^division by zero$'):
+                compile('1 / (2 - 2)', self.cache, arithmetic).execute()
+
+            with self.assertRaises(UnboundVariableError):
+                compile('a + 1', self.cache, arithmetic).execute()
+
+        for name in ('double', 'decimal(0)', 'decimal(x)', 'decimal(100000)'):
+            with self.assertRaises(SyntaxError):
+                get_arithmetic(name)
+
+    def test_batches(self):
+        programs = [compile('%d / 3' % i, self.cache, self.fraction) for i in range(200)]
+        self.assertEqual(execute_many(programs), [Fraction(i, 3) for i in range(200)])
+
+        program = compile('a / 3', self.cache, self.fraction)
+        rows = [(self.fraction.parse(str(i)),) for i in range(200)]
+        self.assertEqual(execute_rows(program, rows), [Fraction(i, 3) for i in range(200)])
+
+    def test_pickle(self):
+        program = pickle.loads(pickle.dumps(compile('1 / 3', self.cache, self.decimal)))
+
+        self.assertIs(program.arithmetic, self.decimal)
+        self.assertEqual(program.execute(), Decimal('0.33333'))
+
+    def test_cost(self):
+        expression = '1 / 3 + 2 / 7'
+        cost = compile(expression, self.cache).cost
+
+        self.assertGreater(compile(expression, self.cache, self.fraction).cost, cost)
+        self.assertGreater(compile('1%s / 3 + 2 / 7' % ('0' * 1000), self.cache, self.fraction).cost,
+                           compile(expression, self.cache, self.fraction).cost)
+        self.assertGreater(compile(expression, self.cache, get_arithmetic('decimal(5000)')).cost,
+                           compile(expression, self.cache, self.decimal).cost)
+
+
+@unittest.skipUnless(numpy, "NumPy is not installed")
+class VectorizedTestCase(unittest.TestCase):
+    def assertSameResults(self, expressions):
+        # Not canonicalized, compile() would fold the constant programs to a number
+        programs = [rpn_compile(shunting_yard(prepare_input(expression)), expression) for expression in expressions]
+        results = execute_vectorized(programs, min_group=1)
+
+        for program, result in zip(programs, results):
+            try:
+                expected = program.execute()
+            except Exception as e:
+                expected = e
+
+            self.assertIs(type(result), type(expected), program.key)
+
+            if not isinstance(expected, Exception):
+                self.assertEqual(result, expected, program.key)
+
+    def test_integer(self):
+        self.assertSameResults(['(%d + 3) * %d - 7' % (i, i * 13) for i in range(100)])
+
+    def test_float(self):
+        self.assertSameResults(['(%d + 3.5) * %d / 7' % (i, i * 13) for i in range(100)])
+        self.assertSameResults(['%d * %s' % (i, '2.0' if i % 2 else '2') for i in range(100)])
+
+    def test_without_key(self):
+        # rpn_compile() programs have no key, the float numbers decide the type of the results
+        programs = [rpn_compile(shunting_yard(prepare_input('%d.5 + 1' % i))) for i in range(3)]
+        self.assertEqual(execute_vectorized(programs, min_group=1), [1.5, 2.5, 3.5])
+
+        program = rpn_compile(shunting_yard(prepare_input('a + 0.5')))
+        self.assertEqual(execute_rows(program, [(i,) for i in range(200)])[:2], [0.5, 1.5])
+
+    def test_fallback(self):
+        self.assertSameResults(['%d / %d' % (i, i % 3) for i in range(100)])
+        self.assertSameResults(['%d * %d' % (2 ** 40 + i, 2 ** 20) for i in range(100)])
+        self.assertSameResults(['%d + 1' % (10 ** 400 * i) for i in range(100)])
+
+    def test_rows(self):
+        program = compile('a * (b + 2) - a / 4')
+        rows = [(i, i % 3 + (0.5 if i % 2 else 0)) for i in range(-100, 100)] + [(2 ** 60, 1), (1, -2)]
+
+        self.assertEqual(execute_rows(program, rows), [program.execute({'a': a, 'b': b}) for a, b in rows])
+        self.assertIsInstance(execute_rows(compile('a / (b + 2)'), rows)[-1], ZeroDivisionError)
+
+        program = compile('a * b + 1')
+        rows = [(i, i * 3) for i in range(200)] + [(2 ** 40, 2 ** 20), (1.5, 2)]
+        results = execute_rows(program, rows)
+
+        self.assertEqual(results, [a * b + 1 for a, b in rows])
+        self.assertEqual([type(result) for result in results], [type(a * b + 1) for a, b in rows])
+
+    def test_mixed_shapes(self):
+        self.assertSameResults(['1 + %d' % i if i % 2 else '%d * 2 - 1' % i for i in range(100)] + ['7'])
+
+
+class TimeLimitTestCase(unittest.TestCase):
+    def tearDown(self):
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, signal.SIG_DFL)
+
+    def test_time_limit(self):
+        slow = Program('slow', (1, 1, lambda a, b: time.sleep(1)), 2, '##?', ())
+        set_time_limit(0.02)
+        start = time.monotonic()
+
+        results = execute_many([compile('1 + 1'), slow, compile('2 + 2')])
+
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertEqual(results[0], 2)
+        self.assertIsInstance(results[1], ExpressionTimeout)
+        self.assertEqual(results[2], 4)
+
+    def test_idle(self):
+        set_time_limit(0.01)
+        time.sleep(0.05)
+        self.assertEqual(execute_many([compile('1 + 1')]), [2])
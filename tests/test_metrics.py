@@ -0,0 +1,64 @@
+from unittest import TestCase
+
+from mathcp.metrics import Registry
+
+
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter(self):
+        counter = self.registry.counter('requests_total', "Requests")
+        counter.inc()
+        counter.inc(2)
+
+        self.assertIs(self.registry.counter('requests_total', "Requests"), counter)
+        self.assertEqual(counter.value, 3)
+        self.assertEqual(self.registry.stats(), ['STAT requests_total 3'])
+
+    def test_histogram(self):
+        histogram = self.registry.histogram('latency_seconds', "Latency", (0.1, 1.0))
+
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value)
+
+        self.assertEqual(histogram.counts, [2, 1, 1])
+        self.assertEqual(histogram.count, 4)
+        self.assertAlmostEqual(histogram.sum, 2.65)
+        self.assertEqual(histogram.quantile(0.5), 0.1)
+        self.assertEqual(histogram.quantile(0.75), 1.0)
+        self.assertEqual(histogram.quantile(1), float('inf'))
+
+    def test_gauge(self):
+        values = [1]
+        self.registry.gauge('open', "Open", lambda: values[0])
+        values[0] = 5
+        # A gauge registered again reads from the new function
+        self.registry.gauge('open', "Open", lambda: values[0] * 2)
+
+        self.assertEqual(self.registry.stats(), ['STAT open 10'])
+
+    def test_function_counter(self):
+        totals = [3]
+        self.registry.counter('shed_total', "Shed", lambda: totals[0])
+        totals[0] = 4
+
+        self.assertEqual(self.registry.stats(), ['STAT shed_total 4'])
+        self.assertIn('# TYPE shed_total counter\nshed_total 4\n', self.registry.prometheus())
+
+    def test_prometheus(self):
+        self.registry.counter('requests_total', "Requests").inc()
+        self.registry.histogram('size_bytes', "Size", (10, 100)).observe(50)
+
+        self.assertEqual(self.registry.prometheus(), '\n'.join([
+            '# HELP requests_total Requests',
+            '# TYPE requests_total counter',
+            'requests_total 1',
+            '# HELP size_bytes Size',
+            '# TYPE size_bytes histogram',
+            'size_bytes_bucket{le="10"} 0',
+            'size_bytes_bucket{le="100"} 1',
+            'size_bytes_bucket{le="+Inf"} 1',
+            'size_bytes_sum 50',
+            'size_bytes_count 1',
+        ]) + '\n')
@@ -0,0 +1,190 @@
+from unittest import TestCase
+
+import time
+
+from mathcp.loop import Loop, SelectorLoop
+from mathcp.math import warm_up
+from mathcp.parallel import BasePool, ExecutorPool, Pool, Scheduler, create_executor
+
+
+def double_all(values):
+    return [ValueError(value) if value < 0 else value * 2 for value in values]
+
+
+class SyncPool(BasePool):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.submitted = []
+
+    def _submit(self, func, args, on_success, on_error):
+        self.submitted.append(args)
+        on_success(func(*args))
+
+
+class SchedulerTestCase(TestCase):
+    def test_inline(self):
+        scheduler = Scheduler(threshold=0.001, unit_time=0.0001)
+
+        self.assertTrue(scheduler.inline(10))
+        self.assertFalse(scheduler.inline(11))
+        self.assertEqual((scheduler.inlined, scheduler.offloaded), (1, 1))
+
+    def test_disabled(self):
+        self.assertFalse(Scheduler(threshold=0).inline(0))
+
+    def test_tuning(self):
+        scheduler = Scheduler(threshold=0.001, unit_time=0.0001, alpha=1)
+
+        scheduler.on_inline(10, 0.00001)
+        self.assertAlmostEqual(scheduler.unit_time, 0.000001)
+        self.assertTrue(scheduler.inline(1000))
+
+        scheduler.on_round_trip(0.0002)
+        self.assertEqual(scheduler.threshold, 0.0002)
+        self.assertFalse(scheduler.inline(1000))
+
+
+class PoolTestCase(TestCase):
+    def setUp(self):
+        self.results = []
+        self.errors = []
+
+    def test_batched(self):
+        pool = SyncPool(batch_size=3, scheduler=Scheduler(threshold=0))
+        loop = Loop(pool)
+
+        for value in (1, -1, 2, 3):
+            pool.add_batched(double_all, value, self.results.append, self.errors.append)
+
+        self.assertEqual(pool.submitted, [(double_all, [1, -1, 2])])
+
+        loop.run(1, sleep=0)
+        self.assertEqual(pool.submitted, [(double_all, [1, -1, 2]), (double_all, [3])])
+        self.assertEqual(self.results, [2, 4, 6])
+        self.assertEqual([str(error) for error in self.errors], ['-1'])
+        self.assertIsNotNone(pool.scheduler.round_trip)
+
+    def test_callback_error(self):
+        pool = SyncPool(scheduler=Scheduler(threshold=0))
+        loop = Loop(pool)
+
+        for value in (1, 2):
+            pool.add_batched(double_all, value, self.fail_on_two, self.errors.append)
+
+        loop.run(1, sleep=0)
+        self.assertEqual(self.results, [2])
+        self.assertEqual([str(error) for error in self.errors], ['4'])
+
+    def fail_on_two(self, result):
+        if result == 4:
+            raise ValueError(result)
+
+        self.results.append(result)
+
+    def test_batch_cost(self):
+        pool = SyncPool(batch_size=10, scheduler=Scheduler(threshold=0, unit_time=0.001, batch_time=0.005))
+        loop = Loop(pool)
+
+        for value, cost in ((1, 2), (2, 2), (3, 1), (4, 10), (5, 1)):
+            pool.add_batched(double_all, value, self.results.append, self.errors.append, cost=cost)
+
+        # Sent when the predicted time of the batch reaches 5 ms
+        self.assertEqual(pool.submitted, [(double_all, [1, 2, 3]), (double_all, [4])])
+
+        loop.run(1, sleep=0)
+        self.assertEqual(pool.submitted[-1], (double_all, [5]))
+        self.assertEqual(self.results, [2, 4, 6, 8, 10])
+
+    def test_inline(self):
+        pool = SyncPool()
+        Loop(pool)
+
+        pool.add_batched(double_all, 1, self.results.append, self.errors.append, cost=1)
+        pool.add(sum, ([1, 2],), self.results.append, self.errors.append, cost=1)
+
+        self.assertEqual(pool.submitted, [])
+        self.assertEqual(self.results, [2, 3])
+        self.assertEqual(pool.scheduler.inlined, 2)
+
+    def test_inline_callback_error(self):
+        pool = SyncPool()
+        Loop(pool)
+
+        pool.add(str, ('x',), int, self.errors.append, cost=1)
+        pool.add(sum, ([1, 2],), self.results.append, self.errors.append, cost=1)
+
+        self.assertEqual([error.__class__ for error in self.errors], [ValueError])
+        self.assertEqual(self.results, [3])
+
+
+class ProcessPoolTestCase(TestCase):
+    def create_pool(self):
+        return Pool(batch_size=8, scheduler=Scheduler(threshold=0))
+
+    def test_completion(self):
+        pool = self.create_pool()
+        loop = SelectorLoop(pool)
+        results, errors = [], []
+
+        try:
+            for value in range(-2, 30):
+                pool.add_batched(double_all, value, results.append, errors.append)
+
+            deadline = time.monotonic() + 10
+
+            while len(results) + len(errors) < 32 and time.monotonic() < deadline:
+                loop.run(1, sleep=0.1)
+        finally:
+            pool.destroy()
+
+        self.assertEqual(sorted(results), [value * 2 for value in range(30)])
+        self.assertEqual(sorted(str(error) for error in errors), ['-1', '-2'])
+
+    def test_completion_callback_error(self):
+        pool = self.create_pool()
+        loop = SelectorLoop(pool)
+        results, errors = [], []
+
+        def on_success(result):
+            if result < 0:
+                raise ValueError(result)
+
+            results.append(result)
+
+        def on_error(error):
+            errors.append(error)
+
+            if str(error) == '-1':
+                raise error
+
+        try:
+            pool.add(sum, ([-1],), on_success, on_error)
+            pool.add(sum, ([-2, 2],), on_success, on_error)
+            pool.add(sum, ([1, 2],), on_success, on_error)
+
+            deadline = time.monotonic() + 10
+
+            while len(results) + len(errors) < 3 and time.monotonic() < deadline:
+                loop.run(1, sleep=0.1)
+        finally:
+            pool.destroy()
+
+        # The failed error callback doesn't stop the delivery of the other results
+        self.assertEqual(sorted(str(error) for error in errors), ['-1'])
+        self.assertEqual(sorted(results), [0, 3])
+
+
+class RecycledPoolTestCase(ProcessPoolTestCase):
+    def create_pool(self):
+        return Pool(8, Scheduler(threshold=0), processes=1, initializer=warm_up, maxtasksperchild=1)
+
+
+class ThreadPoolTestCase(ProcessPoolTestCase):
+    def create_pool(self):
+        return ExecutorPool(create_executor('thread', 2, initializer=warm_up), 8, Scheduler(threshold=0))
+
+
+class ProcessExecutorTestCase(ProcessPoolTestCase):
+    def create_pool(self):
+        executor = create_executor('process', 1, 'spawn', warm_up)
+        return ExecutorPool(executor, 8, Scheduler(threshold=0))
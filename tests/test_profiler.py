@@ -0,0 +1,58 @@
+import os
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from mathcp.profiler import SamplingProfiler, SlowLog
+
+
+def busy_loop(stop: threading.Event):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+class SamplingProfilerTestCase(TestCase):
+    def test_collapsed_stacks(self):
+        stop = threading.Event()
+        thread = threading.Thread(target=busy_loop, args=(stop,))
+        thread.start()
+
+        with tempfile.TemporaryDirectory() as directory:
+            profiler = SamplingProfiler(os.path.join(directory, 'loop-{pid}.folded'), rate=1000)
+
+            try:
+                profiler.start(thread.ident)
+                self.assertTrue(profiler.running)
+                time.sleep(0.2)
+            finally:
+                samples = profiler.stop()
+                stop.set()
+                thread.join()
+
+            self.assertFalse(profiler.running)
+            self.assertGreater(samples, 0)
+            self.assertTrue(profiler.path.endswith('loop-%d.folded' % os.getpid()))
+
+            with open(profiler.path) as file:
+                lines = file.read().splitlines()
+
+        self.assertEqual(sum(int(line.rsplit(' ', 1)[1]) for line in lines), samples)
+        self.assertTrue(all('busy_loop (test_profiler.py)' in line for line in lines))
+        # The root of the stacks is the bootstrap of the thread
+        self.assertTrue(all(line.startswith('Thread._bootstrap (threading.py)') for line in lines))
+
+
+class SlowLogTestCase(TestCase):
+    def test_record(self):
+        slow_log = SlowLog(0.1)
+
+        with self.assertLogs('mathcp.profiler', 'WARNING') as logs:
+            slow_log.record('1 + 2', 3, 0.25, 0.001, (0.2, 0.049, 64))
+            slow_log.record('1 / 0', 3, 0.25, 0.001)
+
+        self.assertEqual(logs.output, [
+            'WARNING:mathcp.profiler:Slow expression (250.000 ms, 3 tokens, parse 1.000 ms, queue 200.000 ms, '
+            'execute 49.000 ms for a batch of 64): 1 + 2',
+            'WARNING:mathcp.profiler:Slow expression (250.000 ms, 3 tokens, parse 1.000 ms): 1 / 0',
+        ])
@@ -0,0 +1,132 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+from unittest import TestCase
+
+from mathcp.loop import SelectorLoop
+from mathcp.server import Connection, Server
+from mathcp.supervisor import ShutdownHandler, SHUTDOWN_SIGNALS
+
+
+class Echo(Connection):
+    def __init__(self, raw_socket, **kwargs):
+        super().__init__(raw_socket, '\n', 'utf8', **kwargs)
+
+    def on_message(self, message: str) -> None:
+        self.send(message)
+
+
+def children(pid: int) -> set:
+    with open('/proc/%d/task/%d/children' % (pid, pid)) as file:
+        return {int(child) for child in file.read().split()}
+
+
+def wait_for(condition: callable, timeout=10.0):
+    deadline = time.monotonic() + timeout
+
+    while time.monotonic() < deadline:
+        result = condition()
+
+        if result:
+            return result
+
+        time.sleep(0.05)
+
+    raise AssertionError("Timed out")
+
+
+def connect(port: int):
+    try:
+        return socket.create_connection(('127.0.0.1', port), timeout=5)
+    except ConnectionRefusedError:
+        return None
+
+
+class ShutdownHandlerTestCase(TestCase):
+    port = 8893
+
+    def setUp(self):
+        self.handlers = {signum: signal.getsignal(signum) for signum in SHUTDOWN_SIGNALS}
+
+    def tearDown(self):
+        for signum, handler in self.handlers.items():
+            signal.signal(signum, handler)
+
+    def test_drain(self):
+        server = Server('127.0.0.1', self.port, Echo)
+        server.listen()
+        handler = ShutdownHandler(server, drain_timeout=0.2)
+        loop = SelectorLoop(server, handler.install())
+        client = connect(self.port)
+
+        try:
+            loop.run(1)
+            self.assertEqual(server.connection_count, 1)
+
+            os.kill(os.getpid(), signal.SIGTERM)
+            start = time.monotonic()
+            loop.run()
+
+            # The idle connection is waited for drain_timeout seconds
+            self.assertGreaterEqual(time.monotonic() - start, 0.2)
+            self.assertIsNone(connect(self.port))
+        finally:
+            handler.destroy()
+            client.close()
+
+
+class SupervisorTestCase(TestCase):
+    port = 8894
+
+    def test_workers(self):
+        process = subprocess.Popen(
+            [sys.executable, '-m', 'mathcp', '127.0.0.1', str(self.port), '--workers', '2', '--drain-timeout', '1'],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        )
+
+        try:
+            connection = wait_for(lambda: connect(self.port))
+            connection.recv(1024)
+            connection.send(b'1 + 2\n')
+            self.assertEqual(connection.recv(1024), b'3\r\n')
+            connection.close()
+
+            workers = wait_for(lambda: len(children(process.pid)) == 2 and children(process.pid))
+            killed = workers.pop()
+            os.kill(killed, signal.SIGKILL)
+
+            # The dead worker is replaced by a new one
+            wait_for(lambda: len(children(process.pid) - workers - {killed}) == 1)
+
+            process.send_signal(signal.SIGTERM)
+            self.assertEqual(process.wait(15), 0)
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+
+    def test_metrics_ports(self):
+        port, metrics_port = 8908, 8909
+        process = subprocess.Popen(
+            [sys.executable, '-m', 'mathcp', '127.0.0.1', str(port), '--workers', '2',
+             '--drain-timeout', '1', '--metrics-port', str(metrics_port)],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        )
+
+        try:
+            # Each worker serves its own metrics on the next port
+            for worker_port in (metrics_port, metrics_port + 1):
+                connection = wait_for(lambda: connect(worker_port))
+                connection.sendall(b'GET /metrics HTTP/1.0\r\n\r\n')
+                self.assertTrue(connection.recv(1024).startswith(b'HTTP/1.0 200 OK'))
+                connection.close()
+
+            process.send_signal(signal.SIGTERM)
+            self.assertEqual(process.wait(15), 0)
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
@@ -1,23 +1,32 @@
+import os
 import socket
 import time
 from threading import Thread
-from unittest import TestCase
+from unittest import TestCase, mock, skipUnless
 
 from functools import partial
 
+from mathcp import math
 from mathcp.__main__ import run_server
+from mathcp.cache import ResultCache
+from mathcp.loop import Loop, EVENT_READ, EVENT_WRITE
+from mathcp.protocol import (
+    ERROR_CALCULATION, ERROR_INVALID, ERROR_PROTOCOL, FrameError, RESULT_FLOAT, RESULT_INT, RESULT_TEXT,
+    pack_request, unpack_responses
+)
+from mathcp.server import Admission, LengthFramer, LineFramer, Socket, SocketCallback
 
 
-def create_server() -> Thread:
-    return Thread(target=run_server, args=('', 8888), daemon=True)
+def create_server(port: int, backend: str, **kwargs) -> Thread:
+    return Thread(target=run_server, args=('', port, backend), kwargs=kwargs, daemon=True)
 
 
 error_msg = 'Error: Invalid expression!'
 
 
-def create_connection():
+def create_connection(port: int):
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.connect(('', 8888))
+    sock.connect(('', port))
     # Read the welcome message, we don't need it
     sock.recv(1024)
     return sock
@@ -29,15 +38,184 @@ def get_result(sock, message):
     return data.decode().strip()
 
 
+def feed(framer: LineFramer, data: bytes) -> list:
+    buffer = framer.get_buffer()
+    buffer[:len(data)] = data
+    del buffer
+    return [bytes(line) for line in framer.feed(len(data))]
+
+
+class LineFramerTestCase(TestCase):
+    def test_lines(self):
+        framer = LineFramer(b'\n', 16)
+        self.assertEqual(feed(framer, b'1 + 1\n2'), [b'1 + 1'])
+        self.assertEqual(framer.pending, 1)
+        self.assertEqual(feed(framer, b' * 3\n\n4\n'), [b'2 * 3', b'', b'4'])
+        self.assertEqual(framer.pending, 0)
+
+    def test_split_separator(self):
+        framer = LineFramer(b'\r\n', 16)
+        self.assertEqual(feed(framer, b'1\r'), [])
+        self.assertEqual(feed(framer, b'\n2\r'), [b'1'])
+        self.assertEqual(feed(framer, b'\n'), [b'2'])
+
+    def test_long_line(self):
+        framer = LineFramer(b'\n', 4)
+        line = b'1 + 2 + 3 + 4 + 5'
+
+        for i in range(0, len(line), 3):
+            self.assertEqual(feed(framer, line[i:i + 3]), [])
+
+        self.assertEqual(framer.pending, len(line))
+        self.assertEqual(feed(framer, b'\n1'), [line])
+        self.assertEqual(feed(framer, b'\n'), [b'1'])
+
+    def test_idle_buffer(self):
+        framer = LineFramer(b'\n', 16)
+        self.assertEqual(framer.allocated, 0)
+
+        # Complete lines are split in the scratch buffer of the thread
+        self.assertEqual(feed(framer, b'1\n2\n'), [b'1', b'2'])
+        self.assertEqual(framer.allocated, 0)
+
+        # Only an incomplete line needs a buffer of the framer
+        self.assertEqual(feed(framer, b'3\n4 +'), [b'3'])
+        self.assertEqual(framer.allocated, 3 + 16)
+        self.assertEqual(feed(framer, b' 5\n'), [b'4 + 5'])
+        self.assertEqual(framer.allocated, 0)
+
+
+class LengthFramerTestCase(TestCase):
+    def test_frames(self):
+        framer = LengthFramer(16)
+        data = pack_request(1, '1 + 2') + pack_request(2, '3')
+
+        self.assertEqual(feed(framer, data[:7]), [])
+        self.assertEqual(feed(framer, data[7:]), [data[4:13], data[17:]])
+        self.assertEqual(framer.pending, 0)
+        self.assertEqual(framer.decode(data[4:13], 'utf8'), (1, '1 + 2'))
+
+    def test_announced_length(self):
+        framer = LengthFramer(16)
+        self.assertEqual(feed(framer, b'\x00\x01\x00\x00\x00'), [])
+        self.assertEqual(framer.pending, 4 + 65536)
+
+    def test_decode_errors(self):
+        with self.assertRaises(FrameError) as context:
+            LengthFramer.decode(b'\x00', 'utf8')
+
+        self.assertEqual(context.exception.request_id, 0)
+
+        with self.assertRaises(FrameError) as context:
+            LengthFramer.decode(b'\x00\x00\x00\x07\xff', 'utf8')
+
+        self.assertEqual(context.exception.request_id, 7)
+
+
+class SocketTestCase(TestCase):
+    def setUp(self):
+        self.raw_socket, self.client = socket.socketpair()
+        self.raw_socket.setblocking(0)
+        self.messages = []
+        callback = SocketCallback(self.messages.append, self.fail, self.fail)
+        self.socket = Socket(self.raw_socket, callback, '\n', 'utf8', high_watermark=100, low_watermark=20)
+        Loop(self.socket)
+
+    def tearDown(self):
+        self.socket.destroy()
+        self.client.close()
+
+    def receive(self, size: int) -> bytes:
+        data = b''
+
+        while len(data) < size:
+            self.socket.tick()
+            data += self.client.recv(65536)
+
+        return data
+
+    def test_write_queue(self):
+        for i in range(5):
+            self.socket.print(str(i))
+
+        self.assertEqual(self.socket.interest(), EVENT_READ | EVENT_WRITE)
+        self.assertEqual(self.receive(15), b'0\r\n1\r\n2\r\n3\r\n4\r\n')
+        self.assertEqual(self.socket.interest(), EVENT_READ)
+
+    def test_partial_send(self):
+        self.raw_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        messages = ['%d' % i * 1000 for i in range(100)]
+
+        for message in messages:
+            self.socket.print(message)
+
+        expected = ''.join('%s\r\n' % message for message in messages).encode()
+        self.assertEqual(self.receive(len(expected)), expected)
+
+    def test_backpressure(self):
+        self.raw_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+
+        for i in range(10000):
+            self.socket.print('%098d' % i)
+
+        # The client didn't read the replies, so its messages are not read either
+        self.assertTrue(self.socket.paused)
+        self.assertEqual(self.socket.interest(), EVENT_WRITE)
+        self.client.send(b'1 + 1\n')
+        self.socket.tick()
+        self.assertEqual(self.messages, [])
+
+        self.receive(10000 * 100)
+        self.assertFalse(self.socket.paused)
+        self.socket.tick()
+        self.assertEqual(self.messages, ['1 + 1'])
+
+
+class AdmissionTestCase(TestCase):
+    def test_limits(self):
+        admission = Admission(max_in_flight=2, max_connection_in_flight=1)
+        self.assertFalse(admission.full(0))
+        self.assertTrue(admission.full(1))
+
+        admission.acquire()
+        admission.acquire()
+        self.assertTrue(admission.full(0))
+
+    def test_waiting(self):
+        admitted = []
+
+        class Waiting(object):
+            def on_admitted(self):
+                admitted.append(self)
+
+        admission = Admission(max_in_flight=1)
+        first, second, cancelled = Waiting(), Waiting(), Waiting()
+        admission.acquire()
+
+        for connection in (first, cancelled, second):
+            admission.wait(connection)
+
+        admission.cancel(cancelled)
+        self.assertEqual(admission.waiting, 2)
+
+        admission.release()
+        self.assertEqual(admitted, [first, second])
+        self.assertEqual(admission.waiting, 0)
+
+
 class ServerTestCase(TestCase):
+    port = 8888
+    backend = 'select'
+    options = {}
+
     @classmethod
     def setUpClass(cls):
-        thread = create_server()
+        thread = create_server(cls.port, cls.backend, **cls.options)
         thread.start()
         time.sleep(1)
 
     def setUp(self):
-        self.connection = create_connection()
+        self.connection = create_connection(self.port)
         self.calculate = partial(get_result, self.connection)
 
     def tearDown(self):
@@ -87,29 +265,368 @@ class ServerTestCase(TestCase):
     def test_invalid_operand(self):
         self.assertEqual(self.calculate('2 * pi'), error_msg)
 
+    def test_result_too_long(self):
+        # The result has more digits than str() converts
+        self.assertTrue(self.calculate('9' * 3000 + ' * ' + '9' * 3000).startswith('Error: Exceeds the limit'))
+        self.assertEqual(self.calculate('1 + 1'), '2')
+
     def test_invalid_encoding(self):
         self.connection.send("куркума\r\n".encode('cp1251'))
         self.assertEqual(self.connection.recv(1024).decode().strip(), "Error while executing the expression!")
 
     def test_close_connection(self):
         # Ctrl-C
-        connection = create_connection()
+        connection = create_connection(self.port)
         connection.send(("%s\r\n" % chr(0x03)).encode())
         self.assertEqual(connection.recv(1024), b'')
         connection.close()
 
         # exit
-        connection = create_connection()
+        connection = create_connection(self.port)
         connection.send("exit\r\n".encode())
         self.assertEqual(connection.recv(1024), b'')
         connection.close()
 
     def test_two_connections(self):
-        connection1 = create_connection()
-        connection2 = create_connection()
+        connection1 = create_connection(self.port)
+        connection2 = create_connection(self.port)
 
         self.assertEqual(get_result(connection1, '1'), '1')
         self.assertEqual(get_result(connection2, '2'), '2')
 
         connection1.close()
         connection2.close()
+
+    def test_sweep(self):
+        self.assertEqual(self.calculate('sweep a * (b + 2)'), 'Variables: a, b')
+        self.assertEqual(self.calculate('3 4'), '18')
+        self.assertEqual(self.calculate('-1, 0.5'), '-2.5')
+        self.assertEqual(self.calculate('3'), 'Error: Expected 2 values!')
+        self.assertEqual(self.calculate('x 1'), error_msg)
+        self.assertEqual(self.calculate('end'), 'Sweep finished')
+        self.assertEqual(self.calculate('a * 2'), error_msg)
+        self.assertEqual(self.calculate('sweep a *'), error_msg)
+
+        # Columns in the order of the expression, not of the canonical one
+        self.assertEqual(self.calculate('sweep rate * qty + fee'), 'Variables: rate, qty, fee')
+        self.assertEqual(self.calculate('2 3 1'), '7')
+        self.assertEqual(self.calculate('end'), 'Sweep finished')
+
+    def test_split_line(self):
+        for data in (b'1 +', b' 2', b'\r', b'\n'):
+            self.connection.send(data)
+            time.sleep(0.01)
+
+        self.assertEqual(self.connection.recv(1024), b'3\r\n')
+
+    def test_line_too_long(self):
+        connection = create_connection(self.port)
+        connection.settimeout(5)
+
+        try:
+            connection.sendall(b'1 + ' * 20000)
+            # The server closes the connection instead of buffering the line
+            self.assertEqual(connection.recv(1024), b'')
+        except ConnectionResetError:
+            pass
+
+        connection.close()
+
+    def test_pipelined(self):
+        expressions = ['%d * 2' % i for i in range(300)] + ['1 +', '1 / 0', '7']
+        self.connection.send(''.join('%s\r\n' % expression for expression in expressions).encode())
+
+        data = b''
+
+        while data.count(b'\r\n') < len(expressions):
+            data += self.connection.recv(65536)
+
+        self.assertEqual(
+            data.decode().split('\r\n')[:-1],
+            [str(i * 2) for i in range(300)] + [error_msg, 'Error: division by zero', '7']
+        )
+
+    def test_tagged(self):
+        self.assertEqual(self.calculate('tagged'), 'Tagged mode')
+        messages = ['a1 1 + 2', '2 7 / 2', '3 2 * (1', '4 1 / 0', '5']
+        self.connection.send(''.join('%s\r\n' % message for message in messages).encode())
+
+        data = b''
+
+        while data.count(b'\r\n') < len(messages):
+            data += self.connection.recv(65536)
+
+        # Replies are sent when they are ready, not in order
+        self.assertEqual(sorted(data.decode().split('\r\n')[:-1]), [
+            '2 3.5', '3 ' + error_msg, '4 Error: division by zero', 'Error: Expected \'<id> <expression>\'!', 'a1 3'
+        ])
+
+    def test_arithmetic(self):
+        self.assertEqual(self.calculate('fraction: 1 / 3 + 1 / 6'), '1/2')
+        self.assertEqual(self.calculate('decimal(5): 1 / 3'), '0.33333')
+        self.assertEqual(self.calculate('1 / 2'), '0.5')
+        self.assertEqual(self.calculate('arithmetic integer'), 'Error: Unknown arithmetic integer!')
+
+        self.assertEqual(self.calculate('arithmetic decimal'), 'Arithmetic decimal(28)')
+        self.assertEqual(self.calculate('0.1 + 0.2'), '0.3')
+        self.assertEqual(self.calculate('1 / 0'), 'Error: division by zero')
+        self.assertEqual(self.calculate('sweep a / 4'), 'Variables: a')
+        self.assertEqual(self.calculate('0.2'), '0.05')
+        self.assertEqual(self.calculate('end'), 'Sweep finished')
+
+        self.assertEqual(self.calculate('arithmetic float'), 'Arithmetic float')
+        self.assertEqual(self.calculate('0.1 + 0.2'), str(0.1 + 0.2))
+
+    def test_profile_not_enabled(self):
+        self.assertEqual(self.calculate('profile start'), 'Error: Profiling is not enabled!')
+
+    def test_stats(self):
+        self.assertEqual(self.calculate('1 + 1'), '2')
+        self.connection.send(b'stats\r\n')
+        data = b''
+
+        while not data.endswith(b'END\r\n'):
+            data += self.connection.recv(65536)
+
+        lines = data.decode().split('\r\n')
+        self.assertTrue(all(line.startswith('STAT ') for line in lines[:-2]))
+        self.assertTrue(any(line.startswith('STAT mathcp_connections ') for line in lines))
+        self.assertTrue(any(line.startswith('STAT mathcp_latency_seconds count=') for line in lines))
+
+
+class PollServerTestCase(ServerTestCase):
+    port = 8889
+    backend = 'poll'
+
+
+class AsyncServerTestCase(ServerTestCase):
+    port = 8890
+    backend = 'asyncio'
+
+
+class OffloadServerTestCase(ServerTestCase):
+    port = 8891
+    options = {'inline_threshold': 0}
+
+
+class ResultCacheServerTestCase(ServerTestCase):
+    port = 8907
+    options = {'inline_threshold': 0, 'results': ResultCache(1024)}
+
+    def test_cached_result(self):
+        results = self.options['results']
+        self.assertEqual(self.calculate('6 * 7'), '42')
+        hits = results.hits
+
+        self.assertEqual(self.calculate('6 * 7'), '42')
+        self.assertEqual(self.calculate('6*7'), '42')
+        self.assertEqual(results.hits, hits + 2)
+
+
+class ThreadPoolServerTestCase(ServerTestCase):
+    port = 8892
+    options = {'inline_threshold': 0, 'pool_backend': 'thread', 'pool_size': 2}
+
+    @skipUnless(math.numpy, "NumPy is not installed")
+    def test_vectorized(self):
+        # Negative results aren't folded, so all the programs have the same shape
+        expressions = ['%d - 1000' % i for i in range(200)]
+
+        # The thread workers run in this process, the groups executed as arrays can be counted
+        with mock.patch('mathcp.math._execute_group', side_effect=math._execute_group) as execute_group:
+            self.connection.send(''.join('%s\r\n' % expression for expression in expressions).encode())
+            data = b''
+
+            while data.count(b'\r\n') < len(expressions):
+                data += self.connection.recv(65536)
+
+        self.assertEqual(data.decode().split('\r\n')[:-1], [str(i - 1000) for i in range(200)])
+        # Not only the programs of warm_up
+        vectorized = [program.key for call in execute_group.call_args_list for program in call.args[0]]
+        self.assertIn('199 - 1000', vectorized)
+
+
+class LimitedServerTestCase(ServerTestCase):
+    port = 8895
+    options = {'inline_threshold': 0, 'max_in_flight': 3, 'max_connection_in_flight': 2}
+
+
+class RejectServerTestCase(TestCase):
+    port = 8896
+
+    @classmethod
+    def setUpClass(cls):
+        options = {'inline_threshold': 0, 'max_connection_in_flight': 1, 'overload_policy': 'reject'}
+        create_server(cls.port, 'select', **options).start()
+        time.sleep(1)
+
+    def test_busy(self):
+        connection = create_connection(self.port)
+        connection.send(b'1\r\n2\r\n3\r\n')
+        data = b''
+
+        while data.count(b'\r\n') < 3:
+            data += connection.recv(1024)
+
+        self.assertEqual(data, b'1\r\nError: Server is busy!\r\nError: Server is busy!\r\n')
+        self.assertEqual(get_result(connection, '4'), '4')
+        connection.close()
+
+
+class MetricsServerTestCase(TestCase):
+    port = 8898
+    metrics_port = 8899
+    backend = 'select'
+
+    @classmethod
+    def setUpClass(cls):
+        create_server(cls.port, cls.backend, metrics_port=cls.metrics_port).start()
+        time.sleep(1)
+
+    def scrape(self, request: bytes) -> bytes:
+        connection = socket.create_connection(('127.0.0.1', self.metrics_port), timeout=5)
+        connection.sendall(request)
+        data = b''
+
+        while True:
+            chunk = connection.recv(65536)
+
+            if not chunk:
+                break
+
+            data += chunk
+
+        connection.close()
+        return data
+
+    def test_metrics(self):
+        connection = create_connection(self.port)
+        self.assertEqual(get_result(connection, '1 + 2'), '3')
+        connection.close()
+
+        headers, body = self.scrape(b'GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n').split(b'\r\n\r\n', 1)
+        self.assertTrue(headers.startswith(b'HTTP/1.0 200 OK'))
+        self.assertIn(b'Content-Length: %d' % len(body), headers)
+        self.assertIn(b'# TYPE mathcp_latency_seconds histogram', body)
+        self.assertIn(b'mathcp_latency_seconds_bucket{le="+Inf"}', body)
+        self.assertIn(b'# TYPE mathcp_inlined_total counter', body)
+
+    def test_method_not_allowed(self):
+        self.assertTrue(self.scrape(b'POST /metrics HTTP/1.0\r\n\r\n').startswith(b'HTTP/1.0 405'))
+
+
+class AsyncMetricsServerTestCase(MetricsServerTestCase):
+    port = 8900
+    metrics_port = 8901
+    backend = 'asyncio'
+
+
+class ProfiledServerTestCase(TestCase):
+    port = 8902
+
+    @classmethod
+    def setUpClass(cls):
+        options = {
+            'inline_threshold': 0, 'profile_rate': 1000, 'slow_threshold': 0.000001, 'allow_profile': True,
+            'results': ResultCache(64)
+        }
+        create_server(cls.port, 'select', **options).start()
+        time.sleep(1)
+
+    def test_profile(self):
+        connection = create_connection(self.port)
+        self.assertEqual(get_result(connection, 'profile stop'), 'Error: Profiler is not running!')
+        self.assertEqual(get_result(connection, 'profile start'), 'Profiling at 1000 Hz')
+
+        for _ in range(20):
+            self.assertEqual(get_result(connection, '1 + 2'), '3')
+
+        reply = get_result(connection, 'profile stop')
+        connection.close()
+
+        self.assertRegex(reply, r'^Profile written to .+\.folded \(\d+ samples\)$')
+        path = reply[len('Profile written to '):reply.rindex(' (')]
+        self.assertTrue(os.path.exists(path))
+        os.remove(path)
+
+    def test_slow_log(self):
+        connection = create_connection(self.port)
+
+        with self.assertLogs('mathcp.profiler', 'WARNING') as logs:
+            self.assertEqual(get_result(connection, '(1 - 2) * 3'), '-3')
+
+        connection.close()
+        # The tokens of the message and the canonical expression, 1 - 2 isn't folded to a negative number
+        self.assertRegex(logs.output[0], r'Slow expression .* 7 tokens, .* queue .* execute .*: 3 \* \(1 - 2\)')
+
+
+    def test_slow_log_cached(self):
+        connection = create_connection(self.port)
+        self.assertEqual(get_result(connection, '5 - 7'), '-2')
+
+        with self.assertLogs('mathcp.profiler', 'WARNING') as logs:
+            self.assertEqual(get_result(connection, '5 - 7'), '-2')
+
+        connection.close()
+        # Found in the result cache, the timing of the previous batch of the pool isn't logged
+        self.assertRegex(logs.output[0], r'Slow expression \([^)]* 3 tokens, parse [^,)]*\): 5 - 7$')
+
+
+class BinaryServerTestCase(TestCase):
+    port = 8903
+    binary_port = 8904
+    backend = 'select'
+
+    @classmethod
+    def setUpClass(cls):
+        options = {'inline_threshold': 0, 'binary_port': cls.binary_port}
+        create_server(cls.port, cls.backend, **options).start()
+        time.sleep(1)
+
+    def request(self, data: bytes, count: int) -> dict:
+        connection = socket.create_connection(('127.0.0.1', self.binary_port), timeout=5)
+        connection.sendall(data)
+        responses, rest = [], b''
+
+        while len(responses) < count:
+            received, rest = unpack_responses(rest + connection.recv(1024))
+            responses += received
+
+        connection.close()
+        return {request_id: (status, value) for request_id, status, value in responses}
+
+    def test_results(self):
+        expressions = ['1 + 2', '7 / 2', '2 * (3 + 4', '1 / 0', '9 ' + '* 9 ' * 30]
+        data = b''.join(pack_request(i, expression) for i, expression in enumerate(expressions))
+
+        self.assertEqual(self.request(data, len(expressions)), {
+            0: (RESULT_INT, 3),
+            1: (RESULT_FLOAT, 3.5),
+            2: (ERROR_INVALID, 'Invalid expression'),
+            3: (ERROR_CALCULATION, 'division by zero'),
+            4: (RESULT_TEXT, str(9 ** 31)),
+        })
+
+    def test_arithmetic(self):
+        self.assertEqual(self.request(pack_request(1, 'fraction: 1 / 3'), 1), {1: (RESULT_TEXT, '1/3')})
+
+    def test_result_too_long(self):
+        status, message = self.request(pack_request(1, '9' * 3000 + ' * ' + '9' * 3000), 1)[1]
+        self.assertEqual(status, ERROR_CALCULATION)
+        self.assertTrue(message.startswith('Exceeds the limit'))
+
+    def test_protocol_error(self):
+        self.assertEqual(self.request(b'\x00\x00\x00\x05\x00\x00\x00\x09\xff', 1), {
+            9: (ERROR_PROTOCOL, 'Invalid encoding')
+        })
+
+    def test_text_server(self):
+        connection = create_connection(self.port)
+        self.assertEqual(get_result(connection, '1 + 2'), '3')
+        connection.close()
+
+
+class AsyncBinaryServerTestCase(BinaryServerTestCase):
+    port = 8905
+    binary_port = 8906
+    backend = 'asyncio'